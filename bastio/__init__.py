@@ -34,6 +34,12 @@ Concurrency Utilities
 
 .. rst-class:: html-toggle
 
+Runtime Metrics
+---------------
+.. automodule:: bastio.metrics
+
+.. rst-class:: html-toggle
+
 Logging Facility
 ----------------
 .. automodule:: bastio.log
@@ -25,20 +25,28 @@ from bastio import __version__
 from bastio.log import Logger
 from bastio.mixin import public
 from bastio.configs import GlobalConfigStore
+from bastio.metrics import GlobalMetrics
 from bastio.concurrency import GlobalThreadPool
+from bastio.command import GlobalCommandHelper
 from bastio.account import upload_public_key, download_backend_hostkey
 from bastio.ssh.client import BackendConnector
 from bastio.ssh.api import Processor
 from bastio.ssh.crypto import RSAKey
-from bastio.excepts import BastioConfigError
+from bastio.ssh.keystore import KeyServer, query_keys
+from bastio.excepts import BastioConfigError, BastioException
 
 def __sig_handler(sig, frame):
     logger = Logger()
     logger.critical("signal received, shutting down")
     cfg = GlobalConfigStore()
+    cfg.shutdown = True
     cfg.connector.stop()
     cfg.processor.stop()
     cfg.threadpool.remove_all_workers(3)
+    GlobalCommandHelper().stop()
+
+def __metrics_handler(sig, frame):
+    GlobalMetrics().dump(Logger())
 
 def _check_file_readability(filename):
     # Return a tuple of two status indicators, the first is to indicate that the
@@ -87,7 +95,8 @@ class CommandLine(object):
         # A group for commands that require start action details
         start_group = argparse.ArgumentParser(add_help=False)
         start_group.add_argument('-H', '--host', default='backend.bastio.com',
-                help='host name of the Bastio backend (default: %(default)s)')
+                help=('host name of the Bastio backend or a comma separated list of'
+                    ' host[:port] backend endpoints (default: %(default)s)'))
         start_group.add_argument('-p', '--port', type=int, default=2357,
                 help='port of the backend to connect to (default: %(default)s)')
         start_group.add_argument('-m', '--min-threads', type=int, default=3,
@@ -122,6 +131,11 @@ class CommandLine(object):
         sp.add_parser('start', parents=[start_group, api_group],
                 description='Start the agent in the foreground',
                 help='start the agent')
+        keys_parser = sp.add_parser('authorized-keys',
+                description=('Print the authorized keys of a user as kept by the '
+                    'running agent, for use as sshd\'s AuthorizedKeysCommand.'),
+                help='print the authorized keys of a user')
+        keys_parser.add_argument('username', help='the name of the user')
         self.parser = parser
 
     def parse(self):
@@ -220,6 +234,8 @@ class CommandLine(object):
                     cfg.minthreads = self.args.min_threads
             except BastioConfigError as ex:
                 _die(ex.message)
+        elif self.args.command == 'authorized-keys':
+            cfg.key_username = self.args.username
         else:
             # NOTE: This execution branch is blocked by argparse
             # so it is here only to account for extremely unlikely cases
@@ -231,13 +247,21 @@ def bastio_main():
     """Main application entry point."""
     signal.signal(signal.SIGINT, __sig_handler)
     signal.signal(signal.SIGTERM, __sig_handler)
+    signal.signal(signal.SIGUSR1, __metrics_handler)
     cfg = GlobalConfigStore()
 
     # Parse command line arguments
     cmd = CommandLine()
     command = cmd.parse()
 
-    if command == 'generate-key':
+    if command == 'authorized-keys':
+        try:
+            sys.stdout.write(query_keys(cfg.key_username,
+                cfg.lookup('key_socket', KeyServer.SocketPath)))
+        except BastioException as ex:
+            _die(ex.message)
+        sys.exit(0)
+    elif command == 'generate-key':
         try:
             key = RSAKey.generate(cfg.bits)
             key.write_private_key_file(cfg.agentkey)
@@ -277,10 +301,20 @@ def bastio_main():
     else:
         Logger().enable_syslog()
 
+    # Start the command helper before any thread is, while the agent is small
+    try:
+        GlobalCommandHelper().start()
+    except BastioException as ex:
+        _die(ex.message)
+
     cfg.threadpool = GlobalThreadPool(cfg.minthreads)
-    cfg.processor = Processor()
-    cfg.connector = BackendConnector()
+    try:
+        cfg.connector = BackendConnector()
+        cfg.processor = Processor(cfg.connector.egress)
+    except BastioException as ex:
+        _die(ex.message)
     cfg.connector.register(cfg.processor.endpoint())
     cfg.connector.start()
-    signal.pause()
+    while not cfg.shutdown:
+        signal.pause()
 
@@ -0,0 +1,548 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.command
+:synopsis: Command execution through a small helper process.
+:author: Amr Ali <amr@databracket.com>
+
+Forking the agent to run a command copies an address space that holds the
+SSH stack, the thread pool and the stacks of all of its threads, and forking
+a threaded interpreter is prone to deadlocks on locks held by other threads
+at the time of the fork. Instead, a helper process that only runs this module
+is started early; the agent sends it commands over a pipe and the helper
+spawns them without a shell and reports back their exit code and output.
+
+.. autoclass:: CommandResult
+    :members:
+
+.. autoclass:: CommandHelper
+    :members:
+
+.. autoclass:: GlobalCommandHelper
+    :inherited-members:
+
+.. autofunction:: serve
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import sys
+import json
+import time
+import fcntl
+import errno
+import select
+import signal
+import itertools
+import threading
+import subprocess
+
+from bastio.mixin import KindSingletonMeta, public
+from bastio.configs import GlobalConfigStore
+from bastio.metrics import GlobalMetrics
+from bastio.log import Logger
+from bastio.excepts import BastioCommandError, BastioConfigError
+
+def _to_wire(data):
+    # JSON only carries text, so arbitrary bytes travel as latin-1 code points
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return data.decode('latin-1')
+
+def _from_wire(data):
+    return data.encode('latin-1')
+
+class _Framer(object):
+    """Netstring framing of JSON objects over a file descriptor."""
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._buf = ''
+
+    @staticmethod
+    def compose(obj):
+        data = json.dumps(obj)
+        return '{}:{},'.format(len(data), data)
+
+    def fill(self):
+        """Read available data and return False on EOF."""
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+                break
+            except OSError as ex:
+                if ex.errno != errno.EINTR:
+                    raise
+        self._buf += data
+        return bool(data)
+
+    def next(self):
+        """Return the next complete object in the buffer or None."""
+        delim = self._buf.find(':')
+        if delim < 0:
+            return None
+        length = int(self._buf[:delim])
+        end = delim + 1 + length
+        if len(self._buf) <= end:
+            return None
+        if self._buf[end] != ',':
+            raise ValueError("message terminator is missing")
+        obj = json.loads(self._buf[delim + 1:end])
+        self._buf = self._buf[end + 1:]
+        return obj
+
+    def read(self):
+        """Block until a complete object is read and return it, or None on
+        EOF.
+        """
+        while True:
+            obj = self.next()
+            if obj is not None:
+                return obj
+            if not self.fill():
+                return None
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except OSError as ex:
+            if ex.errno != errno.EINTR:
+                raise
+
+@public
+class CommandResult(object):
+    """The outcome of a command.
+
+    :param code:
+        The exit status of the command, or the negated number of the signal
+        that terminated it.
+    :type code:
+        int
+    :param stdout:
+        What the command wrote to its standard output.
+    :type stdout:
+        str
+    :param stderr:
+        What the command wrote to its standard error.
+    :type stderr:
+        str
+    :param timed_out:
+        Whether the command was terminated because it ran out of time.
+    :type timed_out:
+        bool
+    :param cancelled:
+        Whether the command was terminated by :func:`CommandHelper.cancel_all`.
+    :type cancelled:
+        bool
+    :param truncated:
+        Whether the output of the command was cut at the output limit.
+    :type truncated:
+        bool
+    """
+
+    def __init__(self, code, stdout, stderr, timed_out=False, cancelled=False,
+            truncated=False):
+        self.code = code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+        self.truncated = truncated
+
+    @property
+    def success(self):
+        """Whether the command ran to completion and exited with status 0."""
+        return self.code == 0 and not (self.timed_out or self.cancelled)
+
+    def __repr__(self):
+        return '<CommandResult code={}>'.format(self.code)
+
+@public
+class CommandHelper(object):
+    """A client of the command helper process. The helper is started by
+    :func:`CommandHelper.start` or by the first command, and is restarted by
+    the next command if it exits. Commands are run concurrently by the helper
+    and their latency is tracked by the ``command.latency`` metric.
+
+    A command that runs out of time is sent ``SIGTERM`` along with everything
+    it spawned, followed by ``SIGKILL`` if it's still running after a grace
+    period. Only the first ``command_output_limit`` KiB of each of its outputs
+    are kept.
+    """
+    Timeout = 60.0
+    KillGrace = 5.0
+    OutputLimit = 64
+
+    def __init__(self):
+        cfg = GlobalConfigStore()
+        self._timeout = cfg.lookup('command_timeout', self.Timeout, float)
+        self._grace = cfg.lookup('command_kill_grace', self.KillGrace, float)
+        self._limit = cfg.lookup('command_output_limit', self.OutputLimit, int) * 1024
+        if self._timeout <= 0 or self._grace < 0 or self._limit < 0:
+            raise BastioConfigError("command_timeout must be positive and "
+                    "command_kill_grace and command_output_limit must not be negative")
+        self._logger = Logger()
+        self._lock = threading.Lock()
+        self._proc = None
+        self._reader = None
+        self._ids = itertools.count(1)
+        self._pending = {}
+        metrics = GlobalMetrics()
+        self._spawns = metrics.counter('command.helper_spawns')
+        self._timeouts = metrics.counter('command.timeouts')
+        self._latency = metrics.stats('command.latency')
+
+    @property
+    def running(self):
+        return self._proc is not None
+
+    def start(self):
+        """Start the helper process if it's not running.
+
+        :raises:
+            :class:`bastio.excepts.BastioCommandError`
+        """
+        with self._lock:
+            if self._proc is None:
+                self._spawn()
+
+    def stop(self):
+        """Close the pipe to the helper process, which kills the commands that
+        are still running and exits.
+        """
+        with self._lock:
+            proc, reader = self._proc, self._reader
+        if proc is not None:
+            try:
+                proc.stdin.close()
+            except (IOError, OSError):
+                pass
+            # The reader reaps the helper once it exits
+            reader.join()
+
+    def cancel_all(self):
+        """Terminate all the commands that are running, which makes them
+        return a result that is cancelled.
+        """
+        with self._lock:
+            if self._proc is None or not self._pending:
+                return
+            try:
+                self._send({'cancel': list(self._pending)})
+            except BastioCommandError as ex:
+                self._logger.warning(ex.message)
+
+    def run(self, argv, input_data=None, timeout=None):
+        """Run a command and wait for it to exit.
+
+        :param argv:
+            The program to run and its arguments, the program is looked up in
+            ``PATH``.
+        :type argv:
+            list
+        :param input_data:
+            The data to write to the standard input of the command.
+        :type input_data:
+            str
+        :param timeout:
+            The number of seconds the command may run, ``command_timeout`` by
+            default.
+        :type timeout:
+            float
+        :returns:
+            :class:`CommandResult`
+        :raises:
+            :class:`bastio.excepts.BastioCommandError`
+        """
+        started = time.time()
+        timeout = timeout or self._timeout
+        entry = [threading.Event(), None]
+        with self._lock:
+            if self._proc is None:
+                self._spawn()
+            cid = next(self._ids)
+            request = {'id': cid, 'argv': [_to_wire(x) for x in argv],
+                    'timeout': timeout, 'grace': self._grace, 'limit': self._limit}
+            if input_data is not None:
+                request['input'] = _to_wire(input_data)
+            self._send(request)
+            self._pending[cid] = entry
+        # The helper enforces the deadline, this only guards against the
+        # helper itself being stuck
+        if not entry[0].wait(timeout + self._grace + 5.0):
+            with self._lock:
+                self._pending.pop(cid, None)
+            raise BastioCommandError("the command helper did not report on `{}`".format(
+                argv[0]))
+        result = entry[1]
+        if isinstance(result, Exception):
+            raise result
+        self._latency.add(time.time() - started)
+        if result.timed_out:
+            self._timeouts.inc()
+            self._logger.warning("command `{}` timed out after {} seconds".format(
+                argv[0], timeout))
+        return result
+
+    def _send(self, request):
+        try:
+            self._proc.stdin.write(_Framer.compose(request))
+            self._proc.stdin.flush()
+        except (IOError, OSError) as ex:
+            raise BastioCommandError(
+                    "unable to send a command to the helper: {}".format(ex.strerror))
+
+    def _spawn(self):
+        # Make sure the helper imports this very package
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+                [root] + filter(None, [env.get('PYTHONPATH')]))
+        try:
+            proc = subprocess.Popen([sys.executable, '-m', 'bastio.command'],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True,
+                    env=env)
+        except OSError as ex:
+            raise BastioCommandError("unable to start the command helper: {}".format(
+                ex.strerror))
+        self._proc = proc
+        self._spawns.inc()
+        self._reader = threading.Thread(target=self.__reader, args=(proc,))
+        self._reader.setDaemon(True)
+        self._reader.start()
+
+    def __reader(self, proc):
+        framer = _Framer(proc.stdout.fileno())
+        try:
+            while True:
+                response = framer.read()
+                if response is None:
+                    break
+                with self._lock:
+                    entry = self._pending.pop(response['id'], None)
+                if entry is None:
+                    continue
+                if 'error' in response:
+                    entry[1] = BastioCommandError(response['error'])
+                else:
+                    entry[1] = CommandResult(response['code'],
+                            _from_wire(response['stdout']),
+                            _from_wire(response['stderr']), response['timed_out'],
+                            response['cancelled'], response['truncated'])
+                entry[0].set()
+        except Exception:
+            self._logger.critical("unable to read from the command helper",
+                    exc_info=True)
+        with self._lock:
+            if self._proc is proc:
+                self._proc = None
+            pending, self._pending = self._pending, {}
+        for entry in pending.itervalues():
+            entry[1] = BastioCommandError("the command helper exited")
+            entry[0].set()
+        proc.stdout.close()
+        proc.wait()
+
+@public
+class GlobalCommandHelper(CommandHelper):
+    """A singleton of :class:`bastio.command.CommandHelper`."""
+    __metaclass__ = KindSingletonMeta
+
+class _Job(object):
+    """A command run by the helper process."""
+
+    def __init__(self, cid, argv, input_data, timeout, grace, limit):
+        self.id = cid
+        self.proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True,
+                preexec_fn=self._child_setup)
+        self.stdout = []
+        self.stderr = []
+        self.output = {self.proc.stdout.fileno(): self.stdout,
+                self.proc.stderr.fileno(): self.stderr}
+        self.sizes = dict.fromkeys(self.output, 0)
+        self.limit = limit
+        self.truncated = False
+        self.readers = set(self.output)
+        self.input = input_data or ''
+        self.writers = set()
+        if self.input:
+            fd = self.proc.stdin.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) |
+                    os.O_NONBLOCK)
+            self.writers.add(fd)
+        else:
+            self.proc.stdin.close()
+        self.deadline = time.time() + timeout if timeout else None
+        self.grace = grace
+        self.kill_at = None
+        self.killed = False
+        self.timed_out = False
+        self.cancelled = False
+
+    @staticmethod
+    def _child_setup():
+        # The helper is single threaded, so running Python code between fork
+        # and exec is safe here. A session of its own lets the command and
+        # everything it spawns be signalled at once.
+        os.setsid()
+        for sig in (signal.SIGINT, signal.SIGPIPE):
+            signal.signal(sig, signal.SIG_DFL)
+
+    def read(self, fd):
+        data = os.read(fd, 65536)
+        if not data:
+            self.readers.discard(fd)
+            return
+        # Keep draining output beyond the limit so the command never blocks
+        room = self.limit - self.sizes[fd]
+        if len(data) > room:
+            data = data[:max(room, 0)]
+            self.truncated = True
+        if data:
+            self.output[fd].append(data)
+            self.sizes[fd] += len(data)
+
+    def write(self, fd):
+        try:
+            self.input = self.input[os.write(fd, self.input):]
+        except OSError as ex:
+            if ex.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            if ex.errno != errno.EPIPE:
+                raise
+            self.input = ''
+        if not self.input:
+            self.writers.discard(fd)
+            self.proc.stdin.close()
+
+    def signal(self, sig):
+        try:
+            os.killpg(self.proc.pid, sig)
+        except OSError:
+            pass
+
+    def terminate(self, now):
+        """Ask the command to terminate, and kill it if it's still running
+        once the grace period is over.
+        """
+        if self.kill_at is None:
+            self.signal(signal.SIGTERM)
+            self.kill_at = now + self.grace
+
+    def kill(self):
+        self.signal(signal.SIGKILL)
+        self.killed = True
+
+    def wakeup(self):
+        """Return the time at which :func:`_Job.tick` has to run next."""
+        if self.kill_at is None:
+            return self.deadline
+        if not self.killed:
+            return self.kill_at
+        return None
+
+    def tick(self, now):
+        if self.kill_at is None and self.deadline is not None and \
+                now >= self.deadline:
+            self.timed_out = True
+            self.terminate(now)
+        if self.kill_at is not None and not self.killed and now >= self.kill_at:
+            self.kill()
+
+    def done(self):
+        return not (self.readers or self.writers) and \
+                self.proc.poll() is not None
+
+    def response(self):
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        return {'id': self.id, 'code': self.proc.returncode,
+                'stdout': _to_wire(''.join(self.stdout)),
+                'stderr': _to_wire(''.join(self.stderr)),
+                'timed_out': self.timed_out, 'cancelled': self.cancelled,
+                'truncated': self.truncated}
+
+def _handle(request, jobs, wfd):
+    if 'cancel' in request:
+        now = time.time()
+        for job in jobs:
+            if job.id in request['cancel']:
+                job.cancelled = True
+                job.terminate(now)
+        return
+    try:
+        jobs.append(_Job(request['id'], [_from_wire(x) for x in request['argv']],
+            _from_wire(request.get('input', u'')), request.get('timeout'),
+            request.get('grace', 0), request.get('limit', sys.maxint)))
+    except OSError as ex:
+        _write_all(wfd, _Framer.compose({'id': request['id'],
+            'error': "unable to run `{}`: {}".format(
+                _from_wire(request['argv'][0]), ex.strerror)}))
+
+@public
+def serve(rfd, wfd):
+    """The main loop of the helper process, which reads commands from ``rfd``
+    and writes their results to ``wfd`` until ``rfd`` is closed.
+    """
+    framer = _Framer(rfd)
+    jobs = []
+    open_ = True
+    while open_ or jobs:
+        rlist = [rfd] if open_ else []
+        wlist = []
+        fds = {}
+        for job in jobs:
+            for fd in job.readers:
+                fds[fd] = job
+                rlist.append(fd)
+            for fd in job.writers:
+                fds[fd] = job
+                wlist.append(fd)
+        timeout = None
+        wakeups = filter(None, [job.wakeup() for job in jobs])
+        if wakeups:
+            timeout = max(min(wakeups) - time.time(), 0)
+        # Commands may exit after closing their output, so poll for those
+        if any(not (job.readers or job.writers) for job in jobs):
+            timeout = min(timeout, 0.01) if timeout is not None else 0.01
+        try:
+            readable, writable, _ = select.select(rlist, wlist, [], timeout)
+        except select.error as ex:
+            if ex.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in writable:
+            fds[fd].write(fd)
+        for fd in readable:
+            if fd != rfd:
+                fds[fd].read(fd)
+            elif not framer.fill():
+                open_ = False
+                # The agent is gone, do not leave its commands behind
+                for job in jobs:
+                    job.kill()
+            else:
+                while True:
+                    request = framer.next()
+                    if request is None:
+                        break
+                    _handle(request, jobs, wfd)
+        now = time.time()
+        for job in jobs[:]:
+            job.tick(now)
+            if job.done():
+                jobs.remove(job)
+                if open_:
+                    _write_all(wfd, _Framer.compose(job.response()))
+
+if __name__ == '__main__':
+    # Interrupts are for the agent, which closes the pipe once it's done
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    serve(sys.stdin.fileno(), sys.stdout.fileno())
@@ -15,6 +15,15 @@
 .. autoclass:: ThreadPool
     :members:
 
+.. autoclass:: LaneQueue
+    :members:
+
+.. autoclass:: KeyedExecutor
+    :members:
+
+.. autoclass:: GroupCommit
+    :members:
+
 .. autoclass:: GlobalThreadPool
     :inherited-members:
 """
@@ -24,13 +33,16 @@ __copyright__ = "Copyright 2013 Databracket LLC"
 __license__ = "GPLv3+"
 
 import sys
+import time
 import random
 import threading
+import collections
 import Queue as queue
 
 from bastio.mixin import KindSingletonMeta, public
 from bastio.excepts import BastioTaskError
 from bastio.configs import GlobalConfigStore
+from bastio.metrics import GlobalMetrics
 from bastio.log import Logger
 
 @public
@@ -299,3 +311,455 @@ class GlobalThreadPool(ThreadPool):
     """A singleton of :class:`bastio.concurrency.ThreadPool`."""
     __metaclass__ = KindSingletonMeta
 
+
+@public
+class LaneQueue(queue.Queue, object):
+    """A queue of a number of priority lanes. Items are always taken from the
+    lowest numbered lane that is not empty, and in FIFO order within a lane.
+
+    When a key function is given, putting an item in a lane promotes all the
+    pending items that have the same key from the lower priority lanes ahead of
+    it so that the relative order of items sharing a key never changes.
+
+    The depth of each lane and the time items wait in it are tracked by the
+    ``<name>.lane<N>.depth`` and ``<name>.lane<N>.wait`` metrics respectively.
+
+    The queue is throttled once its size reaches the high watermark and stays
+    throttled until its size drops to the low watermark, which lets producers
+    that can't block on a full queue hold off before it becomes full.
+
+    When a journal is given every item put in the queue is appended to it
+    before it becomes visible to consumers, see :class:`bastio.journal.Journal`.
+    When a ``duplicate`` callable is also given, an item whose record is
+    still in the journal (i.e., the same item is still pending) is handed to
+    it instead of being put in the queue, and the consumer is interrupted to
+    attend to it.
+
+    When a ``supersedes`` callable is also given, putting an item removes the
+    pending items of the same key it makes pointless, which are handed to the
+    ``superseded`` callable instead of ever being taken from the queue. The
+    number of such items is tracked by the ``<name>.superseded`` metric.
+
+    When a ``barrier_of`` callable is given, an item it returns True for keeps
+    its place relative to every other item: it's put in the highest priority
+    lane behind all the pending items, which are promoted ahead of it, and
+    items put after it never jump ahead of it nor supersede the items ahead
+    of it.
+
+    A consumer blocked in :func:`get` can be woken up with :func:`interrupt`
+    to attend to something other than the queue.
+
+    :param lanes:
+        The number of lanes.
+    :type lanes:
+        int
+    :param lane_of:
+        A callable that returns the lane number of an item. Items are put in the
+        last lane if it was not given.
+    :type lane_of:
+        callable
+    :param key_of:
+        An optional callable that returns the ordering key of an item.
+    :type key_of:
+        callable
+    :param name:
+        The name of the queue to prefix metrics with.
+    :type name:
+        str
+    :param maxsize:
+        See :class:`Queue.Queue`.
+    :type maxsize:
+        int
+    :param high_watermark:
+        The size at which the queue becomes throttled, the queue is never
+        throttled if it was not given.
+    :type high_watermark:
+        int
+    :param low_watermark:
+        The size at which the queue is no longer throttled.
+    :type low_watermark:
+        int
+    :param journal:
+        An optional journal to append items to.
+    :type journal:
+        :class:`bastio.journal.Journal`
+    :param record_of:
+        A callable that returns the ``(key, data)`` journal record of an item,
+        required if a journal was given.
+    :type record_of:
+        callable
+    :param supersedes:
+        A callable that takes an item being put and a pending item of the same
+        key, and returns whether the pending one is superseded.
+    :type supersedes:
+        callable
+    :param superseded:
+        A callable that takes a superseded item and the item that superseded
+        it, which is called while the queue is locked so it must not block.
+    :type superseded:
+        callable
+    :param barrier_of:
+        A callable that returns whether an item is a barrier.
+    :type barrier_of:
+        callable
+    :param duplicate:
+        A callable that takes a duplicate item, which is called while the
+        queue is locked so it must not block.
+    :type duplicate:
+        callable
+    """
+
+    def __init__(self, lanes=2, lane_of=None, key_of=None, name='queue', maxsize=0,
+            high_watermark=None, low_watermark=0, journal=None, record_of=None,
+            supersedes=None, superseded=None, barrier_of=None, duplicate=None):
+        self._nlanes = lanes
+        self._high = high_watermark
+        self._low = low_watermark
+        self._throttled = False
+        self._lane_of = lane_of if lane_of else lambda item: lanes - 1
+        self._key_of = key_of
+        self._journal = journal
+        self._record_of = record_of
+        self._supersedes = supersedes
+        self._superseded = superseded
+        self._barrier_of = barrier_of
+        self._duplicate = duplicate
+        self._interrupted = False
+        metrics = GlobalMetrics()
+        self._superseded_count = metrics.counter('{}.superseded'.format(name))
+        self._depth = [metrics.counter('{}.lane{}.depth'.format(name, x))
+                for x in range(lanes)]
+        self._wait = [metrics.stats('{}.lane{}.wait'.format(name, x))
+                for x in range(lanes)]
+        queue.Queue.__init__(self, maxsize)
+
+    def throttled(self):
+        """Check whether the queue is between its high and low watermarks."""
+        return self._throttled
+
+    def get(self, block=True, timeout=None):
+        """See :func:`Queue.Queue.get`, except that :class:`Queue.Empty` is
+        also raised if the queue is empty once the consumer is interrupted.
+        """
+        with self.not_empty:
+            if block:
+                endtime = None if timeout is None else time.time() + timeout
+                while not self._qsize() and not self._interrupted:
+                    if endtime is None:
+                        self.not_empty.wait()
+                        continue
+                    remaining = endtime - time.time()
+                    if remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+            self._interrupted = False
+            if not self._qsize():
+                raise queue.Empty
+            item = self._get()
+            self.not_full.notify()
+            return item
+
+    def interrupt(self):
+        """Wake up a consumer blocked in :func:`get`, or make the next call
+        return right away if none is.
+        """
+        with self.mutex:
+            self._interrupted = True
+            self.not_empty.notify_all()
+
+    def lane_size(self, lane):
+        """Return the approximate number of items in a lane."""
+        with self.mutex:
+            return len(self._lanes[lane])
+
+    def _init(self, maxsize):
+        self._lanes = [collections.deque() for x in range(self._nlanes)]
+
+    def _qsize(self, len=len):
+        return sum(len(lane) for lane in self._lanes)
+
+    def _put(self, item):
+        lane = max(0, min(self._lane_of(item), self._nlanes - 1))
+        key = self._key_of(item) if self._key_of else None
+        if self._journal is not None:
+            record = self._record_of(item)
+            if self._duplicate is not None and record[0] in self._journal:
+                self._duplicate(item)
+                self._interrupted = True
+                return
+            self._journal.append(*record)
+        if self._barrier_of is not None and self._barrier_of(item):
+            lane = 0
+            for lower in range(1, self._nlanes):
+                self._lanes[0].extend(self._lanes[lower])
+                self._lanes[lower] = collections.deque()
+                self._depth[lower].set(0)
+        if key is not None and self._supersedes is not None:
+            for idx in range(self._nlanes):
+                self._fold(item, key, idx)
+        if key is not None:
+            for lower in range(lane + 1, self._nlanes):
+                self._promote(key, lower, lane)
+        self._lanes[lane].append((item, key, time.time()))
+        self._depth[lane].set(len(self._lanes[lane]))
+        self._throttle()
+
+    def _get(self):
+        for idx, lane in enumerate(self._lanes):
+            if lane:
+                item, _, enqueued = lane.popleft()
+                self._wait[idx].add(time.time() - enqueued)
+                self._depth[idx].set(len(lane))
+                self._throttle()
+                return item
+
+    def _throttle(self):
+        """Update whether the queue is throttled after its size changed,
+        either way since superseded items leave the queue when one is put.
+        """
+        if not self._high:
+            return
+        size = self._qsize()
+        if size >= self._high:
+            self._throttled = True
+        elif self._throttled and size <= self._low:
+            self._throttled = False
+
+    def _fold(self, item, key, idx):
+        if not any(entry[1] == key for entry in self._lanes[idx]):
+            return
+        # Items ahead of a barrier are out of reach
+        start = 0
+        if self._barrier_of is not None:
+            for pos, entry in enumerate(self._lanes[idx]):
+                if self._barrier_of(entry[0]):
+                    start = pos + 1
+        keep = collections.deque()
+        for pos, entry in enumerate(self._lanes[idx]):
+            if pos >= start and entry[1] == key and \
+                    self._supersedes(item, entry[0]):
+                self._superseded_count.inc()
+                self._superseded(entry[0], item)
+                # There is room for one more item now
+                self.not_full.notify()
+            else:
+                keep.append(entry)
+        self._lanes[idx] = keep
+        self._depth[idx].set(len(keep))
+
+    def _promote(self, key, src, dst):
+        if not any(entry[1] == key for entry in self._lanes[src]):
+            return
+        keep = collections.deque()
+        for entry in self._lanes[src]:
+            if entry[1] == key:
+                self._lanes[dst].append(entry)
+            else:
+                keep.append(entry)
+        self._lanes[src] = keep
+        self._depth[src].set(len(keep))
+
+@public
+class KeyedExecutor(object):
+    """Run jobs on a thread pool where jobs of the same key run one after the
+    other in the order they were submitted, while jobs of different keys run
+    concurrently.
+
+    Jobs submitted as exclusive additionally go through a single global lane
+    once their turn in their key's lane comes, so no two exclusive jobs ever run
+    at the same time regardless of their keys. This suits jobs that mutate a
+    shared resource while most jobs only touch resources of their own key.
+
+    The number of keys with pending jobs and the number of exclusive jobs
+    waiting for the global lane are tracked by the ``<name>.keys`` and
+    ``<name>.exclusive.depth`` metrics respectively.
+
+    :param pool:
+        The thread pool to run jobs on, :class:`GlobalThreadPool` by default.
+    :type pool:
+        :class:`ThreadPool`
+    :param name:
+        The name of the executor to prefix metrics with.
+    :type name:
+        str
+    """
+
+    def __init__(self, pool=None, name='executor'):
+        self._pool = pool if pool is not None else GlobalThreadPool()
+        self._logger = Logger()
+        self._lock = threading.Lock()
+        self._lanes = {}
+        self._exclusive = collections.deque()
+        self._exclusive_running = False
+        metrics = GlobalMetrics()
+        self._keys = metrics.counter('{}.keys'.format(name))
+        self._exclusive_depth = metrics.counter('{}.exclusive.depth'.format(name))
+
+    def submit(self, key, target, *args, **kwargs):
+        """Submit a job to run ``target`` with ``args`` and ``kwargs``.
+
+        :param key:
+            The key of the job, or None if the job does not need to be ordered
+            with any other job.
+        :type key:
+            hashable
+        :param target:
+            The callable to run.
+        :type target:
+            callable
+        :param exclusive:
+            A keyword only argument to run the job through the global lane.
+        :type exclusive:
+            bool
+        """
+        exclusive = kwargs.pop('exclusive', False)
+        if key is None:
+            key = object() # A key of its own
+        job = (target, args, kwargs, exclusive)
+        with self._lock:
+            if key in self._lanes:
+                self._lanes[key].append(job)
+                return
+            self._lanes[key] = collections.deque([job])
+            self._keys.set(len(self._lanes))
+        self._start(key)
+
+    def pending(self, key):
+        """Return the number of jobs of ``key`` that did not complete yet."""
+        with self._lock:
+            return len(self._lanes.get(key, ()))
+
+    def _start(self, key):
+        """Start the job at the head of the lane of ``key``."""
+        with self._lock:
+            job = self._lanes[key][0]
+            if job[3]:
+                self._exclusive.append((key, job))
+                self._exclusive_depth.set(len(self._exclusive))
+                if self._exclusive_running:
+                    return
+                self._exclusive_running = True
+                task = Task(target=self.__exclusive_runner)
+            else:
+                task = Task(target=self.__runner)
+                task.args = (key, job)
+        self._pool.run(task)
+
+    def _finish(self, key):
+        """Remove the job that completed from the lane of ``key`` and start the
+        next one if any.
+        """
+        with self._lock:
+            lane = self._lanes[key]
+            lane.popleft()
+            if not lane:
+                del self._lanes[key]
+                self._keys.set(len(self._lanes))
+                return
+        self._start(key)
+
+    def _run(self, job):
+        target, args, kwargs, _ = job
+        try:
+            target(*args, **kwargs)
+        except Exception:
+            self._logger.critical("unexpected error occurred running a job",
+                    exc_info=True)
+
+    def __runner(self, key, job):
+        try:
+            self._run(job)
+        finally:
+            self._finish(key)
+
+    def __exclusive_runner(self):
+        while True:
+            with self._lock:
+                if not self._exclusive:
+                    self._exclusive_running = False
+                    return
+                key, job = self._exclusive.popleft()
+                self._exclusive_depth.set(len(self._exclusive))
+            try:
+                self._run(job)
+            finally:
+                self._finish(key)
+
+@public
+class GroupCommit(object):
+    """Group items submitted concurrently by many threads into batches that
+    are applied at once, which amortizes expensive operations such as
+    rewriting a file over all the items of a batch.
+
+    The first thread to submit an item while no batch is being applied leads;
+    it waits ``delay`` seconds for other threads to join and then applies
+    batches of at most ``max_batch`` items until no items are pending, while
+    the other threads wait for the result of their own item. The size of every
+    batch is tracked by the ``<name>.size`` metric.
+
+    :param apply:
+        A callable that takes a list of items and returns a list of their
+        results in the same order, where a result that is an exception is
+        raised to the thread that submitted the item. An exception raised by
+        ``apply`` itself is raised to every thread of the batch.
+    :type apply:
+        callable
+    :param max_batch:
+        The maximum number of items of a batch.
+    :type max_batch:
+        int
+    :param delay:
+        The number of seconds the leader waits for other items.
+    :type delay:
+        float
+    :param name:
+        The name of the batcher to prefix metrics with.
+    :type name:
+        str
+    """
+
+    def __init__(self, apply, max_batch=64, delay=0.005, name='batch'):
+        self._apply = apply
+        self._max_batch = max_batch
+        self._delay = delay
+        self._lock = threading.Lock()
+        self._pending = []
+        self._leading = False
+        self._size = GlobalMetrics().stats('{}.size'.format(name))
+
+    def submit(self, item):
+        """Submit an item and wait until the batch it's part of is applied.
+
+        :returns:
+            The result of the item.
+        """
+        entry = [item, threading.Event(), None]
+        with self._lock:
+            self._pending.append(entry)
+            lead = not self._leading
+            self._leading = True
+        if lead:
+            if self._delay:
+                time.sleep(self._delay)
+            self.__lead()
+        entry[1].wait()
+        if isinstance(entry[2], Exception):
+            raise entry[2]
+        return entry[2]
+
+    def __lead(self):
+        while True:
+            with self._lock:
+                batch = self._pending[:self._max_batch]
+                del self._pending[:self._max_batch]
+                if not batch:
+                    self._leading = False
+                    return
+            self._size.add(len(batch))
+            try:
+                results = self._apply([entry[0] for entry in batch])
+            except Exception as ex:
+                results = [ex] * len(batch)
+            for entry, result in zip(batch, results):
+                entry[2] = result
+                entry[1].set()
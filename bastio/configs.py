@@ -156,6 +156,43 @@ class GlobalConfigStore(defaultdict):
         """
         self[attr] = value
 
+    def lookup(self, option, default, cast=str):
+        """Look up an option in the in-memory store and then in the configuration
+        file under the default section, falling back to ``default`` if it was set
+        in neither. Once found the value is cast and set in the memory store.
+
+        :param option:
+            The option name.
+        :type option:
+            str
+        :param default:
+            The value to return if the option was not set.
+        :type default:
+            object
+        :param cast:
+            A callable to convert the value found with (e.g., ``int``, ``float``
+            or ``bool``).
+        :type cast:
+            callable
+        :returns:
+            The option's value or ``default``.
+        :raises:
+            :class:`bastio.excepts.BastioConfigError`
+        """
+        value = self.get(option)
+        if value is None or value == '':
+            if not (self._config and self._config.has_option(self._section, option)):
+                return default
+            value = self._config.get(self._section, option)
+        if cast is bool and isinstance(value, basestring):
+            value = value.strip().lower() in ('1', 'yes', 'true', 'on')
+        try:
+            self[option] = cast(value)
+        except (TypeError, ValueError):
+            reraise(BastioConfigError, 'option `{}` has an invalid value `{}`'.format(
+                option, value))
+        return self[option]
+
     def load(self, filename):
         """Load a configuration file using :class:`ConfigParser` into memory.
 
@@ -27,6 +27,16 @@
 .. autoexception:: BastioBackendError
 
 .. autoexception:: BastioAccountError
+
+.. autoexception:: BastioJournalError
+
+.. autoexception:: BastioLockError
+
+.. autoexception:: BastioProvisionError
+
+.. autoexception:: BastioCommandError
+
+.. autoexception:: BastioAuthKeysError
 """
 
 __author__ = "Amr Ali"
@@ -106,3 +116,28 @@ class BastioAccountError(BastioException):
     """An account operation error"""
     pass
 
+
+@public
+class BastioJournalError(BastioException):
+    """A journal operation error"""
+    pass
+
+@public
+class BastioLockError(BastioException):
+    """A file lock operation error"""
+    pass
+
+@public
+class BastioProvisionError(BastioException):
+    """An account provisioning operation error"""
+    pass
+
+@public
+class BastioCommandError(BastioException):
+    """A command execution error"""
+    pass
+
+@public
+class BastioAuthKeysError(BastioException):
+    """An authorized_keys operation error"""
+    pass
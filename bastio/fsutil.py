@@ -0,0 +1,554 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.fsutil
+:synopsis: File system utilities for safe concurrent file updates.
+:author: Amr Ali <amr@databracket.com>
+
+.. autofunction:: atomic_write
+
+.. autoclass:: FileLock
+    :members:
+
+.. autoclass:: LinkLock
+    :members:
+
+.. autoclass:: DirectoryLock
+    :members:
+
+.. autoclass:: Trash
+    :members:
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import stat
+import time
+import errno
+import fcntl
+import ctypes
+import random
+import platform
+import tempfile
+import threading
+import contextlib
+
+from bastio.log import Logger
+from bastio.mixin import public
+from bastio.metrics import GlobalMetrics
+from bastio.concurrency import GlobalThreadPool, Task
+from bastio.excepts import BastioLockError
+
+@public
+def atomic_write(path, data, mode=0644, owner=None):
+    """Replace the content of a file atomically by writing ``data`` to a
+    temporary file in the same directory, flushing it to disk and renaming it
+    over ``path``. The permissions and ownership of the file are kept if it
+    already exists as a regular file, otherwise it is created with ``mode``
+    and ``owner``. A symbolic link at ``path`` is replaced, not followed.
+
+    :param path:
+        The path of the file to write.
+    :type path:
+        str
+    :param data:
+        The new content of the file.
+    :type data:
+        str
+    :param mode:
+        The permissions of the file if it does not exist.
+    :type mode:
+        int
+    :param owner:
+        The ``(uid, gid)`` of the file if it does not exist.
+    :type owner:
+        tuple
+    :returns:
+        The :func:`os.stat` result of the new file.
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    try:
+        st = os.lstat(path)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+        st = None
+    if st and not stat.S_ISREG(st.st_mode):
+        st = None
+    fd, tmp_path = tempfile.mkstemp(prefix='.{}.'.format(basename), dir=dirname)
+    try:
+        if st:
+            os.fchmod(fd, st.st_mode & 07777)
+            if (st.st_uid, st.st_gid) != (os.geteuid(), os.getegid()):
+                os.fchown(fd, st.st_uid, st.st_gid)
+        else:
+            os.fchmod(fd, mode)
+            if owner is not None:
+                os.fchown(fd, owner[0], owner[1])
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+        new_st = os.fstat(fd)
+        os.close(fd)
+        fd = None
+        os.rename(tmp_path, path)
+    except Exception:
+        if fd is not None:
+            os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    # Make the rename itself durable
+    sync_dir(dirname)
+    return new_st
+
+@public
+def sync_dir(path):
+    """Flush a directory to disk, which makes the entries that were created,
+    renamed or removed in it durable.
+
+    :param path:
+        The path of the directory.
+    :type path:
+        str
+    """
+    dirfd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+@public
+def preallocate(fd, offset, length):
+    """Allocate disk space for a range of a file by writing zeros to it, so
+    that writing to the range through a memory map never fails. A sparse
+    range, as :func:`os.ftruncate` leaves it, is only allocated once it is
+    written to, and a memory-mapped write that finds the disk full kills the
+    process with ``SIGBUS`` rather than raising an error.
+
+    :param fd:
+        An open file descriptor of the file.
+    :type fd:
+        int
+    :param offset:
+        The offset of the range.
+    :type offset:
+        int
+    :param length:
+        The length of the range.
+    :type length:
+        int
+    :raises:
+        :class:`OSError`
+    """
+    zeros = '\0' * min(length, 65536)
+    os.lseek(fd, offset, os.SEEK_SET)
+    while length > 0:
+        length -= os.write(fd, zeros[:length])
+    os.fsync(fd)
+
+@public
+class FileLock(object):
+    """An exclusive POSIX record lock on a whole file, which is the kind of lock
+    taken by ``lckpwdf(3)`` on ``/etc/.pwd.lock``. The file is created if it
+    does not exist. Use it as a context manager.
+
+    :param path:
+        The path of the lock file.
+    :type path:
+        str
+    :param timeout:
+        The number of seconds to wait for the lock.
+    :type timeout:
+        float
+    """
+
+    def __init__(self, path, timeout=15.0):
+        self._path = path
+        self._timeout = timeout
+        self._fd = None
+
+    def acquire(self):
+        """Acquire the lock.
+
+        :raises:
+            :class:`bastio.excepts.BastioLockError`
+        """
+        try:
+            fd = os.open(self._path, os.O_WRONLY | os.O_CREAT, 0600)
+        except OSError as ex:
+            raise BastioLockError("unable to open lock file `{}`: {}".format(
+                self._path, ex.strerror))
+        deadline = time.time() + self._timeout
+        while True:
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError as ex:
+                if ex.errno not in (errno.EACCES, errno.EAGAIN):
+                    os.close(fd)
+                    raise BastioLockError("unable to lock `{}`: {}".format(
+                        self._path, ex.strerror))
+            if time.time() > deadline:
+                os.close(fd)
+                raise BastioLockError("timed out waiting for lock `{}`".format(
+                    self._path))
+            time.sleep(0.01)
+        self._fd = fd
+
+    def release(self):
+        """Release the lock."""
+        if self._fd is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+@public
+class LinkLock(object):
+    """A ``<path>.lock`` lock file created atomically with a hard link and
+    holding the PID of its owner, which is the kind of lock taken by the shadow
+    utilities (e.g., ``useradd``) on every database file they change. A lock
+    left behind by a process that no longer exists is broken. Use it as a
+    context manager.
+
+    :param path:
+        The path of the file to lock.
+    :type path:
+        str
+    :param timeout:
+        The number of seconds to wait for the lock.
+    :type timeout:
+        float
+    """
+
+    def __init__(self, path, timeout=15.0):
+        self._lock_path = path + '.lock'
+        self._tmp_path = '{}.{}'.format(path, os.getpid())
+        self._timeout = timeout
+        self._locked = False
+
+    def acquire(self):
+        """Acquire the lock.
+
+        :raises:
+            :class:`bastio.excepts.BastioLockError`
+        """
+        try:
+            with open(self._tmp_path, 'wb') as fd:
+                fd.write(str(os.getpid()))
+        except IOError as ex:
+            raise BastioLockError("unable to create lock file `{}`: {}".format(
+                self._tmp_path, ex.strerror))
+        deadline = time.time() + self._timeout
+        try:
+            while True:
+                try:
+                    os.link(self._tmp_path, self._lock_path)
+                    break
+                except OSError as ex:
+                    if ex.errno != errno.EEXIST:
+                        raise BastioLockError("unable to lock `{}`: {}".format(
+                            self._lock_path, ex.strerror))
+                if self._break_stale():
+                    continue
+                if time.time() > deadline:
+                    raise BastioLockError("timed out waiting for lock `{}`".format(
+                        self._lock_path))
+                time.sleep(0.01)
+        finally:
+            os.unlink(self._tmp_path)
+        self._locked = True
+
+    def release(self):
+        """Release the lock."""
+        if self._locked:
+            os.unlink(self._lock_path)
+            self._locked = False
+
+    def _break_stale(self):
+        """Remove the lock file if its owner is dead and return whether it
+        was removed.
+        """
+        try:
+            with open(self._lock_path, 'rb') as fd:
+                pid = int(fd.read(32).strip())
+        except (IOError, ValueError):
+            return False
+        try:
+            os.kill(pid, 0)
+            return False
+        except OSError as ex:
+            if ex.errno != errno.ESRCH:
+                return False
+        try:
+            os.unlink(self._lock_path)
+        except OSError:
+            pass
+        return True
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+@public
+class DirectoryLock(object):
+    """An exclusive ``flock(2)`` lock on a directory, which needs no lock file
+    to be created in it. The directory is opened without following symbolic
+    links, and its entries should be reached through :func:`entry` while the
+    lock is held so that they are in the directory that was locked even if
+    its path is changed to point elsewhere. Use it as a context manager.
+
+    :param path:
+        The path of the directory.
+    :type path:
+        str
+    :param timeout:
+        The number of seconds to wait for the lock.
+    :type timeout:
+        float
+    """
+
+    def __init__(self, path, timeout=15.0):
+        self._path = path
+        self._timeout = timeout
+        self._fd = None
+
+    def acquire(self):
+        """Acquire the lock.
+
+        :raises:
+            :class:`bastio.excepts.BastioLockError`
+        """
+        try:
+            fd = os.open(self._path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+        except OSError as ex:
+            raise BastioLockError("unable to open directory `{}`: {}".format(
+                self._path, ex.strerror))
+        deadline = time.time() + self._timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError as ex:
+                if ex.errno not in (errno.EACCES, errno.EAGAIN):
+                    os.close(fd)
+                    raise BastioLockError("unable to lock `{}`: {}".format(
+                        self._path, ex.strerror))
+            if time.time() > deadline:
+                os.close(fd)
+                raise BastioLockError("timed out waiting for lock `{}`".format(
+                    self._path))
+            time.sleep(0.01)
+        self._fd = fd
+
+    def entry(self, name):
+        """Return a path to the entry ``name`` of the locked directory that is
+        resolved through the open directory rather than through its path.
+        """
+        return '/proc/self/fd/{}/{}'.format(self._fd, name)
+
+    def release(self):
+        """Release the lock."""
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+# ioprio_get(2) and ioprio_set(2) system call numbers by machine
+_IOPRIO_SYSCALLS = {
+        'x86_64': (252, 251),
+        'i386': (290, 289),
+        'i686': (290, 289),
+        'aarch64': (31, 30),
+        'armv7l': (315, 314),
+        }
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_IDLE = 3
+_IOPRIO_CLASS_SHIFT = 13
+
+@contextlib.contextmanager
+def _idle_io():
+    """A context manager that runs the calling thread in the idle I/O
+    scheduling class, see ``ioprio_set(2)``, and restores its class after.
+    It does nothing where the system calls are not known.
+    """
+    calls = _IOPRIO_SYSCALLS.get(platform.machine())
+    libc = ctypes.CDLL(None, use_errno=True) if calls else None
+    old = libc.syscall(calls[0], _IOPRIO_WHO_PROCESS, 0) if libc else -1
+    if old >= 0:
+        libc.syscall(calls[1], _IOPRIO_WHO_PROCESS, 0,
+                _IOPRIO_CLASS_IDLE << _IOPRIO_CLASS_SHIFT)
+    try:
+        yield
+    finally:
+        if old >= 0:
+            libc.syscall(calls[1], _IOPRIO_WHO_PROCESS, 0, old)
+
+@public
+class Trash(object):
+    """Directories and files that are deleted in the background. A path is put
+    in the trash by renaming it into a ``.bastio-trash`` directory next to it,
+    which is atomic and instant regardless of its size, and a task on the
+    thread pool deletes the trash in the idle I/O scheduling class while
+    pausing ``pause`` seconds after every ``batch`` files so that it never
+    competes with other I/O. Trash left behind by an earlier run is deleted
+    once its parent directory is watched.
+
+    The number of entries waiting in the trash and the number of files and
+    bytes deleted are tracked by the ``trash.pending``, ``trash.files`` and
+    ``trash.bytes`` metrics respectively.
+
+    :param batch:
+        The number of files deleted between pauses.
+    :type batch:
+        int
+    :param pause:
+        The number of seconds to pause for.
+    :type pause:
+        float
+    """
+    DirName = '.bastio-trash'
+    Batch = 256
+    Pause = 0.05
+    Interval = 1.0
+
+    def __init__(self, batch=Batch, pause=Pause):
+        self._batch = batch
+        self._pause = pause
+        self._logger = Logger()
+        self._lock = threading.Lock()
+        self._dirs = set()
+        self._wake = threading.Event()
+        self._task = None
+        metrics = GlobalMetrics()
+        self._pending = metrics.counter('trash.pending')
+        self._files = metrics.counter('trash.files')
+        self._bytes = metrics.counter('trash.bytes')
+
+    def watch(self, parent):
+        """Delete the trash of a directory in the background, including trash
+        left behind by an earlier run.
+        """
+        with self._lock:
+            self._dirs.add(os.path.join(parent, self.DirName))
+        self._wake.set()
+
+    def put(self, path):
+        """Put a path in the trash of its parent directory.
+
+        :param path:
+            The path to delete.
+        :type path:
+            str
+        :returns:
+            Whether the path existed.
+        :raises:
+            :class:`OSError`
+        """
+        parent, name = os.path.split(os.path.abspath(path))
+        trash = os.path.join(parent, self.DirName)
+        try:
+            os.mkdir(trash, 0700)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        try:
+            os.rename(path, os.path.join(trash, '{}.{:016x}'.format(name,
+                random.getrandbits(64))))
+        except OSError as ex:
+            if ex.errno == errno.ENOENT:
+                return False
+            raise
+        self._pending.inc()
+        self.watch(parent)
+        return True
+
+    def start(self):
+        """Start deleting the trash on the thread pool."""
+        self._task = GlobalThreadPool().run(Task(target=self.__reap,
+            infinite=True))
+
+    def stop(self):
+        """Stop deleting the trash, what is left is deleted by the next run."""
+        if self._task:
+            self._task.stop()
+            self._wake.set()
+
+    def empty(self, kill_ev=None):
+        """Delete the trash of all the watched directories.
+
+        :param kill_ev:
+            An event that stops the deletion once set.
+        :type kill_ev:
+            :class:`threading.Event`
+        """
+        with self._lock:
+            dirs = list(self._dirs)
+        with _idle_io():
+            for trash in dirs:
+                try:
+                    entries = os.listdir(trash)
+                except OSError:
+                    continue
+                for name in entries:
+                    if kill_ev is not None and kill_ev.is_set():
+                        return
+                    try:
+                        self._delete(os.path.join(trash, name), kill_ev)
+                    except OSError as ex:
+                        self._logger.warning("unable to delete `{}`: {}".format(
+                            os.path.join(trash, name), ex.strerror))
+                        continue
+                    if self._pending.value > 0:
+                        self._pending.dec()
+
+    def _delete(self, path, kill_ev):
+        count = 0
+        if os.path.isdir(path) and not os.path.islink(path):
+            for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+                for name in filenames + dirnames:
+                    if kill_ev is not None and kill_ev.is_set():
+                        return
+                    self._unlink(os.path.join(dirpath, name))
+                    count += 1
+                    if count % self._batch == 0:
+                        time.sleep(self._pause)
+            os.rmdir(path)
+        else:
+            self._unlink(path)
+
+    def _unlink(self, path):
+        st = os.lstat(path)
+        if stat.S_ISDIR(st.st_mode):
+            os.rmdir(path)
+        else:
+            os.unlink(path)
+            self._bytes.inc(st.st_size)
+        self._files.inc()
+
+    def __reap(self, kill_ev):
+        self._wake.wait(self.Interval)
+        self._wake.clear()
+        if not kill_ev.is_set():
+            self.empty(kill_ev)
@@ -0,0 +1,368 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.journal
+:synopsis: A durable append-only journal of keyed records.
+:author: Amr Ali <amr@databracket.com>
+
+.. autoclass:: Journal
+    :members:
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import json
+import mmap
+import threading
+import collections
+
+from bastio.log import Logger
+from bastio.mixin import public
+from bastio.configs import GlobalConfigStore
+from bastio.concurrency import GlobalThreadPool, Task
+from bastio.fsutil import preallocate, sync_dir
+from bastio.excepts import BastioJournalError, reraise
+
+@public
+class Journal(object):
+    """An append-only journal of keyed records kept in a memory-mapped file.
+
+    Appending a record or acknowledging one is a memory copy into the mapped
+    file, so it survives a crash of the agent right away. Records are flushed
+    to disk in groups every ``commit_interval`` seconds by a commit task (see
+    :func:`Journal.start`) or whenever :func:`Journal.sync` is called.
+
+    Acknowledged records are dropped when the journal is compacted, which
+    happens when it runs out of room or when more than half of it is taken by
+    acknowledged records. The file is grown if compaction does not free enough
+    room. The space of the file is allocated before it is mapped (see
+    :func:`bastio.fsutil.preallocate`), so a compaction that fails (e.g., the
+    disk is full) leaves the journal as it was and is logged instead of
+    failing the append; records that did not fit are kept in memory until a
+    later compaction writes them.
+
+    Every record is framed as a Netstring containing a JSON list, either
+    ``["+", key, data]`` for an append or ``["-", key]`` for an acknowledgement.
+    A zero byte marks the end of the journal.
+
+    :param path:
+        The path of the journal file.
+    :type path:
+        str
+    :param size:
+        The initial size of the journal file in KiB.
+    :type size:
+        int
+    :param commit_interval:
+        The number of seconds between group commits.
+    :type commit_interval:
+        float
+    """
+    StateDir = '/var/lib/bastio'
+    Size = 1024
+    CommitInterval = 0.05
+
+    def __init__(self, path, size=Size, commit_interval=CommitInterval):
+        self._path = path
+        self._size = size * 1024
+        self._commit_interval = commit_interval
+        self._logger = Logger()
+        self._lock = threading.Lock()
+        self._live = collections.OrderedDict()
+        self._offset = 0
+        self._dead = 0
+        self._dirty = False
+        # Whether records or acknowledgements did not fit in the file
+        self._unwritten = False
+        self._compact_failed = False
+        self._commit_task = None
+        self._map = None
+        self._open()
+
+    @classmethod
+    def open(cls, name):
+        """Open the journal ``name`` in the agent's state directory, creating
+        the directory if it does not exist. The ``state_dir``, ``journal_size``
+        and ``journal_commit_interval`` options are used for the journal.
+
+        :param name:
+            The file name of the journal.
+        :type name:
+            str
+        :returns:
+            :class:`Journal`
+        :raises:
+            :class:`bastio.excepts.BastioJournalError`
+        """
+        cfg = GlobalConfigStore()
+        state_dir = cfg.lookup('state_dir', cls.StateDir)
+        try:
+            if not os.path.isdir(state_dir):
+                os.makedirs(state_dir, 0700)
+        except OSError as ex:
+            reraise(BastioJournalError, "unable to create state directory `{}`: {}".format(
+                state_dir, ex.strerror))
+        return cls(os.path.join(state_dir, name),
+                size=cfg.lookup('journal_size', cls.Size, int),
+                commit_interval=cfg.lookup('journal_commit_interval',
+                    cls.CommitInterval, float))
+
+    def __len__(self):
+        return len(self._live)
+
+    def __contains__(self, key):
+        return key in self._live
+
+    def append(self, key, data):
+        """Append a record to the journal. Appending a key that is already in
+        the journal and was not acknowledged is a no-op.
+
+        :param key:
+            The unique key of the record.
+        :type key:
+            str
+        :param data:
+            The record's data.
+        :type data:
+            str
+        """
+        with self._lock:
+            if key in self._live:
+                return
+            record = self._frame(['+', key, data])
+            off = self._write(record)
+            # A record that did not fit keeps its data instead of its length
+            self._live[key] = (off, len(record) if off is not None else data)
+
+    def ack(self, key):
+        """Acknowledge a record so that it is not replayed anymore.
+
+        :param key:
+            The key of the record.
+        :type key:
+            str
+        """
+        with self._lock:
+            if key not in self._live:
+                return
+            off, length = self._live.pop(key)
+            if off is None:
+                return
+            record = self._frame(['-', key])
+            self._write(record)
+            self._dead += length + len(record)
+
+    def replay(self):
+        """Return the records that were not acknowledged in the order they were
+        appended.
+
+        :returns:
+            A list of ``(key, data)`` tuples.
+        """
+        with self._lock:
+            return [(key, self._data(off, length))
+                    for key, (off, length) in self._live.iteritems()]
+
+    def sync(self):
+        """Flush the journal to disk and compact it if it is mostly made of
+        acknowledged records or if some records did not fit in it.
+        """
+        with self._lock:
+            if self._unwritten or self._dead > max(self._offset / 2, 4096):
+                self._try_compact()
+            if self._dirty:
+                self._map.flush()
+                self._dirty = False
+
+    def start(self):
+        """Start the group commit task."""
+        if not self._commit_task:
+            t = Task(target=self.__committer, infinite=True)
+            t.failure = self.__catch_fail
+            self._commit_task = GlobalThreadPool().run(t)
+
+    def stop(self):
+        """Stop the group commit task and flush the journal. The journal can
+        still be appended to afterwards.
+        """
+        if self._commit_task:
+            self._commit_task.stop()
+            self._commit_task = None
+        self.sync()
+
+    def close(self):
+        """Stop the group commit task, flush the journal and close it."""
+        self.stop()
+        with self._lock:
+            self._map.close()
+
+    def __committer(self, kill_ev):
+        kill_ev.wait(self._commit_interval)
+        self.sync()
+
+    def __catch_fail(self, failure):
+        try:
+            raise failure.exception, failure.message, failure.traceback
+        except Exception:
+            self._logger.critical("unexpected error occurred committing journal `{}`".format(
+                self._path), exc_info=True)
+
+    def _open(self):
+        try:
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0600)
+            try:
+                size = os.fstat(fd).st_size
+                if size < self._size:
+                    preallocate(fd, size, self._size - size)
+                    if not size:
+                        # Make the creation of the file durable
+                        sync_dir(os.path.dirname(os.path.abspath(self._path)))
+                    size = self._size
+                self._map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        except (OSError, IOError, mmap.error) as ex:
+            reraise(BastioJournalError, "unable to open journal `{}`: {}".format(
+                self._path, ex.strerror or ex.message))
+        self._load()
+
+    def _load(self):
+        """Rebuild the live records from the journal file."""
+        off = 0
+        while True:
+            try:
+                record = self._read(off)
+            except ValueError:
+                break
+            if record is None:
+                break
+            length, op, key = record[0], record[1][0], record[1][1]
+            if op == '+':
+                self._live[key] = (off, length)
+            elif key in self._live:
+                self._dead += self._live.pop(key)[1] + length
+            off += length
+        if self._map[off:off + 1] not in ('\0', ''):
+            self._logger.critical("discarding a torn record at the end of journal `{}`".format(
+                self._path))
+            self._map[off:] = '\0' * (len(self._map) - off)
+        self._offset = off
+
+    def _read(self, off, length=None):
+        """Read the record at ``off`` and return its length and content, or None
+        if it's the end of the journal. If ``length`` is given the content of an
+        append record is returned as a list instead.
+        """
+        if length is not None:
+            _, record = self._read(off)
+            return record
+        if self._map[off:off + 1] in ('\0', ''):
+            return None
+        delim = self._map.find(':', off, off + 16)
+        if delim < 0:
+            raise ValueError("record length delimiter is missing")
+        size = int(self._map[off:delim])
+        end = delim + 1 + size
+        if self._map[end:end + 1] != ',':
+            raise ValueError("record terminator is missing")
+        return end + 1 - off, json.loads(self._map[delim + 1:end])
+
+    def _data(self, off, length):
+        """Return the data of a live record."""
+        if off is None:
+            return length
+        return self._read(off, length)[2]
+
+    def _write(self, record):
+        """Write a record at the end of the journal and return its offset, or
+        None if it did not fit.
+        """
+        if self._offset + len(record) >= len(self._map) and \
+                not self._try_compact(len(record)):
+            self._unwritten = True
+            return None
+        off = self._offset
+        self._map[off:off + len(record)] = record
+        self._offset += len(record)
+        self._dirty = True
+        return off
+
+    def _try_compact(self, reserve=0):
+        """Compact the journal and return whether it succeeded. A failure is
+        logged once until a compaction succeeds again.
+        """
+        try:
+            self._compact(reserve)
+        except BastioJournalError as ex:
+            if not self._compact_failed:
+                self._logger.error(ex.message)
+            self._compact_failed = True
+            return False
+        if self._compact_failed:
+            self._logger.warning("journal `{}` was compacted".format(self._path))
+        self._compact_failed = False
+        return True
+
+    def _compact(self, reserve=0):
+        """Rewrite the live records to a new journal file and swap it in place
+        of the current one, growing it if needed to make room for ``reserve``
+        more bytes. The journal is left as it was if it fails.
+
+        :raises:
+            :class:`bastio.excepts.BastioJournalError`
+        """
+        records = [self._frame(['+', key, self._data(off, length)])
+                for key, (off, length) in self._live.iteritems()]
+        used = sum(len(r) for r in records)
+        size = max(len(self._map), self._size)
+        # Keep at least half of the journal free after compaction
+        while (used + reserve) * 2 > size:
+            size *= 2
+        tmp_path = self._path + '.compact'
+        new_map = None
+        try:
+            fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0600)
+            try:
+                preallocate(fd, 0, size)
+                new_map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            live = collections.OrderedDict()
+            off = 0
+            for key, record in zip(self._live.iterkeys(), records):
+                new_map[off:off + len(record)] = record
+                live[key] = (off, len(record))
+                off += len(record)
+            new_map.flush()
+            os.rename(tmp_path, self._path)
+        except (OSError, IOError, mmap.error) as ex:
+            if new_map is not None:
+                new_map.close()
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            reraise(BastioJournalError, "unable to compact journal `{}`: {}".format(
+                self._path, ex.strerror or ex.message))
+        self._map.close()
+        self._map = new_map
+        self._live = live
+        self._offset = off
+        self._dead = 0
+        self._dirty = False
+        self._unwritten = False
+        try:
+            # Make the swap itself durable
+            sync_dir(os.path.dirname(os.path.abspath(self._path)))
+        except OSError as ex:
+            self._logger.error("unable to flush the directory of journal `{}`: {}".format(
+                self._path, ex.strerror))
+
+    @staticmethod
+    def _frame(record):
+        data = json.dumps(record, separators=(',', ':'))
+        return '{}:{},'.format(len(data), data)
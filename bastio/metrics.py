@@ -0,0 +1,191 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.metrics
+:synopsis: Runtime counters and statistics of the agent.
+:author: Amr Ali <amr@databracket.com>
+
+.. autoclass:: Counter
+    :members:
+
+.. autoclass:: RollingStats
+    :members:
+
+.. autoclass:: Metrics
+    :members:
+
+.. autoclass:: GlobalMetrics
+    :inherited-members:
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import threading
+import collections
+
+from bastio.mixin import KindSingletonMeta, public
+
+@public
+class Counter(object):
+    """A thread-safe counter. It can also be used as a gauge by setting its
+    value directly.
+    """
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, num=1):
+        """Increment the counter by ``num``."""
+        with self._lock:
+            self._value += num
+
+    def dec(self, num=1):
+        """Decrement the counter by ``num``."""
+        with self._lock:
+            self._value -= num
+
+    def set(self, value):
+        """Set the counter to ``value``."""
+        with self._lock:
+            self._value = value
+
+    @property
+    def value(self):
+        return self._value
+
+@public
+class RollingStats(object):
+    """Keep an exponentially weighted moving average of all the samples
+    recorded and a sliding window of the most recent ones to compute
+    percentiles from.
+
+    :param window:
+        The number of most recent samples to keep for percentiles.
+    :type window:
+        int
+    :param alpha:
+        The weight of a new sample in the moving average.
+    :type alpha:
+        float
+    """
+
+    def __init__(self, window=256, alpha=0.125):
+        self._alpha = alpha
+        self._samples = collections.deque(maxlen=window)
+        self._average = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def add(self, sample):
+        """Record a new sample."""
+        with self._lock:
+            self._samples.append(sample)
+            self._count += 1
+            if self._average is None:
+                self._average = float(sample)
+            else:
+                self._average += self._alpha * (sample - self._average)
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def average(self):
+        return self._average
+
+    @property
+    def last(self):
+        with self._lock:
+            return self._samples[-1] if self._samples else None
+
+    def percentile(self, pct):
+        """Return the ``pct`` percentile of the samples in the window, or None
+        if no samples were recorded yet.
+
+        :param pct:
+            A percentile between 0 and 100.
+        :type pct:
+            float
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        idx = int(round(pct / 100.0 * (len(samples) - 1)))
+        return samples[max(0, min(idx, len(samples) - 1))]
+
+    def snapshot(self):
+        """Return a dictionary of the current statistics."""
+        return dict(count=self.count, last=self.last, avg=self.average,
+                p50=self.percentile(50), p90=self.percentile(90),
+                p99=self.percentile(99))
+
+@public
+class Metrics(object):
+    """A registry of named counters and rolling statistics. Metrics are created
+    on first access so that producers don't have to declare them beforehand.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name):
+        """Return the counter registered as ``name``.
+
+        :returns:
+            :class:`Counter`
+        """
+        with self._lock:
+            if name not in self._counters:
+                self._counters[name] = Counter()
+            return self._counters[name]
+
+    def stats(self, name, **kwargs):
+        """Return the rolling statistics registered as ``name``. Keyword
+        arguments are passed to :class:`RollingStats` on creation.
+
+        :returns:
+            :class:`RollingStats`
+        """
+        with self._lock:
+            if name not in self._stats:
+                self._stats[name] = RollingStats(**kwargs)
+            return self._stats[name]
+
+    def snapshot(self):
+        """Return a dictionary of all metrics and their current values."""
+        with self._lock:
+            counters = self._counters.items()
+            stats = self._stats.items()
+        res = {}
+        for name, counter in counters:
+            res[name] = counter.value
+        for name, stat in stats:
+            res[name] = stat.snapshot()
+        return res
+
+    def dump(self, logger):
+        """Write all metrics to ``logger`` one metric per line."""
+        for name, value in sorted(self.snapshot().iteritems()):
+            if isinstance(value, dict):
+                value = ' '.join('{}={}'.format(k, self._format(v))
+                        for k, v in sorted(value.iteritems()))
+            logger.warning("metric {}: {}".format(name, value))
+
+    @staticmethod
+    def _format(value):
+        if isinstance(value, float):
+            return '{:.3f}'.format(value)
+        return value
+
+@public
+class GlobalMetrics(Metrics):
+    """A singleton of :class:`bastio.metrics.Metrics`."""
+    __metaclass__ = KindSingletonMeta
@@ -0,0 +1,652 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.provision
+:synopsis: Account provisioning backends.
+:author: Amr Ali <amr@databracket.com>
+
+.. autoclass:: Provisioner
+    :members:
+
+.. autoclass:: NativeProvisioner
+    :members:
+
+.. autoclass:: CommandProvisioner
+    :members:
+
+.. autoclass:: NssCacheProvisioner
+    :members:
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import pwd
+import stat
+import errno
+import json
+import shutil
+import threading
+
+from bastio.log import Logger
+from bastio.mixin import public
+from bastio.journal import Journal
+from bastio.metrics import GlobalMetrics
+from bastio.configs import GlobalConfigStore
+from bastio.fsutil import atomic_write, Trash
+from bastio.concurrency import GroupCommit
+from bastio.command import GlobalCommandHelper
+from bastio.userdb import (UserDatabase, AccountDatabase, read_login_defs,
+        allocate_id)
+from bastio.excepts import (BastioProvisionError, BastioConfigError,
+        BastioCommandError, BastioUnimplementedError)
+
+@public
+class Provisioner(object):
+    """A base class of account provisioning backends. Every operation raises
+    :class:`bastio.excepts.BastioProvisionError` on failure.
+
+    Operations are serialized by the provisioner, except that users added
+    concurrently are created together by :func:`Provisioner.add_users` in
+    batches of up to ``BatchSize`` users, see
+    :class:`bastio.concurrency.GroupCommit`.
+
+    Home directories of removed users are put in the trash once the user is
+    removed and deleted in the background, see :class:`bastio.fsutil.Trash`,
+    whose pace is set by the ``trash_batch`` and ``trash_pause`` options.
+
+    :param index:
+        An index of the accounts to keep up to date with the changes made by
+        the provisioner.
+    :type index:
+        :class:`bastio.userdb.AccountIndex`
+    """
+    SudoGroup = 'sudo'
+    Backends = {}
+    BatchSize = 64
+    BatchDelay = 0.005
+
+    def __init__(self, index=None):
+        cfg = GlobalConfigStore()
+        self._index = index
+        self._logger = Logger()
+        self._lock = threading.Lock()
+        self._trash = Trash(cfg.lookup('trash_batch', Trash.Batch, int),
+                cfg.lookup('trash_pause', Trash.Pause, float))
+        self._adds = GroupCommit(self.add_users, self.BatchSize, self.BatchDelay,
+                name='provision.add_user')
+
+    @classmethod
+    def register(cls, backend):
+        """A class decorator to register a provisioning backend by its
+        ``Name``.
+        """
+        cls.Backends[backend.Name] = backend
+        return backend
+
+    @classmethod
+    def create(cls, name, **kwargs):
+        """Create a provisioning backend by its name.
+
+        :param name:
+            The name of the backend.
+        :type name:
+            str
+        :raises:
+            :class:`bastio.excepts.BastioConfigError`
+        """
+        if name not in cls.Backends:
+            raise BastioConfigError("provisioner `{}` is not supported".format(name))
+        return cls.Backends[name](**kwargs)
+
+    def add_user(self, username, sudo):
+        """Create a user with a group of its own, a home directory populated
+        from the skeleton directory and no password.
+
+        :param username:
+            The name of the user.
+        :type username:
+            str
+        :param sudo:
+            Whether to add the user to the sudo group.
+        :type sudo:
+            bool
+        """
+        self._adds.submit((username, sudo))
+
+    def add_users(self, requests):
+        """Create a batch of users, see :func:`Provisioner.add_user`.
+
+        :param requests:
+            A list of ``(username, sudo)`` tuples.
+        :type requests:
+            list
+        :returns:
+            A list of the results of every request in order, where a result is
+            either None or a :class:`bastio.excepts.BastioProvisionError`.
+        """
+        raise BastioUnimplementedError("function add_users is not implemented")
+
+    def remove_user(self, username):
+        """Remove a user, its group, its home directory and its mail spool.
+
+        :param username:
+            The name of the user.
+        :type username:
+            str
+        """
+        raise BastioUnimplementedError("function remove_user is not implemented")
+
+    def set_sudo(self, username, sudo):
+        """Add a user to the sudo group or remove it from it. Removing a user
+        that is not a member fails.
+
+        :param username:
+            The name of the user.
+        :type username:
+            str
+        :param sudo:
+            Whether the user should be a member of the sudo group.
+        :type sudo:
+            bool
+        """
+        raise BastioUnimplementedError("function set_sudo is not implemented")
+
+    def start(self):
+        """Start deleting the trash in the background."""
+        self._trash.start()
+
+    def stop(self):
+        """Stop deleting the trash and flush any state kept by the provisioner
+        to disk.
+        """
+        self._trash.stop()
+
+    def _remove_home(self, path):
+        """Put a home directory in the trash, or remove it right away if it
+        can't be renamed (e.g., it's a mount point).
+        """
+        try:
+            self._trash.put(path)
+        except OSError:
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return
+        try:
+            if stat.S_ISDIR(st.st_mode):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        except (OSError, IOError) as ex:
+            raise BastioProvisionError("unable to remove `{}`: {}".format(
+                path, ex.strerror))
+
+@public
+@Provisioner.register
+class NativeProvisioner(Provisioner):
+    """A provisioning backend that edits the account databases directly the
+    way ``useradd -mU``, ``passwd -d``, ``userdel -r`` and ``gpasswd`` do,
+    without spawning any process. See :class:`bastio.userdb.UserDatabase`.
+
+    A home directory that already exists is kept as it is, the way ``useradd``
+    keeps it, and a user is removed again if its home directory can't be
+    created.
+
+    :param root:
+        The root directory of the system, which is only useful for tests.
+    :type root:
+        str
+    :param index:
+        See :class:`Provisioner`.
+    :type index:
+        :class:`bastio.userdb.AccountIndex`
+    """
+    Name = 'native'
+
+    def __init__(self, root='/', index=None):
+        super(NativeProvisioner, self).__init__(index)
+        self._db = UserDatabase(root, index)
+        defaults = read_login_defs(self._db.path('etc/default/useradd'))
+        self._trash.watch(self._db.path(defaults.get('HOME', '/home').lstrip('/')))
+
+    def add_users(self, requests):
+        results = [None] * len(requests)
+        created = []
+        # All users of the batch are added within a single transaction, which
+        # writes every database once
+        with self._lock, self._db.transaction() as db:
+            defaults = read_login_defs(db.path('etc/default/useradd'))
+            skel = db.path(defaults.get('SKEL', '/etc/skel').lstrip('/'))
+            for idx, (username, sudo) in enumerate(requests):
+                try:
+                    uid, gid, home = self._add_entries(db, defaults, username, sudo)
+                    created.append((idx, uid, gid, db.path(home.lstrip('/'))))
+                except BastioProvisionError as ex:
+                    results[idx] = ex
+        for idx, uid, gid, home in created:
+            try:
+                self._populate_home(requests[idx][0], home, skel, uid, gid,
+                        db.defs)
+            except BastioProvisionError as ex:
+                results[idx] = ex
+        return results
+
+    def _add_entries(self, db, defaults, username, sudo):
+        if username in db.passwd:
+            raise BastioProvisionError("user `{}` already exists".format(username))
+        if username in db.group:
+            raise BastioProvisionError("group `{}` already exists".format(username))
+        if sudo and self.SudoGroup not in db.group:
+            raise BastioProvisionError("group `{}` does not exist".format(
+                self.SudoGroup))
+        uid = db.allocate_uid()
+        gid = db.allocate_gid(uid)
+        home = os.path.join(defaults.get('HOME', '/home'), username)
+        db.add_group(username, gid)
+        # An empty password like ``passwd -d`` leaves it
+        db.add_user(username, uid, gid, home, defaults.get('SHELL', '/bin/sh'),
+                password='')
+        if sudo:
+            db.add_member(self.SudoGroup, username)
+        return uid, gid, home
+
+    def _populate_home(self, username, home, skel, uid, gid, defs):
+        """Create the home directory of a user that was just added, see
+        :func:`NativeProvisioner._create_home`, and remove the user again if it
+        can't be created.
+        """
+        try:
+            if not self._create_home(home, skel, uid, gid, defs):
+                self._logger.warning("home directory `{}` already exists, not "
+                        "copying any file from the skeleton into it".format(home))
+        except BastioProvisionError:
+            try:
+                self._rollback(username)
+            except BastioProvisionError as ex:
+                self._logger.critical("unable to remove user `{}` again: {}".format(
+                    username, ex.message))
+            raise
+
+    def _rollback(self, username):
+        """Remove the entries of a user that was just added."""
+        with self._lock, self._db.transaction() as db:
+            if username in db.passwd:
+                db.remove_user(username)
+            if username in db.group:
+                db.remove_group(username)
+
+    def remove_user(self, username):
+        with self._lock, self._db.transaction() as db:
+            fields = db.passwd.get(username)
+            if fields is None:
+                raise BastioProvisionError("user `{}` does not exist".format(username))
+            home = fields[5]
+            db.remove_user(username)
+            # Like userdel, remove the user's own group unless others use it
+            group = db.group.get(username)
+            if group and group[2] == fields[3] and not db.members(username) and \
+                    not any(user[3] == group[2] for user in db.passwd):
+                db.remove_group(username)
+            mail_dir = db.defs.get('MAIL_DIR', '/var/mail')
+        self._remove(db.path(os.path.join(mail_dir, username).lstrip('/')))
+        self._remove_home(db.path(home.lstrip('/')))
+
+    def set_sudo(self, username, sudo):
+        with self._lock, self._db.transaction() as db:
+            if username not in db.passwd:
+                raise BastioProvisionError("user `{}` does not exist".format(username))
+            if sudo:
+                db.add_member(self.SudoGroup, username)
+            elif not db.remove_member(self.SudoGroup, username):
+                raise BastioProvisionError("user `{}` is not a member of `{}`".format(
+                    username, self.SudoGroup))
+
+    @staticmethod
+    def _create_home(home, skel, uid, gid, defs):
+        """Create a home directory with a copy of the skeleton directory that
+        is owned by the user, and return whether it was created. A home
+        directory that already exists is left untouched.
+        """
+        umask = int(defs.get('UMASK', '022'), 8)
+        mode = int(defs.get('HOME_MODE', oct(0777 & ~umask)), 8)
+        try:
+            os.makedirs(os.path.dirname(home))
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise BastioProvisionError("unable to create `{}`: {}".format(
+                    os.path.dirname(home), ex.strerror))
+        try:
+            os.mkdir(home)
+        except OSError as ex:
+            if ex.errno == errno.EEXIST:
+                return False
+            raise BastioProvisionError("unable to create home directory `{}`: {}".format(
+                home, ex.strerror))
+        try:
+            os.chmod(home, mode)
+            if os.path.isdir(skel):
+                for name in os.listdir(skel):
+                    src = os.path.join(skel, name)
+                    dst = os.path.join(home, name)
+                    if os.path.islink(src):
+                        os.symlink(os.readlink(src), dst)
+                    elif os.path.isdir(src):
+                        shutil.copytree(src, dst, symlinks=True)
+                    else:
+                        shutil.copy2(src, dst)
+            for dirpath, dirnames, filenames in os.walk(home):
+                for name in [dirpath] + [os.path.join(dirpath, x)
+                        for x in dirnames + filenames]:
+                    os.lchown(name, uid, gid)
+        except (OSError, IOError, shutil.Error) as ex:
+            shutil.rmtree(home, ignore_errors=True)
+            raise BastioProvisionError("unable to create home directory `{}`: {}".format(
+                home, getattr(ex, 'strerror', None) or str(ex)))
+        return True
+
+@public
+@Provisioner.register
+class CommandProvisioner(Provisioner):
+    """A provisioning backend that runs the shadow utilities (``useradd``,
+    ``passwd``, ``userdel`` and ``gpasswd``) through the command helper, see
+    :class:`bastio.command.CommandHelper`, where a command fails if it exits
+    with a non-zero status or does not finish in time.
+    """
+    Name = 'command'
+
+    def __init__(self, index=None):
+        super(CommandProvisioner, self).__init__(index)
+        self._trash.watch(read_login_defs('/etc/default/useradd').get('HOME',
+            '/home'))
+
+    def add_users(self, requests):
+        results = []
+        with self._lock:
+            for username, sudo in requests:
+                try:
+                    self._add_user(username, sudo)
+                    results.append(None)
+                except BastioProvisionError as ex:
+                    results.append(ex)
+        return results
+
+    def remove_user(self, username):
+        with self._lock:
+            fields = self._index.user(username) if self._index is not None else None
+            if fields is None:
+                try:
+                    fields = list(pwd.getpwnam(username))
+                except KeyError:
+                    raise BastioProvisionError("user `{}` does not exist".format(
+                        username))
+            # Like ``userdel -r`` except that the home directory is deleted in
+            # the background once the user is gone
+            self._run_command(['userdel', username])
+            mail_dir = read_login_defs('/etc/login.defs').get('MAIL_DIR', '/var/mail')
+            self._remove(os.path.join(mail_dir, username))
+            self._remove_home(fields[5])
+
+    def set_sudo(self, username, sudo):
+        flag = '-a' if sudo else '-d'
+        with self._lock:
+            self._run_command(['gpasswd', flag, username, self.SudoGroup])
+
+    def _add_user(self, username, sudo):
+        if sudo:
+            self._run_command(['useradd', '-mU', '-G', self.SudoGroup, username])
+        else:
+            self._run_command(['useradd', '-mU', username])
+        # Clear out user's password
+        self._run_command(['passwd', '-d', username])
+
+    @staticmethod
+    def _run_command(argv, input_data=None):
+        try:
+            result = GlobalCommandHelper().run(argv, input_data)
+        except BastioCommandError as ex:
+            raise BastioProvisionError(ex.message)
+        if result.timed_out:
+            raise BastioProvisionError("`{}` did not finish in time".format(argv[0]))
+        if result.cancelled:
+            raise BastioProvisionError("`{}` was cancelled".format(argv[0]))
+        if not result.success:
+            raise BastioProvisionError(result.stderr.strip() or
+                    "`{}` exited with status {}".format(argv[0], result.code))
+        return result.stdout
+
+@public
+@Provisioner.register
+class NssCacheProvisioner(NativeProvisioner):
+    """A provisioning backend for hosts with many accounts that keeps the users
+    it creates in a journal of its own instead of the system's account
+    databases, and publishes them as the ``passwd.cache`` and ``group.cache``
+    files of ``libnss-cache``, which ``/etc/nsswitch.conf`` has to list after
+    the local databases::
+
+        passwd: files cache
+        group:  files cache
+
+    The files are regenerated from the journal and written atomically along
+    with their indexes once per batch of changes rather than once per change:
+    users added together are published by a single write (see
+    :func:`Provisioner.add_users`), and so are users removed or changed while
+    a write is pending, see :class:`bastio.concurrency.GroupCommit`. The number
+    of times the files are written is tracked by the ``nsscache.writes``
+    metric.
+
+    Every user gets a group of its own and its sudo group membership is
+    published as a ``group.cache`` entry of the local sudo group. Users have
+    no ``shadow`` entry, so they may only log in with keys. Operations on
+    users that exist in the local databases are left to
+    :class:`NativeProvisioner`.
+
+    :param root:
+        The root directory of the system, which is only useful for tests.
+    :type root:
+        str
+    :param index:
+        See :class:`Provisioner`.
+    :type index:
+        :class:`bastio.userdb.AccountIndex`
+    :param journal:
+        The journal that persists the users, a journal named ``JournalName``
+        in the state directory by default.
+    :type journal:
+        :class:`bastio.journal.Journal`
+    """
+    Name = 'nsscache'
+    JournalName = 'accounts.journal'
+    CacheSuffix = '.cache'
+
+    def __init__(self, root='/', index=None, journal=None):
+        super(NssCacheProvisioner, self).__init__(root, index)
+        self._journal = journal if journal is not None else \
+                Journal.open(self.JournalName)
+        self._writes = GlobalMetrics().counter('nsscache.writes')
+        # username -> [uid, gid, home, shell, sudo]
+        self._users = {}
+        for username, data in self._journal.replay():
+            # The journal gives back unicode strings
+            self._users[str(username)] = [str(x) if isinstance(x, unicode) else x
+                    for x in json.loads(data)]
+        self._publications = GroupCommit(self._publish, self.BatchSize,
+                self.BatchDelay, name='provision.nsscache')
+        # Files written by an earlier run may be missing or stale
+        with self._lock:
+            self._write_files()
+
+    def add_users(self, requests):
+        results = [None] * len(requests)
+        created = []
+        with self._lock:
+            defs = read_login_defs(self._db.path('etc/login.defs'))
+            defaults = read_login_defs(self._db.path('etc/default/useradd'))
+            skel = self._db.path(defaults.get('SKEL', '/etc/skel').lstrip('/'))
+            passwd, group = self._local_databases()
+            uids = self._ids(passwd) | set(x[0] for x in self._users.itervalues())
+            gids = self._ids(group) | set(x[1] for x in self._users.itervalues())
+            for idx, (username, sudo) in enumerate(requests):
+                try:
+                    if username in passwd or username in self._users:
+                        raise BastioProvisionError("user `{}` already exists".format(
+                            username))
+                    if username in group:
+                        raise BastioProvisionError("group `{}` already exists".format(
+                            username))
+                    if sudo and self.SudoGroup not in group:
+                        raise BastioProvisionError("group `{}` does not exist".format(
+                            self.SudoGroup))
+                    uid = allocate_id(defs, 'UID', uids)
+                    gid = allocate_id(defs, 'GID', gids, uid)
+                except BastioProvisionError as ex:
+                    results[idx] = ex
+                    continue
+                uids.add(uid)
+                gids.add(gid)
+                entry = [uid, gid, os.path.join(defaults.get('HOME', '/home'),
+                    username), defaults.get('SHELL', '/bin/sh'), sudo]
+                self._users[username] = entry
+                created.append((idx, username, entry))
+            if not created:
+                return results
+            try:
+                for _, username, entry in created:
+                    self._journal.append(username, json.dumps(entry))
+                self._journal.sync()
+                self._write_files()
+            except BastioProvisionError:
+                for _, username, _ in created:
+                    self._users.pop(username, None)
+                    self._journal.ack(username)
+                raise
+        for idx, username, (uid, gid, home, _, _) in created:
+            try:
+                self._populate_home(username, self._db.path(home.lstrip('/')),
+                        skel, uid, gid, defs)
+            except BastioProvisionError as ex:
+                results[idx] = ex
+        return results
+
+    def _rollback(self, username):
+        with self._lock:
+            if self._users.pop(username, None) is None:
+                return
+            self._journal.ack(username)
+            self._journal.sync()
+        self._publications.submit(username)
+
+    def remove_user(self, username):
+        with self._lock:
+            entry = self._users.pop(username, None)
+            if entry is not None:
+                self._journal.ack(username)
+                self._journal.sync()
+        if entry is None:
+            return super(NssCacheProvisioner, self).remove_user(username)
+        self._publications.submit(username)
+        mail_dir = read_login_defs(self._db.path('etc/login.defs')).get(
+                'MAIL_DIR', '/var/mail')
+        self._remove(self._db.path(os.path.join(mail_dir, username).lstrip('/')))
+        self._remove_home(self._db.path(entry[2].lstrip('/')))
+
+    def set_sudo(self, username, sudo):
+        with self._lock:
+            entry = self._users.get(username)
+            if entry is not None:
+                if sudo and self.SudoGroup not in self._local_databases()[1]:
+                    raise BastioProvisionError("group `{}` does not exist".format(
+                        self.SudoGroup))
+                if not sudo and not entry[4]:
+                    raise BastioProvisionError("user `{}` is not a member of `{}`".format(
+                        username, self.SudoGroup))
+                if entry[4] == sudo:
+                    return
+                entry[4] = sudo
+                self._journal.ack(username)
+                self._journal.append(username, json.dumps(entry))
+                self._journal.sync()
+        if entry is None:
+            return super(NssCacheProvisioner, self).set_sudo(username, sudo)
+        self._publications.submit(username)
+
+    def stop(self):
+        super(NssCacheProvisioner, self).stop()
+        self._journal.stop()
+
+    def _publish(self, usernames):
+        with self._lock:
+            self._write_files()
+        return [None] * len(usernames)
+
+    def _local_databases(self):
+        passwd = AccountDatabase(self._db.path('etc/passwd'), 7)
+        group = AccountDatabase(self._db.path('etc/group'), 4)
+        passwd.load()
+        group.load()
+        return passwd, group
+
+    @staticmethod
+    def _ids(db):
+        return set(int(fields[2]) for fields in db if fields[2].isdigit())
+
+    def _write_files(self):
+        """Write the cache files of all the managed users, must be called while
+        holding the lock.
+        """
+        passwd, group, sudoers = [], [], []
+        for username, (uid, gid, home, shell, sudo) in sorted(
+                self._users.iteritems(), key=lambda x: x[1][0]):
+            passwd.append((username, uid, [username, 'x', str(uid), str(gid), '',
+                home, shell]))
+            group.append((username, gid, [username, 'x', str(gid), '']))
+            if sudo:
+                sudoers.append(username)
+        if sudoers:
+            fields = self._local_databases()[1].get(self.SudoGroup)
+            if fields is not None:
+                group.append((self.SudoGroup, int(fields[2]), [self.SudoGroup, 'x',
+                    fields[2], ','.join(sudoers)]))
+        try:
+            self._write_file('passwd', 'uid', passwd)
+            self._write_file('group', 'gid', group)
+        except (IOError, OSError) as ex:
+            raise BastioProvisionError("unable to write cache files: {}".format(
+                ex.strerror))
+        self._writes.inc()
+
+    def _write_file(self, name, id_name, entries):
+        """Write a cache file and its indexes by name and by ID. An index is
+        sorted by key and made of fixed-width lines, each of which is the key
+        padded with NUL bytes, a NUL byte and the offset of the entry in the
+        cache file.
+        """
+        path = self._db.path('etc', name + self.CacheSuffix)
+        lines, by_name, by_id = [], [], []
+        offset = 0
+        for key, ident, fields in entries:
+            line = ':'.join(fields) + '\n'
+            lines.append(line)
+            by_name.append((key, offset))
+            by_id.append((str(ident), offset))
+            offset += len(line)
+        # libnss-cache ignores indexes that are older than the cache file
+        atomic_write(path, ''.join(lines), 0644)
+        atomic_write(path + '.ixname', self._render_index(by_name), 0644)
+        atomic_write(path + '.ix' + id_name, self._render_index(by_id), 0644)
+
+    @staticmethod
+    def _render_index(entries):
+        if not entries:
+            return ''
+        key_width = max(len(key) for key, _ in entries)
+        offset_width = len(str(max(offset for _, offset in entries)))
+        return ''.join('{}\0{}\n'.format(key.ljust(key_width, '\0'),
+            str(offset).rjust(offset_width, '0')) for key, offset in sorted(entries))
@@ -14,6 +14,12 @@ Backend Connection Management
 
 .. rst-class:: html-toggle
 
+Backend Endpoints Dialer
+------------------------
+.. automodule:: bastio.ssh.dialer
+
+.. rst-class:: html-toggle
+
 Action Processor
 ----------------
 .. automodule:: bastio.ssh.api
@@ -26,6 +32,24 @@ Protocol Parsing And Logic Routing
 
 .. rst-class:: html-toggle
 
+Authorized Keys Management
+--------------------------
+.. automodule:: bastio.ssh.authkeys
+
+.. rst-class:: html-toggle
+
+State Digest
+------------
+.. automodule:: bastio.ssh.digest
+
+.. rst-class:: html-toggle
+
+Access Expiry
+-------------
+.. automodule:: bastio.ssh.expiry
+
+.. rst-class:: html-toggle
+
 Cryptographic Utilities
 -----------------------
 .. automodule:: bastio.ssh.crypto
@@ -8,6 +8,15 @@
 
 .. autoclass:: Processor
     :members:
+
+.. autoclass:: ReplayCache
+    :members:
+
+.. autoclass:: ManagedRegistry
+    :members:
+
+.. autoclass:: Reconciler
+    :members:
 """
 
 __author__ = "Amr Ali"
@@ -15,19 +24,31 @@ __copyright__ = "Copyright 2013 Databracket LLC"
 __license__ = "GPLv3+"
 
 import os
-import pwd
+import time
 import threading
-import subprocess
 import collections
 import Queue as queue
 
 from bastio.log import Logger
 from bastio.mixin import KindSingletonMeta, public
 from bastio.configs import GlobalConfigStore
-from bastio.concurrency import GlobalThreadPool, Task
+from bastio.metrics import GlobalMetrics
+from bastio.concurrency import GlobalThreadPool, Task, LaneQueue, KeyedExecutor
+from bastio.journal import Journal
+from bastio.provision import Provisioner
+from bastio.userdb import AccountIndex
+from bastio.command import GlobalCommandHelper
 from bastio.ssh.client import BackendConnector
-from bastio.ssh.protocol import (FeedbackMessage, AddUserMessage,
-        RemoveUserMessage, UpdateUserMessage, AddKeyMessage, RemoveKeyMessage)
+from bastio.ssh.authkeys import (AuthorizedKey, AuthorizedKeys,
+        AuthorizedKeysCache, AuthorizedKeysWriter)
+from bastio.ssh.keystore import KeyStore, KeyServer
+from bastio.ssh.digest import StateDigest
+from bastio.ssh.expiry import ExpiryScheduler
+from bastio.excepts import (BastioConfigError, BastioMessageError,
+        BastioProvisionError, BastioAuthKeysError)
+from bastio.ssh.protocol import (MessageParser, ProtocolMessage, FeedbackMessage,
+        AddUserMessage, RemoveUserMessage, UpdateUserMessage, AddKeyMessage,
+        RemoveKeyMessage, SyncStateMessage, StateDigestMessage, ActionMessage)
 
 @public
 class Processor(object):
@@ -35,19 +56,154 @@ class Processor(object):
     a feedback to indicate success or failure of the action requested. This class
     is a kind-singleton which means you cannot instantiate more than one copy per
     application life time.
+
+    Actions are processed in order of their priority, so revocations of access
+    jump ahead of any other pending actions except for the ones of the same user.
+
+    The ingress queue holds at most ``ingress_limit`` actions. It is throttled
+    once ``ingress_high_watermark`` actions are pending, which signals the
+    connector to ask the backend to pause, until the number of pending
+    actions drops to ``ingress_low_watermark``. Putting feedback to a full
+    egress queue blocks the processor until there is room for it.
+
+    Every action put in the ingress queue is appended to a write-ahead log in
+    the agent's state directory and is marked complete once its feedback is
+    put in the egress queue. Actions that were not complete when the agent
+    stopped are processed again first thing when it starts, which is safe since
+    every action checks whether it was already applied.
+
+    Up to ``max_inflight`` actions are taken from the ingress queue and run on
+    the thread pool at the same time, and the feedback of each is sent as soon
+    as it completes. Actions of the same user are still run one after the other
+    in the order they were received, and actions that mutate the account
+    databases (e.g., ``/etc/passwd`` and ``/etc/group``) never run at the same
+    time, see :class:`bastio.concurrency.KeyedExecutor`. A sync-state message,
+    which carries the desired state of all managed users, never trades places
+    with another action in the ingress queue and runs alone once the actions
+    before it completed, see :class:`Reconciler`. Actions the backend
+    sends again (e.g., after a reconnect) are answered with the feedback they
+    already got without being processed again, see :class:`ReplayCache`, or
+    with the feedback they get once they complete if they are still pending.
+    Pending actions that a later action of the same user makes pointless
+    (e.g., adding a key that is removed right after, or any action of a user
+    that is removed right after) are answered as superseded without ever being
+    processed. A state-digest
+    message is answered with a node of a hash tree over the state of the
+    managed users, see :class:`bastio.ssh.digest.StateDigest`.
+
+    Users and keys added with an ``expires_at`` field are removed once it
+    passes, even while the agent is not connected to the backend, see
+    :class:`bastio.ssh.expiry.ExpiryScheduler`. Such removals jump ahead of
+    the actions in the ingress queue, and since the backend never sent them
+    their outcome is only logged.
+
+    Accounts are provisioned by the backend named by the ``provisioner``
+    option, which is ``native`` by default, see :mod:`bastio.provision`.
+
+    :param egress:
+        The queue to put feedback messages to, which is usually
+        :attr:`bastio.ssh.client.BackendConnector.egress`. A private queue is
+        created if none was given.
+    :type egress:
+        :class:`Queue.Queue`
     """
     __metaclass__ = KindSingletonMeta
+    IngressLimit = 1024
+    IngressHighWatermark = 768
+    IngressLowWatermark = 256
+    JournalName = 'ingress.journal'
+    MaxInflight = 8
+    IngressPoll = 3.0
+    DefaultProvisioner = 'native'
+    # Users added concurrently are created together by the provisioner, see
+    # :class:`bastio.provision.Provisioner`
+    ExclusiveActions = (RemoveUserMessage, UpdateUserMessage)
+    KeyActions = (AddKeyMessage, RemoveKeyMessage)
+    KeyStores = ('files', 'memory')
+    DefaultKeyStore = 'files'
+    # Messages whose feedback is answered again to retransmits
+    Replayable = (ActionMessage, SyncStateMessage)
 
-    def __init__(self):
+    def __init__(self, egress=None):
+        cfg = GlobalConfigStore()
         self._tp = GlobalThreadPool()
         self._logger = Logger()
-        self._ingress = queue.Queue()
-        self._egress = queue.Queue()
+        limit = cfg.lookup('ingress_limit', self.IngressLimit, int)
+        high = cfg.lookup('ingress_high_watermark', self.IngressHighWatermark, int)
+        low = cfg.lookup('ingress_low_watermark', self.IngressLowWatermark, int)
+        if not 0 <= low < high <= limit:
+            raise BastioConfigError("ingress watermarks must satisfy "
+                    "0 <= ingress_low_watermark < ingress_high_watermark <= ingress_limit")
+        self._wal = Journal.open(self.JournalName)
+        self._superseded = collections.deque()
+        # Actions the backend sent again while they were still pending, and
+        # the ones waiting for the feedback of the pending action by MID
+        self._duplicates = collections.deque()
+        self._attached = {}
+        self._ingress = LaneQueue(lanes=ProtocolMessage.PRIORITIES,
+                lane_of=lambda m: m.priority(),
+                key_of=lambda m: m.ordering_key(), name='ingress',
+                maxsize=limit, high_watermark=high, low_watermark=low,
+                journal=self._wal, record_of=lambda m: (m.mid, m.to_json()),
+                supersedes=self._supersedes,
+                superseded=lambda m, by: self._superseded.append((m, by)),
+                barrier_of=lambda m: isinstance(m, SyncStateMessage),
+                duplicate=self._duplicates.append)
+        self._egress = egress if egress is not None else queue.Queue()
+        self._replayed = collections.deque()
+        self._replay()
+        self._wal.start()
+        self._max_inflight = cfg.lookup('max_inflight', self.MaxInflight, int)
+        if self._max_inflight < 1:
+            raise BastioConfigError("max_inflight must be a positive integer")
+        self._inflight = 0
+        self._slots = threading.Condition()
+        self._executor = KeyedExecutor(self._tp, name='processor')
+        self._replies = ReplayCache(
+                cfg.lookup('replay_cache_size', ReplayCache.Capacity, int),
+                cfg.lookup('replay_cache_ttl', ReplayCache.TTL, float))
+        self._key_batches = {}
+        self._stop_ev = threading.Event()
+        metrics = GlobalMetrics()
+        self._inflight_gauge = metrics.counter('processor.inflight')
+        self._latency = metrics.stats('processor.latency')
+        self._accounts = AccountIndex()
+        self._provisioner = Provisioner.create(cfg.lookup('provisioner',
+            self.DefaultProvisioner), index=self._accounts)
+        self._provisioner.start()
         # TODO: Put the following in a configuration file.
         self._home_dir = '/home'
         self._user_dir = os.path.join(self._home_dir, '{username}')
         self._ssh_dir = os.path.join(self._user_dir, '.ssh')
         self._authkeys = os.path.join(self._ssh_dir, 'authorized_keys')
+        self._keys_cache = AuthorizedKeysCache()
+        self._keys_writer = AuthorizedKeysWriter(self._keys_cache)
+        # Keys are either written to authorized_keys files or kept in memory
+        # and served to sshd's AuthorizedKeysCommand
+        key_store = cfg.lookup('key_store', self.DefaultKeyStore)
+        if key_store not in self.KeyStores:
+            raise BastioConfigError("key_store must be one of {}".format(
+                ', '.join(self.KeyStores)))
+        self._key_store = None
+        self._key_server = None
+        if key_store == 'memory':
+            try:
+                self._key_store = KeyStore()
+                self._key_server = KeyServer(self._key_store,
+                        cfg.lookup('key_socket', KeyServer.SocketPath),
+                        cfg.lookup('key_socket_user', KeyServer.SocketUser))
+                self._key_server.start()
+            except BastioAuthKeysError as ex:
+                raise BastioConfigError(ex.message)
+        self._managed = ManagedRegistry()
+        self._reconciler = Reconciler(self)
+        self._digest = StateDigest()
+        for username in self._managed:
+            self._refresh_digest(username)
+        self._barrier = False
+        # Grants that expired, waiting to be dispatched as removals
+        self._expiring = collections.deque()
+        self._expiry = ExpiryScheduler(wake=self._ingress.interrupt)
         # Start the action handler
         t = Task(target=self.__action_handler, infinite=True)
         t.failure = self.__catch_fail
@@ -87,6 +243,12 @@ class Processor(object):
         elif isinstance(message, RemoveKeyMessage):
             # Remove public key from the user's authorized_keys file
             feedback = self._remove_key(message)
+        elif isinstance(message, SyncStateMessage):
+            # Converge to the desired state of all managed users
+            feedback = self._sync_state(message)
+        elif isinstance(message, StateDigestMessage):
+            # Answer with a node of the state digest
+            feedback = self._state_digest(message)
         else:
             # NOTE: This execution branch must never be reached,
             # do not take this lightly if it happens.
@@ -94,19 +256,321 @@ class Processor(object):
                     ("internal error: agent does not know how to handle messages"
                         " of type `{type}`").format(type=message.type),
                     FeedbackMessage.ERROR)
+        if isinstance(message, ActionMessage):
+            self._refresh_digest(message.username)
         return feedback
 
+    def process_keys(self, messages):
+        """Process key actions of a single user in the order they were received
+        and return their feedback. The user's ``authorized_keys`` file is
+        rewritten at most once.
+
+        :param messages:
+            The messages to be processed.
+        :type messages:
+            list of :class:`bastio.ssh.protocol.AddKeyMessage` and
+            :class:`bastio.ssh.protocol.RemoveKeyMessage`
+        :returns:
+            list of :class:`bastio.ssh.protocol.FeedbackMessage`
+        """
+        feedbacks = self._apply_keys(messages)
+        self._refresh_digest(messages[0].username)
+        return feedbacks
+
     def stop(self):
-        """Signal the action handler to stop."""
+        """Signal the action handler to stop and cancel running commands."""
+        self._stop_ev.set()
         self._action_handler_task.stop()
+        GlobalCommandHelper().cancel_all()
+        if self._key_server:
+            self._key_server.stop()
+            self._key_store.stop()
+        self._managed.stop()
+        self._expiry.stop()
+        self._provisioner.stop()
+        self._wal.stop()
+
+    @property
+    def managed(self):
+        """The users managed by the agent.
+
+        :returns:
+            :class:`ManagedRegistry`
+        """
+        return self._managed
+
+    def has_user(self, username):
+        """Return whether a user and its home directory exist.
+
+        :raises:
+            :class:`bastio.excepts.BastioProvisionError`
+        """
+        fields = self._accounts.user(username)
+        return fields is not None and os.path.isdir(fields[5])
+
+    def is_sudo(self, username):
+        """Return whether a user is a member of the sudo group.
+
+        :raises:
+            :class:`bastio.excepts.BastioProvisionError`
+        """
+        return self._accounts.is_member(Provisioner.SudoGroup, username)
+
+    def read_keys(self, username):
+        """Return the current keys of a user.
+
+        :returns:
+            :class:`bastio.ssh.authkeys.AuthorizedKeys`
+        :raises:
+            :class:`bastio.excepts.BastioAuthKeysError`
+        """
+        if self._key_store is not None:
+            return self._key_store.keys(username)
+        return self._keys_cache.get(self._authkeys.format(username=username))
+
+    def write_keys(self, username, changes):
+        """Apply key changes of a user at once and discard the expiry of the
+        keys that were removed, see
+        :func:`bastio.ssh.authkeys.AuthorizedKeysWriter.apply`.
+
+        :returns:
+            A list of whether each change was applied.
+        :raises:
+            :class:`bastio.excepts.BastioAuthKeysError`,
+            :class:`bastio.excepts.BastioProvisionError`
+        """
+        if self._key_store is not None:
+            results = self._key_store.apply(username, changes)
+        else:
+            fields = self._accounts.user(username)
+            if fields is None:
+                raise BastioProvisionError("{} does not exist".format(username))
+            results = self._keys_writer.apply(self._authkeys.format(
+                username=username), changes, (int(fields[2]), int(fields[3])))
+        for op, arg in changes:
+            if op == AuthorizedKeysWriter.REMOVE:
+                self._expiry.discard(username, arg)
+        return results
+
+    def add_users(self, requests):
+        """Create users in a single batch of the provisioner, see
+        :func:`bastio.provision.Provisioner.add_users`. The users that were
+        created are managed from now on.
+
+        :returns:
+            A list of None or of the :class:`bastio.excepts.BastioProvisionError`
+            of every request.
+        """
+        results = self._provisioner.add_users(requests)
+        for (username, _), result in zip(requests, results):
+            if result is None:
+                self._managed.add(username)
+                self._create_ssh(username)
+        return results
+
+    def remove_user(self, username):
+        """Remove a user along with its keys and grants, and stop managing it.
+
+        :raises:
+            :class:`bastio.excepts.BastioProvisionError`
+        """
+        self._provisioner.remove_user(username)
+        self._managed.discard(username)
+        self._expiry.discard_user(username)
+        if self._key_store is not None:
+            self._key_store.remove_user(username)
+
+    def set_sudo(self, username, sudo):
+        """Add a user to the sudo group or remove it from it.
+
+        :raises:
+            :class:`bastio.excepts.BastioProvisionError`
+        """
+        self._provisioner.set_sudo(username, sudo)
 
     def __action_handler(self, kill_ev):
         self._logger.warning("action handler started")
         while not kill_ev.is_set():
-            message = self._get_ingress(timeout=3)
+            # Wait for a free slot in the in-flight window
+            with self._slots:
+                if self._inflight >= self._max_inflight or self._barrier:
+                    self._slots.wait(1)
+                    continue
+            if self._superseded:
+                self._answer_superseded(*self._superseded.popleft())
+                continue
+            if self._duplicates:
+                self._attach(self._duplicates.popleft())
+                continue
+            if not self._expiring:
+                self._expiring.extend(self._expiry.due())
+            if self._expiring:
+                self._dispatch(self._revocation(self._expiring.popleft()))
+                continue
+            message = self._get_ingress(timeout=self._ingress_timeout())
             if message:
-                feedback = self.process(message)
-                self._put_egress(feedback)
+                self._dispatch(message)
+
+    def _dispatch(self, message):
+        """Run an action on the executor in the lane of its user. Key actions
+        of a user that arrive while an earlier one still waits in the lane
+        join it to be applied together.
+        """
+        key = message.ordering_key()
+        cached = self._replies.get(message.mid)
+        if cached is not None:
+            # A retransmit of an action that was already processed
+            with self._slots:
+                self._inflight += 1
+                self._inflight_gauge.set(self._inflight)
+            self._complete(message, message.reply(*cached), time.time())
+            return
+        if isinstance(message, SyncStateMessage):
+            # A sync-state concerns every user, so it runs alone after all the
+            # actions before it completed and before any action after it
+            with self._slots:
+                while self._inflight and not self._stop_ev.is_set():
+                    self._slots.wait(1)
+                self._barrier = True
+                self._inflight += 1
+                self._inflight_gauge.set(self._inflight)
+            self._executor.submit(None, self._execute, message, exclusive=True)
+            return
+        with self._slots:
+            self._inflight += 1
+            self._inflight_gauge.set(self._inflight)
+            if isinstance(message, self.KeyActions):
+                batch = self._key_batches.get(key)
+                if batch is not None:
+                    batch.append(message)
+                    return
+                batch = self._key_batches[key] = [message]
+            else:
+                # Later key actions must not be applied before this one
+                self._key_batches.pop(key, None)
+                batch = None
+        if batch is None:
+            self._executor.submit(key, self._execute, message,
+                    exclusive=isinstance(message, self.ExclusiveActions))
+        else:
+            self._executor.submit(key, self._execute_keys, key, batch)
+
+    def _supersedes(self, message, pending):
+        """Return whether a pending action has no bearing on the outcome once
+        a later action of the same user is applied. Removing a user supersedes
+        all of its pending actions but removals, and adding a key supersedes
+        removing the same key and vice versa.
+        """
+        if isinstance(message, RemoveUserMessage):
+            return isinstance(pending, ActionMessage) and \
+                    not isinstance(pending, RemoveUserMessage)
+        if isinstance(message, self.KeyActions) and \
+                isinstance(pending, self.KeyActions) and \
+                type(message) is not type(pending):
+            try:
+                return AuthorizedKey.parse(message.public_key).fingerprint == \
+                        AuthorizedKey.parse(pending.public_key).fingerprint
+            except BastioAuthKeysError:
+                return False
+        return False
+
+    def _answer_superseded(self, message, superseding):
+        with self._slots:
+            self._inflight += 1
+            self._inflight_gauge.set(self._inflight)
+        self._complete(message, message.reply(
+            "{action} was superseded by action `{mid}`".format(
+                action=message.action, mid=superseding.mid),
+            FeedbackMessage.INFO), time.time())
+
+    def _attach(self, message):
+        """Answer an action the backend sent again while it was pending with
+        the feedback of the pending one once it completes. Actions whose
+        feedback is not kept are processed again instead.
+        """
+        if not isinstance(message, self.Replayable):
+            self._dispatch(message)
+            return
+        with self._slots:
+            cached = self._replies.get(message.mid)
+            if cached is None:
+                self._attached.setdefault(message.mid, []).append(message)
+                return
+            self._inflight += 1
+            self._inflight_gauge.set(self._inflight)
+        self._complete(message, message.reply(*cached), time.time())
+
+    def _revocation(self, grant):
+        """Return the action that revokes a grant that expired."""
+        if grant.public_key is None:
+            message = RemoveUserMessage(username=grant.username)
+        else:
+            message = RemoveKeyMessage(username=grant.username,
+                    public_key=grant.public_key)
+        message._grant = grant
+        return message
+
+    def _execute(self, message):
+        started = time.time()
+        try:
+            feedback = self.process(message)
+        except Exception:
+            self._logger.critical("unexpected error occurred processing action `{}`".format(
+                message.mid), exc_info=True)
+            feedback = message.reply("internal error: agent failed to process "
+                    "the action", FeedbackMessage.ERROR)
+        self._complete(message, feedback, started)
+
+    def _execute_keys(self, key, batch):
+        with self._slots:
+            # Close the batch to new actions
+            if self._key_batches.get(key) is batch:
+                del self._key_batches[key]
+        started = time.time()
+        try:
+            feedbacks = self.process_keys(batch)
+        except Exception:
+            self._logger.critical("unexpected error occurred processing actions `{}`".format(
+                ', '.join(message.mid for message in batch)), exc_info=True)
+            feedbacks = [message.reply("internal error: agent failed to process "
+                "the action", FeedbackMessage.ERROR) for message in batch]
+        for message, feedback in zip(batch, feedbacks):
+            self._complete(message, feedback, started)
+
+    def _complete(self, message, feedback, started):
+        self._latency.add(time.time() - started)
+        grant = getattr(message, '_grant', None)
+        duplicates = ()
+        if grant is None:
+            with self._slots:
+                if isinstance(message, self.Replayable):
+                    self._replies.put(message.mid, (feedback.feedback,
+                        feedback.status))
+                duplicates = self._attached.pop(message.mid, ())
+        try:
+            if grant is not None:
+                # The backend never sent this action, so there is no one to
+                # send its feedback to
+                log = self._logger.error if feedback.status == \
+                        FeedbackMessage.ERROR else self._logger.warning
+                log("access of {} expired: {}".format(grant.username,
+                    feedback.feedback))
+            elif self._put_egress(feedback):
+                # The feedback is journaled by now so the action is complete
+                self._wal.ack(message.mid)
+        finally:
+            with self._slots:
+                self._inflight -= 1
+                self._inflight_gauge.set(self._inflight)
+                if isinstance(message, SyncStateMessage):
+                    self._barrier = False
+                self._slots.notify_all()
+        for duplicate in duplicates:
+            with self._slots:
+                self._inflight += 1
+                self._inflight_gauge.set(self._inflight)
+            self._complete(duplicate, duplicate.reply(feedback.feedback,
+                feedback.status), time.time())
 
     def __catch_fail(self, failure):
         try:
@@ -115,27 +579,60 @@ class Processor(object):
             self._logger.critical("unexpected error occurred in the action handler",
                     exc_info=True)
 
+    def _replay(self):
+        """Schedule the actions that were not complete when the agent was last
+        stopped to be processed first.
+        """
+        for mid, data in self._wal.replay():
+            try:
+                self._replayed.append(MessageParser.parse(data))
+            except BastioMessageError as ex:
+                self._logger.critical("dropping journaled action `{}`: {}".format(
+                    mid, ex.message))
+                self._wal.ack(mid)
+        if self._replayed:
+            self._logger.warning("replaying {} incomplete actions".format(
+                len(self._replayed)))
+
+    def _ingress_timeout(self):
+        """Wait for ingress no longer than until the next grant expires."""
+        deadline = self._expiry.next_deadline()
+        if deadline is None:
+            return self.IngressPoll
+        return max(0, min(self.IngressPoll, deadline - time.time()))
+
     def _get_ingress(self, timeout):
+        if self._replayed:
+            return self._replayed.popleft()
         try:
             return self._ingress.get(timeout=timeout)
         except queue.Empty:
             return None
 
     def _put_egress(self, item):
-        self._egress.put(item)
+        # Block while the egress queue is full unless we were asked to stop
+        while not self._stop_ev.is_set():
+            try:
+                self._egress.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
 ###
 ###  BEGIN COMMAND METHODS
 ###
 
+    def _parse_key(self, public_key):
+        # Raises BastioAuthKeysError unless the public key is a valid key line
+        key = AuthorizedKey.parse(public_key)
+        if key is None:
+            raise BastioAuthKeysError("public key is missing")
+        return key
+
     def _chk_user(self, message, status=FeedbackMessage.ERROR, should_exist=False):
         # Check if a user exists
-        user_exist = os.path.exists(self._user_dir.format(
-            username=message.username))
-        try:
-            pwd.getpwnam(message.username)
-        except KeyError:
-            user_exist = False
+        user_exist = self.has_user(message.username)
 
         if user_exist:
             reply_msg = "{username} already exists".format(username=message.username)
@@ -151,24 +648,18 @@ class Processor(object):
                 return False
         return feedback
 
-    def _chk_key(self, message):
-        # Check if a public key exists
-        try:
-            with open(self._authkeys.format(username=message.username), 'rb') as fd:
-                auth_data = fd.read()
-        except Exception:
-            return False
-        return message.public_key in auth_data
-
-    def _create_ssh(self, message):
+    def _create_ssh(self, username):
+        if self._key_store is not None:
+            # Keys are served from memory, so there are no files to create
+            return
         # Make sure that .ssh exists and has the right permissions
         try:
-            os.mkdir(self._ssh_dir.format(username=message.username), 0700)
+            os.mkdir(self._ssh_dir.format(username=username), 0700)
         except OSError:
             pass # Directory already exists (or perm denied... very unlikely)
 
         # Touch .ssh/authorized_keys file
-        auth_file = self._authkeys.format(username=message.username)
+        auth_file = self._authkeys.format(username=username)
         try:
             with open(auth_file, 'ab') as fd:
                 pass # We just want to create the file if it doesn't exist
@@ -185,179 +676,476 @@ class Processor(object):
 
         # Chown .ssh/authorized_keys to the user
         try:
-            pw_struct = pwd.getpwnam(message.username)
-            os.chown(self._ssh_dir.format(username=message.username),
-                    pw_struct.pw_uid, pw_struct.pw_gid)
-            os.chown(auth_file, pw_struct.pw_uid, pw_struct.pw_gid)
-        except KeyError:
-            # username not found from getpwnam
-            pass
-        except OSError:
+            fields = self._accounts.user(username)
+        except BastioProvisionError:
+            # Left to the messages that write the keys of the user
+            return
+        if fields is None:
+            # username not found in the passwd database
+            return
+        try:
+            uid, gid = int(fields[2]), int(fields[3])
+            os.chown(self._ssh_dir.format(username=username), uid, gid)
+            os.chown(auth_file, uid, gid)
+        except (ValueError, OSError):
             # chown failed
             pass
 
     def _add_user(self, message):
-        # Add user
-        if message.sudo:
-            add_command = 'useradd -mU -G sudo {username}'
-        else:
-            add_command = 'useradd -mU {username}'
-        add_command = add_command.format(username=message.username)
-
         # Check if a user exists
-        feedback = self._chk_user(message, FeedbackMessage.INFO, False)
+        try:
+            feedback = self._chk_user(message, FeedbackMessage.INFO, False)
+        except BastioProvisionError as ex:
+            return message.reply(ex.message, FeedbackMessage.ERROR)
         if feedback:
-            self._create_ssh(message)
-            return feedback
-
-        # Create the user
-        _, stderr = self._run_command(add_command)
-        if stderr:
-            feedback = message.reply(stderr, FeedbackMessage.ERROR)
+            self._create_ssh(message.username)
+            if message.username in self._managed:
+                self._grant(message)
             return feedback
 
-        # Clear out user's password
-        _, stderr = self._run_command("passwd -d {username}".format(
-            username=message.username))
-        if stderr:
-            feedback = message.reply(stderr, FeedbackMessage.ERROR)
+        # Create the user without a password
+        try:
+            self._provisioner.add_user(message.username, message.sudo)
+        except BastioProvisionError as ex:
+            feedback = message.reply(ex.message, FeedbackMessage.ERROR)
             return feedback
 
-        self._create_ssh(message)
+        self._managed.add(message.username)
+        self._create_ssh(message.username)
+        self._grant(message)
         feedback = message.reply("{username} was created successfully".format(
             username=message.username), FeedbackMessage.SUCCESS)
         return feedback
 
     def _remove_user(self, message):
-        # Remove user
-        rm_command = 'userdel -r {username}'.format(username=message.username)
-
         # Check if a user exists
-        feedback = self._chk_user(message, FeedbackMessage.INFO, True)
+        try:
+            feedback = self._chk_user(message, FeedbackMessage.INFO, True)
+        except BastioProvisionError as ex:
+            return message.reply(ex.message, FeedbackMessage.ERROR)
         if feedback:
+            self._expiry.discard_user(message.username)
             return feedback
 
         # Try to remove the user
-        _, stderr = self._run_command(rm_command)
-        if stderr:
-            feedback = message.reply(stderr, FeedbackMessage.ERROR)
-        else:
+        try:
+            self.remove_user(message.username)
             feedback = message.reply(
                     "{username} was removed successfully".format(
                         username=message.username), FeedbackMessage.SUCCESS)
+        except BastioProvisionError as ex:
+            feedback = message.reply(ex.message, FeedbackMessage.ERROR)
         return feedback
 
     def _update_user(self, message):
-        # Update user
-        flag = '-a' if message.sudo else '-d'
-        update_command = 'gpasswd {flag} {username} sudo'.format(flag=flag,
-                username=message.username)
-
         # Check if a user exists
-        feedback = self._chk_user(message, FeedbackMessage.ERROR, True)
+        try:
+            feedback = self._chk_user(message, FeedbackMessage.ERROR, True)
+        except BastioProvisionError as ex:
+            return message.reply(ex.message, FeedbackMessage.ERROR)
         if feedback:
             return feedback
 
         # Update a user either to give it root access or to demote it
-        _, stderr = self._run_command(update_command)
-        if stderr:
-            feedback = message.reply(stderr, FeedbackMessage.ERROR)
-        else:
+        try:
+            self.set_sudo(message.username, message.sudo)
             if message.sudo:
                 fb_str = '{username} was added to the sudo group successfully'
             else:
                 fb_str = '{username} was removed from the sudo group successfully'
             feedback = message.reply(fb_str.format(username=message.username),
                     FeedbackMessage.SUCCESS)
+        except BastioProvisionError as ex:
+            feedback = message.reply(ex.message, FeedbackMessage.ERROR)
         return feedback
 
     def _add_key(self, message):
         # Add public key
-        pubkey = message.public_key
-        username = message.username
-
-        # Check if a user exists
-        feedback = self._chk_user(message, FeedbackMessage.ERROR, True)
-        if feedback:
-            return feedback
-
-        # Check if public key already exists
-        if self._chk_key(message):
-            feedback = message.reply(
-                    "public key `{pub_key}` for {username} already exists".format(
-                        pub_key=pubkey, username=username),
-                    FeedbackMessage.INFO)
-            return feedback
-
-        # Try to add the public key to the user's authorized_keys file
-        auth_file = self._authkeys.format(username=username)
-        try:
-            with open(auth_file, 'ab') as fd:
-                fd.write(pubkey + '\n')
-            feedback = message.reply(
-                    "added public key to {username} successfully".format(
-                        username=username), FeedbackMessage.SUCCESS)
-        except IOError as ex:
-            feedback = message.reply(ex.strerror, FeedbackMessage.ERROR)
-        except Exception as ex:
-            feedback = message.reply(ex.message, FeedbackMessage.ERROR)
-        return feedback
+        return self._apply_keys([message])[0]
 
     def _remove_key(self, message):
         # Remove public key
-        pubkey = message.public_key
-        username = message.username
+        return self._apply_keys([message])[0]
+
+    def _apply_keys(self, messages):
+        # Apply key actions of the same user in a single rewrite of the user's
+        # authorized_keys file
+        username = messages[0].username
+        feedbacks = {}
+        keys = {}
+        for idx, message in enumerate(messages):
+            try:
+                keys[idx] = self._parse_key(message.public_key)
+            except BastioAuthKeysError as ex:
+                feedbacks[idx] = message.reply(ex.message, FeedbackMessage.ERROR)
+        valid = [idx for idx in range(len(messages)) if idx in keys]
 
         # Check if a user exists
-        feedback = self._chk_user(message, FeedbackMessage.ERROR, True)
+        try:
+            feedback = self._chk_user(messages[0], FeedbackMessage.ERROR, True)
+        except BastioProvisionError as ex:
+            feedback = messages[0].reply(ex.message, FeedbackMessage.ERROR)
+        else:
+            if feedback:
+                # Keys of a user that does not exist are gone already
+                for idx in valid:
+                    if isinstance(messages[idx], RemoveKeyMessage):
+                        self._expiry.discard(username, keys[idx].fingerprint)
         if feedback:
-            return feedback
+            return [feedbacks.get(idx) or message.reply(feedback.feedback,
+                feedback.status) for idx, message in enumerate(messages)]
 
-        # Check if public key does not exist
-        if not self._chk_key(message):
-            feedback = message.reply(
-                    "public key for {username} does not exist".format(
-                        username=username), FeedbackMessage.INFO)
-            return feedback
+        changes = []
+        for idx in valid:
+            if isinstance(messages[idx], AddKeyMessage):
+                changes.append((AuthorizedKeysWriter.ADD, keys[idx]))
+            else:
+                changes.append((AuthorizedKeysWriter.REMOVE, keys[idx].fingerprint))
+        try:
+            results = self.write_keys(username, changes) if changes else []
+        except (BastioAuthKeysError, BastioProvisionError) as ex:
+            for idx in valid:
+                feedbacks[idx] = messages[idx].reply(ex.message,
+                        FeedbackMessage.ERROR)
+            return [feedbacks[idx] for idx in range(len(messages))]
 
-        # Try to remove the public key from the user's authorized_keys file
-        auth_data = []
-        auth_file = self._authkeys.format(username=username)
+        for idx, changed in zip(valid, results):
+            message = messages[idx]
+            if isinstance(message, AddKeyMessage):
+                self._grant(message)
+            if isinstance(message, AddKeyMessage) and changed:
+                feedback = message.reply(
+                        "added public key to {username} successfully".format(
+                            username=username), FeedbackMessage.SUCCESS)
+            elif isinstance(message, AddKeyMessage):
+                feedback = message.reply(
+                        "public key `{pub_key}` for {username} already exists".format(
+                            pub_key=message.public_key, username=username),
+                        FeedbackMessage.INFO)
+            elif changed:
+                feedback = message.reply(
+                        "removed public key from {username} successfully".format(
+                            username=username), FeedbackMessage.SUCCESS)
+            else:
+                feedback = message.reply(
+                        "public key for {username} does not exist".format(
+                            username=username), FeedbackMessage.INFO)
+            feedbacks[idx] = feedback
+        return [feedbacks[idx] for idx in range(len(messages))]
+
+    def _grant(self, message):
+        # Schedule the expiry of the access an action granted, an action
+        # without one makes the access permanent
+        fingerprint = None
+        public_key = getattr(message, 'public_key', None)
+        if public_key is not None:
+            fingerprint = self._parse_key(public_key).fingerprint
+        if message.expires() is not None:
+            self._expiry.add(message.username, message.expires(), public_key)
+        else:
+            self._expiry.discard(message.username, fingerprint)
+
+    def _refresh_digest(self, username):
+        # Bring the bucket of a user in the state digest up to date
         try:
-            with open(auth_file, 'rb') as fd:
-                for line in fd.readlines():
-                    if pubkey in line:
-                        continue
-                    auth_data.append(line)
-            with open(auth_file, 'wb') as fd:
-                # TODO: A race condition is possible here where the file could
-                # be written to before we write to it and therefore overriding
-                # the changes made to it by some other application. Find a fix
-                # for it. This is quite unlikely in this particular case so
-                # don't sweat it.
-                fd.writelines(auth_data)
-            feedback = message.reply(
-                    "removed public key from {username} successfully".format(
-                        username=username), FeedbackMessage.SUCCESS)
-        except IOError as ex:
-            feedback = message.reply(ex.strerror, FeedbackMessage.ERROR)
-        except Exception as ex:
-            feedback = message.reply(ex.message, FeedbackMessage.ERROR)
+            if username not in self._managed or not self.has_user(username):
+                self._digest.remove_user(username)
+                return
+            sudo = self.is_sudo(username)
+        except BastioProvisionError as ex:
+            # A user that can't be read shows up as drift
+            self._logger.warning("unable to read the account of {}: {}".format(
+                username, ex.message))
+            self._digest.remove_user(username)
+            return
+        try:
+            fingerprints = [key.fingerprint for key in self.read_keys(username)]
+        except BastioAuthKeysError:
+            # Keys that can't be read show up as drift
+            fingerprints = []
+        self._digest.set_user(username, sudo, fingerprints)
+
+    def _state_digest(self, message):
+        feedback = message.reply("state digest of {} managed users".format(
+            len(self._digest)), FeedbackMessage.SUCCESS)
+        feedback.digest = self._digest.node(message.prefix)
         return feedback
 
-    @staticmethod
-    def _run_command(command, input_data=None):
+    def _sync_state(self, message):
         try:
-            po = subprocess.Popen(args=command, shell=True, stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = po.communicate(input_data)
-        except OSError as ex:
-            stderr = ex.strerror
-        except ValueError as ex:
-            stderr = ex.message
-        return stdout, stderr
+            plan = self._reconciler.diff(message.users)
+        except BastioProvisionError as ex:
+            return message.reply(ex.message, FeedbackMessage.ERROR)
+        errors = self._reconciler.apply(plan)
+        for username in plan.users + plan.remove:
+            self._refresh_digest(username)
+        if errors:
+            return message.reply("state was partially synchronized: {}".format(
+                '; '.join(errors)), FeedbackMessage.ERROR)
+        if not plan.changes():
+            return message.reply("state is already synchronized",
+                    FeedbackMessage.INFO)
+        return message.reply(("state was synchronized successfully: {} users added, "
+            "{} removed, {} updated and {} keys changed").format(len(plan.add),
+                len(plan.remove), len(plan.sudo), plan.key_changes()),
+            FeedbackMessage.SUCCESS)
 
 ###
 ###  END COMMAND METHODS
 ###
 
+
+@public
+class ReplayCache(object):
+    """A bounded cache of the feedback of processed messages by MID, so that
+    a message the backend sends again gets the same answer right away. Entries
+    expire ``ttl`` seconds after they were stored, and the least recently used
+    entry is evicted once there are ``capacity`` entries. Hits and evictions
+    are tracked by the ``replay_cache.hits`` and ``replay_cache.evictions``
+    metrics respectively.
+
+    :param capacity:
+        The maximum number of entries.
+    :type capacity:
+        int
+    :param ttl:
+        The number of seconds an entry is kept.
+    :type ttl:
+        float
+    """
+    Capacity = 4096
+    TTL = 3600.0
+
+    def __init__(self, capacity=Capacity, ttl=TTL):
+        if capacity < 1:
+            raise BastioConfigError("replay_cache_size must be a positive integer")
+        self._capacity = capacity
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        metrics = GlobalMetrics()
+        self._hits = metrics.counter('replay_cache.hits')
+        self._evictions = metrics.counter('replay_cache.evictions')
+
+    def get(self, mid):
+        """Return the entry of a MID or None."""
+        with self._lock:
+            entry = self._entries.pop(mid, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.time():
+                return None
+            # Most recently used entries are kept last
+            self._entries[mid] = entry
+            self._hits.inc()
+            return value
+
+    def put(self, mid, value):
+        """Store the entry of a MID."""
+        with self._lock:
+            self._entries.pop(mid, None)
+            self._entries[mid] = (value, time.time() + self._ttl)
+            while len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+                self._evictions.inc()
+
+    def __len__(self):
+        return len(self._entries)
+
+@public
+class ManagedRegistry(object):
+    """The names of the users managed by the agent, which are the users a
+    sync-state may remove. Users are managed once the agent created them or
+    once a sync-state listed them, and every user is a record of a journal.
+
+    :param journal:
+        The journal that persists the names, a journal named ``JournalName``
+        in the state directory by default.
+    :type journal:
+        :class:`bastio.journal.Journal`
+    """
+    JournalName = 'managed.journal'
+
+    def __init__(self, journal=None):
+        self._journal = journal if journal is not None else \
+                Journal.open(self.JournalName)
+
+    def add(self, username):
+        """Start managing a user."""
+        if username not in self._journal:
+            self._journal.append(username, '')
+            self._journal.sync()
+
+    def discard(self, username):
+        """Stop managing a user."""
+        if username in self._journal:
+            self._journal.ack(username)
+            self._journal.sync()
+
+    def __contains__(self, username):
+        return username in self._journal
+
+    def __iter__(self):
+        return iter([str(username) for username, _ in self._journal.replay()])
+
+    def stop(self):
+        """Flush the journal to disk."""
+        self._journal.stop()
+
+@public
+class Reconciler(object):
+    """Bring the local users to the desired state of a
+    :class:`bastio.ssh.protocol.SyncStateMessage` with the smallest set of
+    changes. The state is compared to the index of the local accounts and to
+    the keys of every user, and only the differences are applied: users that
+    are managed but not desired are removed first, then users that are missing
+    are added in a single batch of the provisioner, the sudo group is updated
+    for users whose membership differs, and the keys of every user that
+    differ are changed with a single write per user. Changes to the account
+    databases are applied one after the other, while the keys of different
+    users are written concurrently, see
+    :class:`bastio.concurrency.KeyedExecutor`. The number of changes of
+    every sync-state is tracked by the ``reconciler.changes`` metric.
+
+    Only users the agent created are managed, so local users that were
+    desired once (e.g., administrators) are never removed by a later
+    sync-state that leaves them out.
+
+    :param processor:
+        The processor to apply changes through.
+    :type processor:
+        :class:`Processor`
+    """
+
+    class Plan(collections.namedtuple('Plan', 'add remove sudo keys users')):
+        """The changes to apply, which are the ``(username, sudo)`` of the users
+        to add, the names of the users to remove, the ``(username, sudo)`` of
+        the users to add to or remove from the sudo group and the key changes
+        of every user (see
+        :func:`bastio.ssh.authkeys.AuthorizedKeysWriter.apply`), along with the
+        names of the desired users.
+        """
+
+        def key_changes(self):
+            """Return the number of key changes."""
+            return sum(len(changes) for changes in self.keys.itervalues())
+
+        def changes(self):
+            """Return the number of changes."""
+            return len(self.add) + len(self.remove) + len(self.sudo) + \
+                    self.key_changes()
+
+    def __init__(self, processor):
+        self._proc = processor
+        self._logger = Logger()
+        self._executor = KeyedExecutor(name='reconciler')
+        self._changes = GlobalMetrics().stats('reconciler.changes')
+
+    def diff(self, users):
+        """Compute the changes that bring the local users to a desired state.
+
+        :param users:
+            The ``users`` of a sync-state message.
+        :type users:
+            list
+        :returns:
+            :class:`Reconciler.Plan`
+        """
+        proc = self._proc
+        desired = dict((str(user['username']), user) for user in users)
+        plan = Reconciler.Plan([], [], [], {}, sorted(desired))
+        for username in proc.managed:
+            if username not in desired and proc.has_user(username):
+                plan.remove.append(username)
+        for username in plan.users:
+            user = desired[username]
+            keys = []
+            for line in user.get('keys', []):
+                key = AuthorizedKey.parse(str(line))
+                if key is not None:
+                    keys.append(key)
+            if not proc.has_user(username):
+                plan.add.append((username, user['sudo']))
+                current = AuthorizedKeys(None)
+            else:
+                if proc.is_sudo(username) != user['sudo']:
+                    plan.sudo.append((username, user['sudo']))
+                try:
+                    current = proc.read_keys(username)
+                except BastioAuthKeysError as ex:
+                    self._logger.warning("unable to read the keys of {}: {}".format(
+                        username, ex.message))
+                    current = AuthorizedKeys(None)
+            fingerprints = set(key.fingerprint for key in keys)
+            changes = [(AuthorizedKeysWriter.REMOVE, key.fingerprint)
+                    for key in current if key.fingerprint not in fingerprints]
+            changes.extend((AuthorizedKeysWriter.ADD, key) for key in keys
+                    if key.fingerprint not in current)
+            if changes:
+                plan.keys[username] = changes
+        return plan
+
+    def apply(self, plan):
+        """Apply the changes of a plan, carrying on past the ones that fail.
+
+        :param plan:
+            The changes to apply.
+        :type plan:
+            :class:`Reconciler.Plan`
+        :returns:
+            A list of the errors of the changes that failed.
+        """
+        proc = self._proc
+        errors = []
+        failed = set()
+        # Revocations come first
+        for username in plan.remove:
+            try:
+                proc.remove_user(username)
+            except BastioProvisionError as ex:
+                errors.append(ex.message)
+        for username, sudo in plan.sudo:
+            if sudo:
+                continue
+            try:
+                proc.set_sudo(username, sudo)
+            except BastioProvisionError as ex:
+                errors.append(ex.message)
+        if plan.add:
+            results = proc.add_users(plan.add)
+            for (username, _), result in zip(plan.add, results):
+                if result is not None:
+                    errors.append(result.message)
+                    failed.add(username)
+        for username, sudo in plan.sudo:
+            if not sudo:
+                continue
+            try:
+                proc.set_sudo(username, sudo)
+            except BastioProvisionError as ex:
+                errors.append(ex.message)
+        errors.extend(self._write_keys(dict((username, changes)
+            for username, changes in plan.keys.iteritems()
+            if username not in failed)))
+        self._changes.add(plan.changes())
+        return errors
+
+    def _write_keys(self, keys):
+        """Write the key changes of every user concurrently and return the
+        errors of the writes that failed in order of the users' names.
+        """
+        errors = {}
+        done = threading.Semaphore(0)
+        def write(username, changes):
+            try:
+                self._proc.write_keys(username, changes)
+            except (BastioAuthKeysError, BastioProvisionError) as ex:
+                errors[username] = ex.message
+            finally:
+                done.release()
+        for username, changes in keys.iteritems():
+            self._executor.submit(username, write, username, changes)
+        for x in range(len(keys)):
+            done.acquire()
+        return [errors[username] for username in sorted(errors)]
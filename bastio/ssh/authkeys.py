@@ -0,0 +1,367 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.ssh.authkeys
+:synopsis: A parsed model of OpenSSH authorized_keys files.
+:author: Amr Ali <amr@databracket.com>
+
+.. autoclass:: AuthorizedKey
+    :members:
+
+.. autoclass:: AuthorizedKeys
+    :members:
+
+.. autoclass:: AuthorizedKeysCache
+    :members:
+
+.. autoclass:: AuthorizedKeysWriter
+    :members:
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import errno
+import base64
+import hashlib
+import binascii
+import threading
+
+from bastio.mixin import public
+from bastio.metrics import GlobalMetrics
+from bastio.fsutil import atomic_write, DirectoryLock
+from bastio.excepts import BastioAuthKeysError, BastioLockError
+
+@public
+class AuthorizedKey(object):
+    """A key entry of an ``authorized_keys`` file, see ``sshd(8)``.
+
+    :param keytype:
+        The type of the key (e.g., ``ssh-rsa``).
+    :type keytype:
+        str
+    :param blob:
+        The base64 encoded key.
+    :type blob:
+        str
+    :param options:
+        The options of the entry as they appear in the file or None.
+    :type options:
+        str
+    :param comment:
+        The comment of the entry or None.
+    :type comment:
+        str
+    """
+
+    def __init__(self, keytype, blob, options=None, comment=None):
+        self.keytype = keytype
+        self.blob = blob
+        self.options = options
+        self.comment = comment
+        try:
+            self._raw = base64.b64decode(blob)
+        except (TypeError, binascii.Error):
+            raise BastioAuthKeysError("invalid key data")
+
+    @property
+    def fingerprint(self):
+        """The ``SHA256:`` fingerprint of the key as printed by
+        ``ssh-keygen -l``.
+        """
+        digest = base64.b64encode(hashlib.sha256(self._raw).digest())
+        return 'SHA256:' + digest.rstrip('=')
+
+    @staticmethod
+    def _is_keytype(word):
+        return word.startswith(('ssh-', 'ecdsa-', 'sk-')) or '-cert-' in word
+
+    @classmethod
+    def parse(cls, line):
+        """Parse a line of an ``authorized_keys`` file.
+
+        :param line:
+            The line to parse.
+        :type line:
+            str
+        :returns:
+            :class:`AuthorizedKey` or None if the line is empty or a comment.
+        :raises:
+            :class:`bastio.excepts.BastioAuthKeysError`
+        """
+        line = line.strip()
+        if not line or line.startswith('#'):
+            return None
+        options = None
+        if not cls._is_keytype(line.split(None, 1)[0]):
+            # Options end at the first whitespace that is not quoted
+            quoted = False
+            for idx, char in enumerate(line):
+                if char == '"' and (idx == 0 or line[idx - 1] != '\\'):
+                    quoted = not quoted
+                elif char in ' \t' and not quoted:
+                    break
+            else:
+                raise BastioAuthKeysError("key is missing")
+            if quoted:
+                raise BastioAuthKeysError("unterminated quote in options")
+            options, line = line[:idx], line[idx:].strip()
+        parts = line.split(None, 2)
+        if len(parts) < 2 or not cls._is_keytype(parts[0]):
+            raise BastioAuthKeysError("key type or data is missing")
+        return cls(parts[0], parts[1], options, parts[2] if len(parts) > 2 else None)
+
+    def __str__(self):
+        return ' '.join(x for x in (self.options, self.keytype, self.blob,
+            self.comment) if x)
+
+@public
+class AuthorizedKeys(object):
+    """The entries of an ``authorized_keys`` file indexed by fingerprint.
+    Lines that are not keys (e.g., comments or lines that do not parse) are
+    kept untouched.
+
+    :param path:
+        The path of the file.
+    :type path:
+        str
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lines = []
+        self._index = {}
+
+    @property
+    def path(self):
+        return self._path
+
+    def load(self, source=None):
+        """Read the file, a missing file is read as an empty one. A symbolic
+        link is never followed.
+
+        :param source:
+            The path to read the file from, the path of the file by default.
+        :type source:
+            str
+        :raises:
+            :class:`bastio.excepts.BastioAuthKeysError`
+        """
+        try:
+            fd = os.open(source or self._path, os.O_RDONLY | os.O_NOFOLLOW)
+            with os.fdopen(fd, 'rb') as fobj:
+                data = fobj.read()
+        except (IOError, OSError) as ex:
+            if ex.errno != errno.ENOENT:
+                raise BastioAuthKeysError("unable to read `{}`: {}".format(
+                    self._path, ex.strerror))
+            data = ''
+        self.parse(data)
+
+    def parse(self, data):
+        """Replace the entries with the ones in ``data``."""
+        self._lines = []
+        self._index = {}
+        for line in data.splitlines():
+            try:
+                key = AuthorizedKey.parse(line)
+            except BastioAuthKeysError:
+                key = None
+            if key is None:
+                self._lines.append(line)
+                continue
+            self._index.setdefault(key.fingerprint, []).append(len(self._lines))
+            self._lines.append(key)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        for line in self._lines:
+            if isinstance(line, AuthorizedKey):
+                yield line
+
+    def get(self, fingerprint):
+        """Return the first entry of a key or None."""
+        if fingerprint not in self._index:
+            return None
+        return self._lines[self._index[fingerprint][0]]
+
+    def add(self, key):
+        """Append a key unless it's already there and return whether it was
+        added.
+        """
+        if key.fingerprint in self._index:
+            return False
+        self._index[key.fingerprint] = [len(self._lines)]
+        self._lines.append(key)
+        return True
+
+    def remove(self, fingerprint):
+        """Remove every entry of a key and return whether there was any."""
+        if fingerprint not in self._index:
+            return False
+        for idx in self._index.pop(fingerprint):
+            self._lines[idx] = None
+        return True
+
+    def copy(self):
+        """Return a copy of the entries."""
+        keys = AuthorizedKeys(self._path)
+        keys._lines = list(self._lines)
+        keys._index = dict((k, list(v)) for k, v in self._index.iteritems())
+        return keys
+
+    def render(self):
+        """Return the content of the file."""
+        return ''.join('{}\n'.format(line) for line in self._lines
+                if line is not None)
+
+@public
+class AuthorizedKeysCache(object):
+    """A cache of parsed ``authorized_keys`` files. A file is read again only
+    if its inode, modification time or size changed since it was last read,
+    which is tracked by the ``authkeys.reloads`` metric.
+
+    Entries returned by :func:`AuthorizedKeysCache.get` must not be changed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._reloads = GlobalMetrics().counter('authkeys.reloads')
+
+    def get(self, path, source=None):
+        """Return the parsed file at ``path``.
+
+        :param source:
+            The path to read the file from, ``path`` by default.
+        :type source:
+            str
+        :returns:
+            :class:`AuthorizedKeys`
+        :raises:
+            :class:`bastio.excepts.BastioAuthKeysError`
+        """
+        signature = self._signature(source or path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry[0] == signature:
+                return entry[1]
+        keys = AuthorizedKeys(path)
+        keys.load(source)
+        with self._lock:
+            # Loading after the stat may only cause an extra reload
+            self._entries[path] = (signature, keys)
+        self._reloads.inc()
+        return keys
+
+    def put(self, path, st, keys):
+        """Cache the entries of the file at ``path`` as it was written.
+
+        :param st:
+            The :func:`os.stat` result of the file as it was written.
+        :type st:
+            :class:`posix.stat_result`
+        """
+        with self._lock:
+            self._entries[path] = (self._stat_signature(st), keys)
+
+    def invalidate(self, path):
+        """Forget the file at ``path``."""
+        with self._lock:
+            self._entries.pop(path, None)
+
+    @staticmethod
+    def _signature(path):
+        try:
+            st = os.lstat(path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise BastioAuthKeysError("unable to stat `{}`: {}".format(
+                    path, ex.strerror))
+            return None
+        return AuthorizedKeysCache._stat_signature(st)
+
+    @staticmethod
+    def _stat_signature(st):
+        return (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+
+@public
+class AuthorizedKeysWriter(object):
+    """Apply changes to ``authorized_keys`` files. All the changes to a file
+    are applied at once while holding a lock on its directory. The new
+    content is written to a temporary file that is flushed to disk and renamed
+    over the file, so readers such as ``sshd`` never see a partial file and a
+    crash never leaves one behind. The file is read and written through the
+    locked directory rather than its path, so a user that swaps the directory
+    for a symbolic link can't redirect the write. The number of rewrites is
+    tracked by the ``authkeys.writes`` metric.
+
+    :param cache:
+        The cache to read the files from and to update with the new entries.
+    :type cache:
+        :class:`AuthorizedKeysCache`
+    """
+    ADD = 'add'
+    REMOVE = 'remove'
+    LockTimeout = 15.0
+
+    def __init__(self, cache=None):
+        self._cache = cache if cache is not None else AuthorizedKeysCache()
+        self._writes = GlobalMetrics().counter('authkeys.writes')
+
+    def apply(self, path, changes, owner=None):
+        """Apply a list of changes to a file in order.
+
+        :param path:
+            The path of the file.
+        :type path:
+            str
+        :param changes:
+            A list of ``(AuthorizedKeysWriter.ADD, key)`` or
+            ``(AuthorizedKeysWriter.REMOVE, fingerprint)`` tuples.
+        :type changes:
+            list
+        :param owner:
+            The ``(uid, gid)`` of the file if it has to be created.
+        :type owner:
+            tuple
+        :returns:
+            A list of whether every change changed the entries, that is
+            whether an added key was not there already and whether a removed
+            key was there.
+        :raises:
+            :class:`bastio.excepts.BastioAuthKeysError`
+        """
+        dirname = os.path.dirname(path)
+        if all(op == self.REMOVE for op, _ in changes) and \
+                not os.path.lexists(dirname):
+            # There is nothing to remove from a directory that doesn't exist
+            return [False] * len(changes)
+        try:
+            with DirectoryLock(dirname, self.LockTimeout) as lock:
+                source = lock.entry(os.path.basename(path))
+                keys = self._cache.get(path, source).copy()
+                results = []
+                for op, arg in changes:
+                    if op == self.ADD:
+                        results.append(keys.add(arg))
+                    else:
+                        results.append(keys.remove(arg))
+                if any(results):
+                    st = atomic_write(source, keys.render(), 0600, owner)
+                    self._cache.put(path, st, keys)
+                    self._writes.inc()
+                return results
+        except BastioLockError as ex:
+            raise BastioAuthKeysError(ex.message)
+        except (IOError, OSError) as ex:
+            raise BastioAuthKeysError("unable to write `{}`: {}".format(path,
+                ex.strerror))
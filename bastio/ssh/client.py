@@ -24,10 +24,14 @@ from bastio import __version__
 from bastio.log import Logger
 from bastio.mixin import KindSingletonMeta, public
 from bastio.configs import GlobalConfigStore
-from bastio.concurrency import GlobalThreadPool, Task
-from bastio.ssh.protocol import Netstring, MessageParser, ProtocolMessage
+from bastio.metrics import GlobalMetrics
+from bastio.journal import Journal
+from bastio.concurrency import GlobalThreadPool, Task, LaneQueue
+from bastio.ssh.dialer import Dialer
+from bastio.ssh.protocol import (Netstring, MessageParser, ProtocolMessage,
+        HeartbeatMessage, FlowControlMessage, AckMessage, ResumeMessage)
 from bastio.excepts import (BastioBackendError, BastioEOFError,
-        BastioNetstringError, BastioMessageError, reraise)
+        BastioNetstringError, BastioMessageError, BastioConfigError, reraise)
 
 # Set paramiko client ID
 paramiko.Transport._CLIENT_ID = "bastio-{}".format(__version__)
@@ -37,23 +41,102 @@ class BackendConnector(object):
     """A singleton to establish and maintain a secure connection with the backend
     over a specific subsystem channel. This connector supports registering of
     endpoints where processors can register their endpoint to communicate with
-    the backend. It is guaranteed that the messages will be delivered ASAP but
-    the actual ETA is chaotic.
+    the backend. All endpoints publish to the single egress queue owned by the
+    connector (see :attr:`BackendConnector.egress`). It is guaranteed that the
+    messages will be delivered ASAP but the actual ETA is chaotic.
+
+    The connector sends a heartbeat to the backend every ``heartbeat_interval``
+    seconds and drops the connection if nothing was received from the backend
+    for ``heartbeat_deadline`` seconds. The round-trip time of heartbeats is
+    tracked by the ``backend.rtt`` metric in seconds.
+
+    The backend host may be a comma separated list of ``host[:port]`` endpoints
+    and every address they resolve to is a candidate to connect to, see
+    :class:`bastio.ssh.dialer.Dialer`. If a reachable address fails the
+    connector fails over to the next address right away, and only backs off
+    when every address has failed.
+
+    The egress queue holds at most ``egress_limit`` messages. The connector
+    asks the backend to pause while the ingress queue of any endpoint is
+    throttled (see :class:`bastio.concurrency.LaneQueue`) but keeps reading
+    from the channel, so heartbeats and acknowledgements are always handled.
+    Messages that arrive while an ingress queue is full are held back until
+    there is room for them and are not acknowledged before, and the connection
+    is dropped if the backend sends more than ``ingress_hold_back`` of them.
+    The connector stops sending anything but control messages while the
+    backend asks the agent to pause.
+
+    Every message put in the egress queue is appended to a journal in the
+    agent's state directory until the backend acknowledges it, and messages
+    that were never acknowledged are sent again when the agent starts, which
+    means the backend may receive a message more than once (see
+    :class:`bastio.journal.Journal`).
+
+    Messages are sequenced and at most ``send_window`` of them may be waiting
+    for an acknowledgement from the backend at any time. Once reconnected the
+    connector resumes its session with the backend and sends again only the
+    messages the backend did not receive, while messages the backend sends
+    again are acknowledged but not delivered twice (see
+    :class:`bastio.ssh.protocol.ResumeMessage`).
     """
     __metaclass__ = KindSingletonMeta
     EndPoint = collections.namedtuple("EndPoint", "ingress egress")
     Subsystem = 'bastio-agent'
+    HeartbeatInterval = 5.0
+    HeartbeatDeadline = 15.0
+    ReconnectDelay = 1.0
+    MaxReconnectDelay = 60.0
+    EgressBurst = 64
+    EgressLimit = 1024
+    SendWindow = 64
+    IngressHoldBack = 64
+    JournalName = 'feedback.journal'
 
     def __init__(self):
         cfg = GlobalConfigStore()
         self._tp = GlobalThreadPool()
         self._username = cfg.agent_username
         self._agent_key = cfg.agentkey
-        self._backend_addr = (cfg.host, cfg.port)
+        self._dialer = Dialer(Dialer.parse_endpoints(cfg.host, cfg.port))
+        self._address = None
+        self._backoff = 0
         self._backend_hostkey = cfg.backend_hostkey
+        self._hb_interval = cfg.lookup('heartbeat_interval',
+                self.HeartbeatInterval, float)
+        self._hb_deadline = cfg.lookup('heartbeat_deadline',
+                self.HeartbeatDeadline, float)
+        self._hb_pending = {}
+        self._last_heartbeat = 0
+        self._last_recv = 0
+        self._rtt = GlobalMetrics().stats('backend.rtt')
         self._logger = Logger()
         self._endpoints = []
-        self._tx = queue.Queue()
+        self._journal = Journal.open(self.JournalName)
+        self._tx = LaneQueue(lanes=ProtocolMessage.PRIORITIES,
+                lane_of=lambda m: m.priority(),
+                key_of=lambda m: m.ordering_key(), name='egress',
+                maxsize=cfg.lookup('egress_limit', self.EgressLimit, int),
+                journal=self._journal, record_of=lambda m: (m.mid, m.to_json()))
+        self._paused = False
+        self._peer_paused = False
+        # Pairs of an endpoint and a message that did not fit in its ingress
+        self._held = collections.deque()
+        self._hold_back = cfg.lookup('ingress_hold_back', self.IngressHoldBack, int)
+        self._pauses = GlobalMetrics().counter('backend.pauses')
+        self._retransmit = collections.deque()
+        self._window = cfg.lookup('send_window', self.SendWindow, int)
+        if self._window < 1:
+            raise BastioConfigError("send_window must be a positive integer")
+        self._session = None
+        self._next_seq = 1
+        self._recv_seq = 0
+        self._ack_due = False
+        self._unacked = collections.deque()
+        metrics = GlobalMetrics()
+        self._unacked_gauge = metrics.counter('backend.unacked')
+        self._resent = metrics.counter('backend.retransmits')
+        self._duplicates = metrics.counter('backend.duplicates')
+        self._replay()
         self._conn_handler_task = None
         self._connected = False
         self._running = False
@@ -64,6 +147,7 @@ class BackendConnector(object):
         """Start the connection handler thread."""
         if not self._running:
             self._running = True
+            self._journal.start()
             t = Task(target=self.__conn_handler, infinite=True)
             t.failure = self._catch_fail
             self._conn_handler_task = self._tp.run(t)
@@ -74,27 +158,60 @@ class BackendConnector(object):
             self._running = False
             self.close()
             self._conn_handler_task.stop()
+            self._journal.stop()
+
+    @property
+    def egress(self):
+        """The egress queue shared by all endpoints of this connector."""
+        return self._tx
+
+    @property
+    def session(self):
+        """The session ID the backend assigned to this agent or None."""
+        return self._session
+
+    @property
+    def journal(self):
+        """The journal of messages the backend did not acknowledge yet."""
+        return self._journal
 
     def register(self, endpoint):
         """Register an endpoint to this connector to so that it can communicate
         with the backend. The endpoint is a tuple of one ingress queue as first
-        argument and egress as the second argument.
+        argument and egress as the second argument, where the egress queue must
+        be :attr:`BackendConnector.egress`.
 
         :param endpoint:
             A tuple of two queues; ingress and egress.
         :type endpoint:
             :class:`BackendConnector.EndPoint`
+        :raises:
+            :class:`bastio.excepts.BastioBackendError`
         """
+        if endpoint.egress is not self._tx:
+            raise BastioBackendError(
+                    "endpoint must publish to the connector's egress queue")
         self._endpoints.append(endpoint)
 
     def is_active(self):
-        """Check whether the transport is still active."""
+        """Check whether the transport is still active and the backend has
+        not been silent for longer than the heartbeat deadline.
+        """
         if self._client:
             t = self._client.get_transport()
             if t:
-                return t.is_active()
+                return t.is_active() and not self._is_silent()
         return False
 
+    @property
+    def rtt(self):
+        """The round-trip time statistics of the link with the backend.
+
+        :returns:
+            :class:`bastio.metrics.RollingStats`
+        """
+        return self._rtt
+
     def close(self):
         """Close open channels and transport."""
         if self._chan:
@@ -102,26 +219,76 @@ class BackendConnector(object):
         if self._client:
             self._client.close()
         self._connected = False
+        self._address = None
+        self._hb_pending.clear()
         self._logger.critical("connection lost with the backend")
 
     def __conn_handler(self, kill_ev):
         self._logger.warning("backend connection handler started")
         while not kill_ev.is_set():
+            # Put what was held back in ingress as far as there is room
+            self._drain_ingress()
+
             # Try to connect to the backend
             try:
                 self._connect()
             except BastioBackendError as ex:
+                address = self._address
                 self.close()
                 self._logger.critical(ex.message)
-                # TODO: Implement a more decent reconnection strategy
-                time.sleep(5) # Sleep 5 seconds before retrial
+                if address:
+                    # The backend was reachable but failed us, so try another
+                    # address right away if we have any
+                    self._dialer.mark_failed(address)
+                    if self._dialer.has_alternatives(address):
+                        continue
+                self._backoff = min(self._backoff * 2 or self.ReconnectDelay,
+                        self.MaxReconnectDelay)
+                kill_ev.wait(self._backoff)
+                continue
+
+            # Ask the backend to pause while any endpoint is overloaded
+            try:
+                self._flow_control()
+            except socket.timeout:
+                pass # Try again on the next round
+            except BastioEOFError:
+                self._logger.critical("flow control was not sent; channel closed")
+                self.close()
+                continue
+
+            # Detect a dead backend and keep the link latency measured
+            try:
+                self._heartbeat()
+            except socket.timeout:
+                pass # The deadline will catch it if the backend is unreachable
+            except BastioBackendError as ex:
+                self._logger.critical(ex.message)
+                self._dialer.mark_failed(self._address)
+                self.close()
+                continue
+            except BastioEOFError:
+                self._logger.critical("heartbeat was not sent; channel closed")
+                self.close()
                 continue
 
             # Read a message from the wire, parse it, and push it to ingress queue(s)
             try:
                 json_string = self._read_message()
                 message = MessageParser.parse(json_string)
-                self._put_ingress(message)
+                self._last_recv = time.time()
+                if isinstance(message, HeartbeatMessage):
+                    self._handle_heartbeat(message)
+                elif isinstance(message, AckMessage):
+                    self._handle_ack(message.ack)
+                elif isinstance(message, FlowControlMessage):
+                    self._peer_paused = message.pause
+                    self._logger.warning("backend asked to {} sending".format(
+                        'pause' if message.pause else 'resume'))
+                elif isinstance(message, ResumeMessage):
+                    raise BastioMessageError("unexpected session resume message")
+                elif self._sequence(message):
+                    self._put_ingress(message)
             except socket.timeout:
                 pass # No messages are ready to be read
             except BastioNetstringError as ex:
@@ -138,54 +305,67 @@ class BackendConnector(object):
                 self._logger.critical("received EOF on channel")
                 self.close()
                 continue
+            except BastioBackendError as ex:
+                self._logger.critical(ex.message)
+                self.close()
+                continue
 
-            # Get an item from the egress queue(s) and send it to the backend
+            # Acknowledge what we received so far
             try:
-                message = self._get_egress(timeout=0.01) # 10ms
-                if message == None:
-                    # No message is available to send
-                    continue
-                self._write_message(message.to_json())
+                self._send_ack()
             except socket.timeout:
-                # Too many un-ACK'd packets? Sliding window shut on our fingers?
-                # We don't really know what happened, lets reschedule the last
-                # message for retransmission anyway
-                self._push_queue(self._tx, message)
+                pass # Try again on the next round
             except BastioEOFError:
-                # Message was not sent because channel was closed
-                # re-push the message to the TX queue again and retry connection
-                self._push_queue(self._tx, message)
+                self._logger.critical("acknowledgement was not sent; channel closed")
                 self.close()
                 continue
 
+            # Send a burst of items from the egress queue to the backend unless
+            # it asked us to pause, control messages are sent regardless
+            if not self._peer_paused:
+                self._send_egress()
+
     def _connect(self):
         """An idempotent method to connect to the backend."""
         try:
             if self._connected:
                 return
+            # Race connections to all of the backend addresses
+            self._address, sock = self._dialer.dial()
+
             # Prepare host keys
             self._client = paramiko.SSHClient()
             hostkeys = self._client.get_host_keys()
-            hostkey_server_name = self._make_hostkey_entry_name(self._backend_addr)
+            hostkey_server_name = self._make_hostkey_entry_name(
+                    (self._address.host, self._address.port))
             hostkeys.add(hostkey_server_name, self._backend_hostkey.get_name(),
                     self._backend_hostkey)
 
             # Try to connect
-            self._client.connect(hostname=self._backend_addr[0],
-                    port=self._backend_addr[1], username=self._username,
+            self._client.connect(hostname=self._address.host,
+                    port=self._address.port, username=self._username,
                     pkey=self._agent_key, allow_agent=False,
-                    look_for_keys=False)
+                    look_for_keys=False, sock=sock)
             self._connected = True
 
             # Open session and establish the subsystem
             self._chan = self._invoke_bastio()
-            self._logger.critical("connection established with the backend")
+            self._resume()
+            self._last_recv = time.time()
+            self._last_heartbeat = 0
+            self._backoff = 0
+            self._paused = False
+            self._peer_paused = False
+            self._logger.critical("connection established with the backend ({})".format(
+                self._address.sockaddr[0]))
         except BastioBackendError:
             raise
         except paramiko.AuthenticationException:
             reraise(BastioBackendError, "authentication with backend failed")
         except paramiko.BadHostKeyException:
             reraise(BastioBackendError, "backend host key does not match")
+        except (BastioEOFError, BastioNetstringError, BastioMessageError) as ex:
+            reraise(BastioBackendError, "session resume failed: {}".format(ex.message))
         except socket.error as ex:
             reraise(BastioBackendError, ex.strerror.lower())
         except Exception:
@@ -207,31 +387,238 @@ class BackendConnector(object):
         chan.invoke_subsystem(self.Subsystem)
         return chan
 
+    def _resume(self):
+        """Resume the session with the backend or start a new one, see
+        :class:`bastio.ssh.protocol.ResumeMessage`.
+        """
+        self._write_message(ResumeMessage(session=self._session,
+            ack=self._ack_seq()).to_json(), blocking=True)
+        deadline = time.time() + self._hb_deadline
+        while True:
+            try:
+                message = MessageParser.parse(self._read_message())
+                break
+            except socket.timeout:
+                if time.time() > deadline:
+                    raise BastioBackendError("backend did not resume the session")
+        if not isinstance(message, ResumeMessage):
+            raise BastioMessageError("expected a session resume message")
+        if self._session is not None and message.session == self._session:
+            # Send again whatever the backend did not receive before anything else
+            self._handle_ack(message.ack)
+            pending = len(self._unacked)
+            self._retransmit.extendleft(reversed(self._unacked))
+            self._unacked.clear()
+            self._resent.inc(pending)
+            self._logger.warning("resumed session with the backend, {} messages "
+                    "to be sent again".format(pending))
+            return
+        # The backend does not know about this session, so start over and send
+        # everything that was not acknowledged with new sequence numbers
+        self._retransmit.extendleft(reversed(self._unacked))
+        self._unacked.clear()
+        for pending in self._retransmit:
+            pending.__dict__.pop('seq', None)
+        self._session = message.session
+        self._next_seq = 1
+        self._recv_seq = 0
+        self._ack_due = False
+        self._logger.warning("started a new session with the backend")
+
+    def _sequence(self, message):
+        """Check the sequence number of a received message and return whether
+        it should be delivered.
+        """
+        seq = getattr(message, 'seq', None)
+        if seq is None:
+            return True
+        if seq <= self._recv_seq:
+            # The backend sent it again after we resumed, it's already delivered
+            self._duplicates.inc()
+            self._ack_due = True
+            return False
+        if seq != self._recv_seq + 1:
+            raise BastioMessageError("expected sequence number {} but got {}".format(
+                self._recv_seq + 1, seq))
+        self._recv_seq = seq
+        self._ack_due = True
+        return True
+
+    def _ack_seq(self):
+        """Return the sequence number of the last message that was put in
+        ingress along with every message before it.
+        """
+        for _, message in self._held:
+            seq = getattr(message, 'seq', None)
+            if seq is not None:
+                return seq - 1
+        return self._recv_seq
+
+    def _send_ack(self):
+        if not self._ack_due:
+            return
+        self._write_message(AckMessage(ack=self._ack_seq()).to_json())
+        self._ack_due = False
+
+    def _handle_ack(self, ack):
+        """Forget about the messages the backend acknowledged."""
+        while self._unacked and self._unacked[0].seq <= ack:
+            self._journal.ack(self._unacked.popleft().mid)
+        self._unacked_gauge.set(len(self._unacked))
+
+    def _send_egress(self):
+        burst = self.EgressBurst
+        while burst and len(self._unacked) < self._window:
+            message = self._get_egress(timeout=0.01 if burst == self.EgressBurst else 0)
+            if message is None:
+                break
+            if getattr(message, 'seq', None) is None:
+                message.seq = self._next_seq
+                self._next_seq += 1
+            try:
+                self._write_message(message.to_json())
+            except socket.timeout:
+                # Nothing was written since the channel's window is shut, try
+                # again on the next round with the same sequence number
+                self._retransmit.appendleft(message)
+                break
+            except BastioEOFError:
+                # The message might have been sent before the channel was
+                # closed, the backend will tell us once we resume the session
+                self._unacked.append(message)
+                self.close()
+                break
+            self._unacked.append(message)
+            burst -= 1
+        self._unacked_gauge.set(len(self._unacked))
+
+    def _flow_control(self):
+        """Ask the backend to pause once the ingress queue of any endpoint is
+        throttled and to resume once none of them is.
+        """
+        throttled = bool(self._held) or any(getattr(endpoint.ingress,
+            'throttled', bool)() for endpoint in self._endpoints)
+        if throttled == self._paused:
+            return
+        self._write_message(FlowControlMessage(pause=throttled).to_json())
+        self._paused = throttled
+        if throttled:
+            self._pauses.inc()
+            self._logger.warning("ingress is above its high watermark, pausing the backend")
+        else:
+            self._logger.warning("ingress is below its low watermark, resuming the backend")
+
+    def _is_silent(self):
+        return bool(self._last_recv) and \
+                time.time() - self._last_recv > self._hb_deadline
+
+    def _heartbeat(self):
+        """Send a heartbeat if one is due and raise an error if the backend
+        has been silent for longer than the deadline.
+        """
+        now = time.time()
+        if self._is_silent():
+            raise BastioBackendError(
+                    "backend has been silent for {:.1f} seconds".format(
+                        now - self._last_recv))
+        if now - self._last_heartbeat < self._hb_interval:
+            return
+        # Forget about heartbeats that will never be echoed back
+        for mid, sent in self._hb_pending.items():
+            if now - sent > self._hb_deadline:
+                del self._hb_pending[mid]
+        heartbeat = HeartbeatMessage()
+        self._last_heartbeat = now
+        self._hb_pending[heartbeat.mid] = now
+        self._write_message(heartbeat.to_json())
+
+    def _handle_heartbeat(self, heartbeat):
+        if not heartbeat.echo:
+            # The backend is probing us, echo it back right away
+            self._write_message(heartbeat.make_echo().to_json())
+            return
+        sent = self._hb_pending.pop(heartbeat.mid, None)
+        if sent is not None:
+            rtt = time.time() - sent
+            self._rtt.add(rtt)
+            self._dialer.record_rtt(self._address, rtt)
+            self._logger.debug("backend round-trip time is {:.1f}ms".format(
+                rtt * 1000))
+
     def _read_message(self):
         nets = Netstring(self._chan)
         return nets.recv()
 
-    def _write_message(self, data):
+    def _write_message(self, data, blocking=False):
+        """Write a whole message to the channel. A :class:`socket.timeout` is
+        raised only if nothing was written unless ``blocking`` is set, otherwise
+        the rest is written within the heartbeat deadline so that a partial
+        message never stays on the wire.
+        """
         nets = Netstring.compose(data)
-        remaining = len(nets)
-        while remaining > 0:
-            n = self._chan.send(nets)
+        deadline = time.time() + self._hb_deadline
+        sent = 0
+        while sent < len(nets):
+            try:
+                n = self._chan.send(nets[sent:])
+            except socket.timeout:
+                if not (sent or blocking):
+                    raise
+                if time.time() > deadline:
+                    raise BastioEOFError("timed out writing to channel")
+                continue
             if n <= 0:
                 raise BastioEOFError("channel closed")
-            remaining -= n
+            sent += n
+
+    def _replay(self):
+        """Schedule the messages the backend did not acknowledge before the
+        agent was last stopped to be sent first.
+        """
+        for mid, data in self._journal.replay():
+            try:
+                self._retransmit.append(MessageParser.parse(data))
+            except BastioMessageError as ex:
+                self._logger.critical("dropping journaled message `{}`: {}".format(
+                    mid, ex.message))
+                self._journal.ack(mid)
+        if self._retransmit:
+            self._logger.warning("replaying {} unacknowledged messages".format(
+                len(self._retransmit)))
 
     def _put_ingress(self, item):
-        for endpoint in self._endpoints:
-            endpoint.ingress.put(item)
+        """Put a message in the ingress queue of every endpoint without
+        blocking, holding it back behind the messages that are already held.
 
-    def _get_egress(self, timeout):
+        :raises:
+            :class:`bastio.excepts.BastioBackendError`
+        """
         for endpoint in self._endpoints:
+            self._held.append((endpoint, item))
+        self._drain_ingress()
+        if len(self._held) > self._hold_back:
+            raise BastioBackendError("backend sent {} messages past a full "
+                    "ingress queue".format(len(self._held)))
+
+    def _drain_ingress(self):
+        """Put held back messages in ingress in order as long as there is room
+        for them.
+        """
+        while self._held:
+            endpoint, item = self._held[0]
             try:
-                item = endpoint.egress.get_nowait()
-                self._tx.put(item)
-            except queue.Empty:
-                pass
+                endpoint.ingress.put(item, block=False)
+            except queue.Full:
+                break
+            self._held.popleft()
+            self._ack_due = True
+
+    def _get_egress(self, timeout):
+        if self._retransmit:
+            return self._retransmit.popleft()
         try:
+            if not timeout:
+                return self._tx.get_nowait()
             return self._tx.get(timeout=timeout)
         except queue.Empty:
             return None
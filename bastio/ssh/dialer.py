@@ -0,0 +1,239 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.ssh.dialer
+:synopsis: A module to resolve backend endpoints and race connections to them.
+:author: Amr Ali <amr@databracket.com>
+
+.. autoclass:: Dialer
+    :members:
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import time
+import errno
+import select
+import socket
+import collections
+
+from bastio.mixin import public
+from bastio.metrics import RollingStats
+from bastio.excepts import BastioBackendError
+
+Endpoint = collections.namedtuple("Endpoint", "host port")
+Address = collections.namedtuple("Address", "host port family sockaddr")
+
+@public
+class Dialer(object):
+    """Resolve every address of a list of backend endpoints and race connection
+    attempts to them Happy Eyeballs style; an attempt is started every
+    ``stagger`` seconds until one of them succeeds, and the first one to connect
+    wins while the others are abandoned.
+
+    Addresses are attempted in order of their measured round-trip time, where
+    addresses that failed within the last ``penalty`` seconds are attempted last.
+    Round-trip times are measured by the TCP handshake of every winning attempt
+    and can be fed by the caller through :func:`Dialer.record_rtt`.
+
+    :param endpoints:
+        A list of ``(host, port)`` tuples.
+    :type endpoints:
+        list
+    :param stagger:
+        The number of seconds to wait before starting the next attempt.
+    :type stagger:
+        float
+    :param timeout:
+        The number of seconds to wait for any attempt to succeed.
+    :type timeout:
+        float
+    :param penalty:
+        The number of seconds a failed address is deprioritized for.
+    :type penalty:
+        float
+    """
+    Endpoint = Endpoint
+    Address = Address
+
+    def __init__(self, endpoints, stagger=0.25, timeout=10.0, penalty=30.0):
+        if not endpoints:
+            raise BastioBackendError("no backend endpoints were specified")
+        self._endpoints = [Endpoint(*e) for e in endpoints]
+        self._stagger = stagger
+        self._timeout = timeout
+        self._penalty = penalty
+        self._rtt = collections.defaultdict(lambda: RollingStats(window=32))
+        self._failures = {}
+
+    @property
+    def endpoints(self):
+        return list(self._endpoints)
+
+    @classmethod
+    def parse_endpoints(cls, hosts, default_port):
+        """Parse a comma separated list of ``host[:port]`` endpoints. IPv6
+        addresses with a port must be enclosed in square brackets.
+
+        :param hosts:
+            A comma separated list of endpoints.
+        :type hosts:
+            str
+        :param default_port:
+            The port to use for endpoints that do not specify one.
+        :type default_port:
+            int
+        :returns:
+            A list of :class:`Endpoint`.
+        """
+        endpoints = []
+        for host in str(hosts).split(','):
+            host = host.strip()
+            if not host:
+                continue
+            port = default_port
+            if host.startswith('['):
+                host, _, rest = host[1:].partition(']')
+                if rest.startswith(':'):
+                    port = rest[1:]
+            elif host.count(':') == 1:
+                host, port = host.split(':')
+            try:
+                endpoints.append(Endpoint(host, int(port)))
+            except ValueError:
+                raise BastioBackendError(
+                        "invalid port for backend endpoint `{}`".format(host))
+        return endpoints
+
+    def record_rtt(self, address, rtt):
+        """Record a round-trip time sample in seconds for an address."""
+        self._rtt[address.sockaddr[:2]].add(rtt)
+
+    def mark_failed(self, address):
+        """Deprioritize an address for the next ``penalty`` seconds."""
+        self._failures[address.sockaddr[:2]] = time.time()
+
+    def has_alternatives(self, address):
+        """Check whether there's an address other than ``address`` that did not
+        fail recently.
+        """
+        for addr in self.resolve():
+            if addr.sockaddr[:2] != address.sockaddr[:2] and \
+                    not self._failed_recently(addr):
+                return True
+        return False
+
+    def resolve(self):
+        """Resolve all endpoints to their addresses, interleaving address
+        families so that a broken IPv6 or IPv4 network does not delay
+        connecting through the other.
+
+        :returns:
+            A list of :class:`Address`.
+        """
+        families = collections.OrderedDict()
+        seen = set()
+        for endpoint in self._endpoints:
+            try:
+                infos = socket.getaddrinfo(endpoint.host, endpoint.port,
+                        socket.AF_UNSPEC, socket.SOCK_STREAM)
+            except socket.gaierror:
+                continue
+            for family, _, _, _, sockaddr in infos:
+                if sockaddr[:2] in seen:
+                    continue
+                seen.add(sockaddr[:2])
+                families.setdefault(family, []).append(
+                        Address(endpoint.host, endpoint.port, family, sockaddr))
+        addrs = []
+        groups = families.values()
+        while any(groups):
+            for group in groups:
+                if group:
+                    addrs.append(group.pop(0))
+        return addrs
+
+    def candidates(self):
+        """Return the resolved addresses in the order they will be attempted."""
+        def key(addr):
+            stats = self._rtt.get(addr.sockaddr[:2])
+            rtt = stats.average if stats and stats.count else float('inf')
+            return (self._failed_recently(addr), rtt)
+        return sorted(self.resolve(), key=key)
+
+    def dial(self):
+        """Race connection attempts to the backend addresses and return the
+        first one to connect.
+
+        :returns:
+            A tuple of the :class:`Address` and a connected blocking socket.
+        :raises:
+            :class:`bastio.excepts.BastioBackendError`
+        """
+        waiting = self.candidates()
+        if not waiting:
+            raise BastioBackendError("unable to resolve any backend endpoint")
+        pending = {}
+        errors = []
+        deadline = time.time() + self._timeout
+        next_attempt = 0
+        try:
+            while waiting or pending:
+                now = time.time()
+                if now >= deadline:
+                    errors.append("timed out")
+                    break
+                if waiting and (not pending or now >= next_attempt):
+                    addr = waiting.pop(0)
+                    try:
+                        pending[self._start(addr)] = (addr, now)
+                    except socket.error as ex:
+                        self.mark_failed(addr)
+                        errors.append(self._strerror(addr, ex.errno))
+                        continue
+                    next_attempt = now + self._stagger
+                wait = deadline if not waiting else min(deadline, next_attempt)
+                _, ready, _ = select.select([], pending.keys(), [],
+                        max(wait - time.time(), 0))
+                for sock in ready:
+                    addr, started = pending.pop(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err:
+                        sock.close()
+                        self.mark_failed(addr)
+                        errors.append(self._strerror(addr, err))
+                        # Don't wait for the stagger to elapse
+                        next_attempt = 0
+                        continue
+                    self.record_rtt(addr, time.time() - started)
+                    self._failures.pop(addr.sockaddr[:2], None)
+                    sock.setblocking(1)
+                    return addr, sock
+        finally:
+            for sock, (addr, _) in pending.iteritems():
+                self.mark_failed(addr)
+                sock.close()
+        raise BastioBackendError("unable to connect to the backend: {}".format(
+            ', '.join(errors)))
+
+    def _failed_recently(self, addr):
+        failed = self._failures.get(addr.sockaddr[:2])
+        return bool(failed) and time.time() - failed < self._penalty
+
+    @staticmethod
+    def _start(addr):
+        sock = socket.socket(addr.family, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        err = sock.connect_ex(addr.sockaddr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise socket.error(err, os.strerror(err))
+        return sock
+
+    @staticmethod
+    def _strerror(addr, err):
+        return "{} ({})".format(addr.sockaddr[0], os.strerror(err).lower())
@@ -0,0 +1,173 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.ssh.digest
+:synopsis: A hash tree over the state of the managed users.
+:author: Amr Ali <amr@databracket.com>
+
+.. autoclass:: StateDigest
+    :members:
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import bisect
+import hashlib
+import threading
+
+from bastio.mixin import public
+from bastio.metrics import GlobalMetrics
+
+@public
+class StateDigest(object):
+    """A hash tree over the state of the managed users, which lets the backend
+    tell whether the state of a host drifted from the one it expects and find
+    the users that differ without sending the whole state.
+
+    Every user is a bucket whose hash covers its name, whether it's a member of
+    the sudo group and the fingerprints of its keys::
+
+        sha256("<username>\\n<0|1>\\n<fingerprint>\\n...")
+
+    with the fingerprints sorted. Users are placed in the tree by the hex
+    SHA-256 digest of their name, and the node of a hex prefix is either a
+    leaf when at most one user falls under it, or the hash of its non-empty
+    children otherwise::
+
+        leaf(prefix) = sha256("leaf\\n<username> <bucket>\\n")
+        node(prefix) = sha256("node\\n<digit> <child>\\n...")
+
+    where the node of a prefix no user falls under is None. Changing a user
+    only drops the cached hashes of the nodes on its path, so a change costs
+    a logarithmic number of hashes when the root is asked for again. The
+    number of hashes computed is tracked by the ``digest.hashes`` metric.
+    """
+    Digits = '0123456789abcdef'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        # The sorted placements of users in the tree, and their names
+        self._keys = []
+        self._names = {}
+        self._nodes = {}
+        self._hashes = GlobalMetrics().counter('digest.hashes')
+
+    @staticmethod
+    def bucket(username, sudo, fingerprints):
+        """Return the hash of the bucket of a user.
+
+        :param username:
+            The name of the user.
+        :type username:
+            str
+        :param sudo:
+            Whether the user is a member of the sudo group.
+        :type sudo:
+            bool
+        :param fingerprints:
+            The fingerprints of the keys of the user.
+        :type fingerprints:
+            iterable
+        :returns:
+            The hex digest of the bucket.
+        """
+        data = '\n'.join([username, '1' if sudo else '0'] + sorted(fingerprints))
+        return hashlib.sha256(data).hexdigest()
+
+    def set_user(self, username, sudo, fingerprints):
+        """Set the state of a user."""
+        bucket = self.bucket(username, sudo, fingerprints)
+        with self._lock:
+            if self._buckets.get(username) == bucket:
+                return
+            key = self._place(username)
+            if username not in self._buckets:
+                bisect.insort(self._keys, key)
+                self._names[key] = username
+            self._buckets[username] = bucket
+            self._invalidate(key)
+
+    def remove_user(self, username):
+        """Forget a user."""
+        with self._lock:
+            if self._buckets.pop(username, None) is None:
+                return
+            key = self._place(username)
+            del self._keys[bisect.bisect_left(self._keys, key)]
+            del self._names[key]
+            self._invalidate(key)
+
+    def __contains__(self, username):
+        return username in self._buckets
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def root(self):
+        """Return the hash of the root of the tree or None if there are no
+        users.
+        """
+        return self.node('')['hash']
+
+    def node(self, prefix):
+        """Return a node of the tree.
+
+        :param prefix:
+            The hex prefix of the node, the empty string for the root.
+        :type prefix:
+            str
+        :returns:
+            A dictionary with the ``prefix`` and the ``hash`` of the node, and
+            either the hashes of its non-empty ``children`` by hex digit, or
+            the bucket hash of its only user by name in ``users`` if it's a
+            leaf.
+        """
+        with self._lock:
+            node = {'prefix': prefix, 'hash': self._hash(prefix)}
+            keys = self._under(prefix)
+            if len(keys) > 1:
+                node['children'] = dict((digit, self._hash(prefix + digit))
+                        for digit in self.Digits
+                        if self._under(prefix + digit))
+            else:
+                node['users'] = dict((self._names[key],
+                    self._buckets[self._names[key]]) for key in keys)
+            return node
+
+    @staticmethod
+    def _place(username):
+        return hashlib.sha256(username).hexdigest()
+
+    def _invalidate(self, key):
+        for idx in xrange(len(key) + 1):
+            self._nodes.pop(key[:idx], None)
+
+    def _under(self, prefix):
+        """Return the placements that start with ``prefix``."""
+        low = bisect.bisect_left(self._keys, prefix)
+        high = bisect.bisect_left(self._keys, prefix + 'g')
+        return self._keys[low:high]
+
+    def _hash(self, prefix):
+        if prefix in self._nodes:
+            return self._nodes[prefix]
+        keys = self._under(prefix)
+        if not keys:
+            return None
+        if len(keys) == 1:
+            name = self._names[keys[0]]
+            data = 'leaf\n{} {}\n'.format(name, self._buckets[name])
+        else:
+            children = []
+            for digit in self.Digits:
+                child = self._hash(prefix + digit)
+                if child is not None:
+                    children.append('{} {}\n'.format(digit, child))
+            data = 'node\n' + ''.join(children)
+        self._hashes.inc()
+        digest = self._nodes[prefix] = hashlib.sha256(data).hexdigest()
+        return digest
@@ -0,0 +1,223 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.ssh.expiry
+:synopsis: Deadlines of time-bounded access grants.
+:author: Amr Ali <amr@databracket.com>
+
+.. autoclass:: ExpiryScheduler
+    :members:
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import time
+import json
+import heapq
+import itertools
+import threading
+import collections
+
+from bastio.mixin import public
+from bastio.journal import Journal
+from bastio.metrics import GlobalMetrics
+from bastio.ssh.authkeys import AuthorizedKey
+
+@public
+class ExpiryScheduler(object):
+    """The deadlines of time-bounded access grants, which are either a user or
+    a key of a user that must be revoked once the UNIX time of its deadline
+    passes. Deadlines are kept in a heap, so adding, replacing or discarding a
+    grant and taking the next one that expired cost a logarithmic time in the
+    number of grants. Discarded grants are only marked as such and are dropped
+    once they reach the top of the heap, or all at once when they outnumber
+    the pending grants.
+
+    Every grant is a record of a journal, so deadlines that passed while the
+    agent was not running expire as soon as it starts. Grants that expired
+    are taken with :func:`due` by a consumer that waits until
+    :func:`next_deadline`, and are handed out again every ``RetryInterval``
+    seconds until they are discarded, which is up to the consumer once the
+    access was revoked. The number of pending grants and of grants
+    that expired are tracked by the ``expiry.pending`` and ``expiry.expired``
+    metrics respectively.
+
+    :param journal:
+        The journal that persists the grants, a journal named ``JournalName``
+        in the state directory by default.
+    :type journal:
+        :class:`bastio.journal.Journal`
+    :param wake:
+        A callable to wake up a consumer waiting until :func:`next_deadline`,
+        which is called whenever a grant is added that's due before it.
+    :type wake:
+        callable
+    """
+    JournalName = 'expiry.journal'
+    RetryInterval = 60.0
+
+    class Grant(collections.namedtuple('Grant',
+        'username fingerprint public_key deadline')):
+        """A grant of a user when ``fingerprint`` and ``public_key`` are None,
+        or of a key of a user otherwise.
+        """
+
+    def __init__(self, journal=None, wake=None):
+        self._wake = wake
+        self._journal = journal if journal is not None else \
+                Journal.open(self.JournalName)
+        self._lock = threading.RLock()
+        self._heap = []
+        # The live heap entry of every record and the records of every user
+        self._entries = {}
+        self._users = {}
+        self._stale = 0
+        self._order = itertools.count()
+        metrics = GlobalMetrics()
+        self._pending = metrics.counter('expiry.pending')
+        self._expired = metrics.counter('expiry.expired')
+        for record, data in self._journal.replay():
+            record = str(record)
+            try:
+                deadline, public_key = json.loads(data)
+                username, fingerprint = record.split(':', 1)
+                grant = self.Grant(username, fingerprint or None,
+                        str(public_key) if public_key else None, float(deadline))
+            except (ValueError, TypeError):
+                self._journal.ack(record)
+                continue
+            self._push(record, grant, grant.deadline)
+        self._pending.set(len(self._entries))
+
+    @staticmethod
+    def _record(username, fingerprint):
+        return '{}:{}'.format(username, fingerprint or '')
+
+    def add(self, username, deadline, public_key=None):
+        """Grant access to a user, or to one of its keys, until ``deadline``,
+        replacing the deadline of an earlier grant of the same.
+
+        :param username:
+            The name of the user.
+        :type username:
+            str
+        :param deadline:
+            The UNIX time the access expires at.
+        :type deadline:
+            float
+        :param public_key:
+            The public key of the grant or None for a grant of the user.
+        :type public_key:
+            str
+        """
+        fingerprint = None
+        if public_key is not None:
+            fingerprint = AuthorizedKey.parse(public_key).fingerprint
+        record = self._record(username, fingerprint)
+        grant = self.Grant(username, fingerprint, public_key, float(deadline))
+        with self._lock:
+            entry = self._entries.get(record)
+            if entry is not None and entry[3] == grant:
+                return
+            self._remove(record)
+            self._journal.append(record, json.dumps([grant.deadline, public_key]))
+            self._journal.sync()
+            self._push(record, grant, grant.deadline)
+            self._pending.set(len(self._entries))
+            earliest = self.next_deadline() == grant.deadline
+        if earliest and self._wake is not None:
+            self._wake()
+
+    def discard(self, username, fingerprint=None):
+        """Discard the grant of a user, or of one of its keys by fingerprint,
+        if any.
+        """
+        with self._lock:
+            if self._remove(self._record(username, fingerprint)):
+                self._journal.sync()
+                self._pending.set(len(self._entries))
+
+    def discard_user(self, username):
+        """Discard the grants of a user and of all of its keys."""
+        with self._lock:
+            records = list(self._users.get(username, ()))
+            for record in records:
+                self._remove(record)
+            if records:
+                self._journal.sync()
+                self._pending.set(len(self._entries))
+
+    def get(self, username, fingerprint=None):
+        """Return the grant of a user, or of one of its keys by fingerprint,
+        or None.
+        """
+        with self._lock:
+            entry = self._entries.get(self._record(username, fingerprint))
+            return entry[3] if entry is not None else None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def next_deadline(self):
+        """Return the earliest time a grant is handed out by :func:`due`, or
+        None if there are no grants.
+        """
+        with self._lock:
+            while self._heap and self._heap[0][2] is None:
+                heapq.heappop(self._heap)
+                self._stale -= 1
+            return self._heap[0][0] if self._heap else None
+
+    def due(self, now=None):
+        """Return the grants whose deadline passed by ``now``, the current time
+        by default, in order of their deadlines. They are handed out again
+        ``RetryInterval`` seconds later unless they are discarded by then.
+
+        :returns:
+            list of :class:`ExpiryScheduler.Grant`
+        """
+        if now is None:
+            now = time.time()
+        grants = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                if entry[2] is None:
+                    self._stale -= 1
+                    continue
+                grants.append(entry[3])
+                self._push(entry[2], entry[3], now + self.RetryInterval)
+        self._expired.inc(len(grants))
+        return grants
+
+    def stop(self):
+        """Flush the journal to disk."""
+        self._journal.stop()
+
+    def _push(self, record, grant, deadline):
+        # Entries are [deadline, order, record, grant] where a discarded entry
+        # has no record, and the order breaks ties between equal deadlines
+        entry = [deadline, next(self._order), record, grant]
+        self._entries[record] = entry
+        self._users.setdefault(grant.username, set()).add(record)
+        heapq.heappush(self._heap, entry)
+
+    def _remove(self, record):
+        entry = self._entries.pop(record, None)
+        if entry is None:
+            return False
+        entry[2] = None
+        self._stale += 1
+        records = self._users[entry[3].username]
+        records.discard(record)
+        if not records:
+            del self._users[entry[3].username]
+        self._journal.ack(record)
+        if self._stale > len(self._entries):
+            self._heap = [e for e in self._heap if e[2] is not None]
+            heapq.heapify(self._heap)
+            self._stale = 0
+        return True
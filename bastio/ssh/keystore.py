@@ -0,0 +1,346 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.ssh.keystore
+:synopsis: Authorized keys served from memory to sshd's AuthorizedKeysCommand.
+:author: Amr Ali <amr@databracket.com>
+
+Instead of writing ``~/.ssh/authorized_keys`` files, the agent can keep the
+authorized keys of all users in memory, persisted in a journal, and answer
+``sshd`` through ``AuthorizedKeysCommand``, which runs
+``bastio-agent authorized-keys <user>`` on every login to query the agent over
+a local Unix socket::
+
+    AuthorizedKeysCommand /usr/bin/bastio-agent authorized-keys %u
+    AuthorizedKeysCommandUser nobody
+
+where only the ``AuthorizedKeysCommandUser`` may connect to the socket.
+
+.. autoclass:: KeyStore
+    :members:
+
+.. autoclass:: KeyServer
+    :members:
+
+.. autofunction:: query_keys
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import pwd
+import time
+import errno
+import socket
+import select
+import threading
+
+from bastio.log import Logger
+from bastio.mixin import public
+from bastio.journal import Journal
+from bastio.metrics import GlobalMetrics
+from bastio.concurrency import GlobalThreadPool, Task
+from bastio.ssh.authkeys import AuthorizedKey, AuthorizedKeys, AuthorizedKeysWriter
+from bastio.excepts import BastioAuthKeysError, BastioJournalError
+
+@public
+class KeyStore(object):
+    """The authorized keys of all users. Every key is a record of a journal,
+    so adding or removing a key costs a single append to it.
+
+    :param journal:
+        The journal that persists the keys, a journal named ``JournalName``
+        in the state directory by default.
+    :type journal:
+        :class:`bastio.journal.Journal`
+    """
+    JournalName = 'keys.journal'
+
+    def __init__(self, journal=None):
+        self._journal = journal if journal is not None else \
+                Journal.open(self.JournalName)
+        self._lock = threading.Lock()
+        self._users = {}
+        for record, data in self._journal.replay():
+            username = record.split(':', 1)[0]
+            try:
+                key = AuthorizedKey.parse(data)
+            except BastioAuthKeysError:
+                key = None
+            if key is None:
+                self._journal.ack(record)
+                continue
+            self._keys(username).add(key)
+
+    def _keys(self, username):
+        if username not in self._users:
+            self._users[username] = AuthorizedKeys(None)
+        return self._users[username]
+
+    @staticmethod
+    def _record(username, fingerprint):
+        return '{}:{}'.format(username, fingerprint)
+
+    def apply(self, username, changes):
+        """Apply a list of changes to the keys of a user in order, see
+        :func:`bastio.ssh.authkeys.AuthorizedKeysWriter.apply`.
+
+        :raises:
+            :class:`bastio.excepts.BastioAuthKeysError`
+        """
+        results = []
+        with self._lock:
+            keys = self._keys(username)
+            try:
+                for op, arg in changes:
+                    if op == AuthorizedKeysWriter.ADD:
+                        changed = keys.add(arg)
+                        if changed:
+                            self._journal.append(self._record(username,
+                                arg.fingerprint), str(arg))
+                    else:
+                        changed = keys.remove(arg)
+                        if changed:
+                            self._journal.ack(self._record(username, arg))
+                    results.append(changed)
+                if any(results):
+                    self._journal.sync()
+            except BastioJournalError as ex:
+                raise BastioAuthKeysError(ex.message)
+        return results
+
+    def remove_user(self, username):
+        """Remove all the keys of a user."""
+        with self._lock:
+            keys = self._users.pop(username, None)
+            if keys is None:
+                return
+            for key in keys:
+                self._journal.ack(self._record(username, key.fingerprint))
+            self._journal.sync()
+
+    def keys(self, username):
+        """Return a copy of the keys of a user.
+
+        :returns:
+            :class:`bastio.ssh.authkeys.AuthorizedKeys`
+        """
+        with self._lock:
+            keys = self._users.get(username)
+            return keys.copy() if keys is not None else AuthorizedKeys(None)
+
+    def render(self, username):
+        """Return the keys of a user in ``authorized_keys`` format."""
+        with self._lock:
+            keys = self._users.get(username)
+            return keys.render() if keys is not None else ''
+
+    def stop(self):
+        """Flush the journal to disk."""
+        self._journal.stop()
+
+@public
+class KeyServer(object):
+    """Answer queries for the keys of a user over a Unix socket. A query is
+    the name of the user followed by a new line, and the answer is the keys
+    of the user in ``authorized_keys`` format. The number of queries is
+    tracked by the ``keyserver.queries`` metric.
+
+    Only ``user``, which should be sshd's ``AuthorizedKeysCommandUser``, and
+    root may connect to the socket. Up to ``MaxClients`` clients are served at
+    the same time by a single thread, and a client that does not complete its
+    query and read the answer within ``ClientTimeout`` seconds is dropped, so
+    a slow client never holds up the logins of other users.
+
+    :param store:
+        The keys to serve.
+    :type store:
+        :class:`KeyStore`
+    :param path:
+        The path of the socket.
+    :type path:
+        str
+    :param user:
+        The name of the user allowed to query the keys.
+    :type user:
+        str
+    """
+    SocketPath = '/var/run/bastio/keys.sock'
+    SocketUser = 'nobody'
+    ClientTimeout = 0.2
+    MaxClients = 128
+    MaxQuery = 256
+
+    def __init__(self, store, path=None, user=None):
+        self._store = store
+        self._path = path or self.SocketPath
+        self._user = user or self.SocketUser
+        self._logger = Logger()
+        self._sock = None
+        self._task = None
+        self._queries = GlobalMetrics().counter('keyserver.queries')
+
+    def start(self):
+        """Listen on the socket and serve queries on the thread pool.
+
+        :raises:
+            :class:`bastio.excepts.BastioAuthKeysError`
+        """
+        try:
+            uid = pwd.getpwnam(self._user).pw_uid
+        except KeyError:
+            raise BastioAuthKeysError("unable to find user `{}` to serve keys "
+                    "to".format(self._user))
+        try:
+            try:
+                os.makedirs(os.path.dirname(self._path), 0755)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+            try:
+                os.unlink(self._path)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self._path)
+            os.chmod(self._path, 0600)
+            os.chown(self._path, uid, -1)
+            sock.listen(64)
+            sock.setblocking(0)
+        except (OSError, socket.error) as ex:
+            raise BastioAuthKeysError("unable to listen on `{}`: {}".format(
+                self._path, ex.strerror if hasattr(ex, 'strerror') else ex))
+        self._sock = sock
+        self._task = GlobalThreadPool().run(Task(target=self.__serve,
+            infinite=True))
+
+    def stop(self):
+        """Stop serving queries."""
+        if self._task:
+            self._task.stop()
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+
+    def __serve(self, kill_ev):
+        # Every client is [query, answer, deadline] where the answer is None
+        # until the query is complete
+        clients = {}
+        try:
+            while not kill_ev.is_set():
+                sock = self._sock
+                if sock is None:
+                    return
+                now = time.time()
+                for conn, client in clients.items():
+                    if client[2] <= now:
+                        self._drop(clients, conn)
+                readers = [conn for conn, client in clients.iteritems()
+                        if client[1] is None]
+                writers = [conn for conn, client in clients.iteritems()
+                        if client[1] is not None]
+                if len(clients) < self.MaxClients:
+                    readers.append(sock)
+                timeout = min([1.0] + [client[2] - now
+                    for client in clients.itervalues()])
+                try:
+                    readable, writable, _ = select.select(readers, writers, [],
+                            max(0, timeout))
+                except (select.error, socket.error):
+                    continue
+                for conn in readable:
+                    if conn is sock:
+                        self._accept(sock, clients)
+                    else:
+                        self._read(clients, conn)
+                for conn in writable:
+                    if conn in clients:
+                        self._write(clients, conn)
+        finally:
+            for conn in clients.keys():
+                self._drop(clients, conn)
+
+    def _accept(self, sock, clients):
+        try:
+            conn, _ = sock.accept()
+        except socket.error:
+            return
+        conn.setblocking(0)
+        clients[conn] = ['', None, time.time() + self.ClientTimeout]
+
+    def _read(self, clients, conn):
+        client = clients[conn]
+        try:
+            data = conn.recv(self.MaxQuery)
+        except socket.error as ex:
+            if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self._drop(clients, conn)
+            return
+        client[0] += data
+        if data and '\n' not in client[0] and len(client[0]) < self.MaxQuery:
+            return
+        username = client[0].split('\n', 1)[0].strip()
+        self._queries.inc()
+        client[1] = self._store.render(username) if username else ''
+        self._write(clients, conn)
+
+    def _write(self, clients, conn):
+        client = clients[conn]
+        try:
+            if client[1]:
+                client[1] = client[1][conn.send(client[1]):]
+        except socket.error as ex:
+            if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self._logger.warning("unable to answer a key query: {}".format(ex))
+                self._drop(clients, conn)
+            return
+        if not client[1]:
+            self._drop(clients, conn)
+
+    @staticmethod
+    def _drop(clients, conn):
+        del clients[conn]
+        conn.close()
+
+@public
+def query_keys(username, path=None, timeout=5.0):
+    """Query the agent for the keys of a user.
+
+    :param username:
+        The name of the user.
+    :type username:
+        str
+    :param path:
+        The path of the socket.
+    :type path:
+        str
+    :returns:
+        The keys of the user in ``authorized_keys`` format.
+    :raises:
+        :class:`bastio.excepts.BastioAuthKeysError`
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path or KeyServer.SocketPath)
+        sock.sendall(username + '\n')
+        sock.shutdown(socket.SHUT_WR)
+        data = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+        return ''.join(data)
+    except socket.error as ex:
+        raise BastioAuthKeysError("unable to query the agent: {}".format(ex))
+    finally:
+        sock.close()
@@ -40,6 +40,24 @@ Protocol Messages
 .. autoclass:: FeedbackMessage
     :members:
 
+.. autoclass:: HeartbeatMessage
+    :members:
+
+.. autoclass:: FlowControlMessage
+    :members:
+
+.. autoclass:: AckMessage
+    :members:
+
+.. autoclass:: ResumeMessage
+    :members:
+
+.. autoclass:: SyncStateMessage
+    :members:
+
+.. autoclass:: StateDigestMessage
+    :members:
+
 .. autoclass:: AddUserMessage
     :members:
 
@@ -160,9 +178,24 @@ class Netstring(object):
 
 @public
 class ProtocolMessage(Json):
-    """A protocol message base class."""
+    """A protocol message base class.
+
+    Every message has a priority which is the lane number it should take in
+    priority aware queues (see :class:`bastio.concurrency.LaneQueue`), where
+    ``PRIORITY_HIGH`` is reserved for messages that revoke access.
 
-    def __init__(self, mid=None, **kwargs):
+    Messages other than control messages carry a sequence number ``seq`` once
+    they are sent, which is assigned by the sender per direction and session
+    starting from 1. The receiver acknowledges every sequence number it received
+    in order with a cumulative :class:`AckMessage`. Control messages are never
+    sequenced nor acknowledged.
+    """
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITIES = 2
+    Control = False
+
+    def __init__(self, mid=None, seq=None, **kwargs):
         super(ProtocolMessage, self).__init__()
         self.type = self.MessageType
         if not mid:
@@ -171,6 +204,8 @@ class ProtocolMessage(Json):
             self.mid = self.__generate_mid()
         else:
             self.mid = mid
+        if seq is not None:
+            self.seq = seq
         self.parse(self, False)
 
     def reply(self, feedback, status):
@@ -188,7 +223,19 @@ class ProtocolMessage(Json):
         :returns:
             :class:`FeedbackMessage`
         """
-        return FeedbackMessage(feedback, status, **self.__dict__)
+        reply = FeedbackMessage(feedback, status, mid=self.mid)
+        reply._request = self
+        return reply
+
+    def priority(self):
+        """Return the priority of this message."""
+        return self.PRIORITY_NORMAL
+
+    def ordering_key(self):
+        """Return the key of messages that must keep their relative order, or
+        None if this message can be reordered freely.
+        """
+        return None
 
     @classmethod
     def parse(cls, obj, traverse=True):
@@ -211,6 +258,8 @@ class ProtocolMessage(Json):
         """
         if 'mid' not in obj:
             raise BastioMessageError("message ID field is missing")
+        if 'seq' in obj and not (isinstance(obj.seq, (int, long)) and obj.seq > 0):
+            raise BastioMessageError("sequence number must be a positive integer")
         if traverse:
             return cls(**obj.__dict__)
 
@@ -234,6 +283,22 @@ class FeedbackMessage(ProtocolMessage):
         super(FeedbackMessage, self).__init__(**kwargs)
         self.parse(self, False)
 
+    def priority(self):
+        """Return the priority of this feedback, which is the priority of the
+        message it is a reply to if it is known.
+        """
+        request = getattr(self, '_request', None)
+        if request:
+            return request.priority()
+        return self.PRIORITY_NORMAL
+
+    def ordering_key(self):
+        """Return the ordering key of the message this is a reply to."""
+        request = getattr(self, '_request', None)
+        if request:
+            return request.ordering_key()
+        return None
+
     @classmethod
     def parse(cls, obj, traverse=True):
         """Check feedback message fields and validate them.
@@ -262,12 +327,300 @@ class FeedbackMessage(ProtocolMessage):
         if traverse:
             return super(FeedbackMessage, cls).parse(obj)
 
+@public
+class HeartbeatMessage(ProtocolMessage):
+    """A protocol heartbeat message. A peer receiving a heartbeat that is not
+    an echo must send it back as an echo with the same MID as soon as possible,
+    which allows the sender to detect a dead link and measure its round-trip
+    time.
+    """
+    MessageType = "heartbeat"
+    Control = True
+
+    def __init__(self, echo=False, **kwargs):
+        self.echo = echo
+        super(HeartbeatMessage, self).__init__(**kwargs)
+        self.parse(self, False)
+
+    def make_echo(self):
+        """Return the echo of this heartbeat.
+
+        :returns:
+            :class:`HeartbeatMessage`
+        """
+        return HeartbeatMessage(echo=True, mid=self.mid)
+
+    @classmethod
+    def parse(cls, obj, traverse=True):
+        """Check heartbeat message fields and validate them.
+
+        Return a new object of type ``cls`` containing the validated
+        heartbeat object.
+
+        :param obj:
+            A JSON object containing the relevant fields for this heartbeat message.
+        :type obj:
+            :class:`bastio.mixin.Json`
+        :param traverse:
+            Whether to traverse ``parse`` on all the classes in the hierarchy.
+        :type traverse:
+            bool
+        :returns:
+            A new object of type ``cls`` containing the validated heartbeat
+            object.
+        """
+        if 'echo' not in obj:
+            raise BastioMessageError("echo field is missing")
+        if traverse:
+            return super(HeartbeatMessage, cls).parse(obj)
+
+@public
+class FlowControlMessage(ProtocolMessage):
+    """A protocol flow control message. A peer receiving a flow control message
+    with ``pause`` set must stop sending messages other than heartbeats and flow
+    control messages until it receives one with ``pause`` unset.
+    """
+    MessageType = "flow-control"
+    Control = True
+
+    def __init__(self, pause, **kwargs):
+        self.pause = pause
+        super(FlowControlMessage, self).__init__(**kwargs)
+        self.parse(self, False)
+
+    @classmethod
+    def parse(cls, obj, traverse=True):
+        """Check flow control message fields and validate them.
+
+        Return a new object of type ``cls`` containing the validated
+        flow control object.
+
+        :param obj:
+            A JSON object containing the relevant fields for this flow control
+            message.
+        :type obj:
+            :class:`bastio.mixin.Json`
+        :param traverse:
+            Whether to traverse ``parse`` on all the classes in the hierarchy.
+        :type traverse:
+            bool
+        :returns:
+            A new object of type ``cls`` containing the validated flow control
+            object.
+        """
+        if 'pause' not in obj:
+            raise BastioMessageError("pause field is missing")
+        if traverse:
+            return super(FlowControlMessage, cls).parse(obj)
+
+@public
+class AckMessage(ProtocolMessage):
+    """A protocol acknowledgement message. A peer acknowledges that it
+    received every message up to and including the sequence number ``ack``, so
+    that the sender can forget about them.
+    """
+    MessageType = "ack"
+    Control = True
+
+    def __init__(self, ack, **kwargs):
+        self.ack = ack
+        super(AckMessage, self).__init__(**kwargs)
+        self.parse(self, False)
+
+    @classmethod
+    def parse(cls, obj, traverse=True):
+        """Check acknowledgement message fields and validate them.
+
+        Return a new object of type ``cls`` containing the validated
+        acknowledgement object.
+
+        :param obj:
+            A JSON object containing the relevant fields for this
+            acknowledgement message.
+        :type obj:
+            :class:`bastio.mixin.Json`
+        :param traverse:
+            Whether to traverse ``parse`` on all the classes in the hierarchy.
+        :type traverse:
+            bool
+        :returns:
+            A new object of type ``cls`` containing the validated
+            acknowledgement object.
+        """
+        if 'ack' not in obj:
+            raise BastioMessageError("ack field is missing")
+        if not isinstance(obj.ack, (int, long)) or obj.ack < 0:
+            raise BastioMessageError("ack field must be a non-negative integer")
+        if traverse:
+            return super(AckMessage, cls).parse(obj)
+
+@public
+class ResumeMessage(ProtocolMessage):
+    """A protocol session resume message. The agent sends it right after it
+    connects with the ``session`` it had with the backend (or None) and the last
+    sequence number it received in ``ack``. The backend replies with the same
+    ``session`` and the last sequence number it received if it can resume the
+    session, in which case both peers send the messages that were not
+    acknowledged again, or with a new ``session`` and an ``ack`` of 0 in which
+    case sequence numbers start over.
+    """
+    MessageType = "resume"
+    Control = True
+
+    def __init__(self, session, ack, **kwargs):
+        self.session = session
+        self.ack = ack
+        super(ResumeMessage, self).__init__(**kwargs)
+        self.parse(self, False)
+
+    @classmethod
+    def parse(cls, obj, traverse=True):
+        """Check session resume message fields and validate them.
+
+        Return a new object of type ``cls`` containing the validated
+        session resume object.
+
+        :param obj:
+            A JSON object containing the relevant fields for this session
+            resume message.
+        :type obj:
+            :class:`bastio.mixin.Json`
+        :param traverse:
+            Whether to traverse ``parse`` on all the classes in the hierarchy.
+        :type traverse:
+            bool
+        :returns:
+            A new object of type ``cls`` containing the validated session
+            resume object.
+        """
+        if 'session' not in obj:
+            raise BastioMessageError("session field is missing")
+        if 'ack' not in obj:
+            raise BastioMessageError("ack field is missing")
+        if not isinstance(obj.ack, (int, long)) or obj.ack < 0:
+            raise BastioMessageError("ack field must be a non-negative integer")
+        if traverse:
+            return super(ResumeMessage, cls).parse(obj)
+
+@public
+class SyncStateMessage(ProtocolMessage):
+    """A protocol message that carries the full desired state of the users
+    managed by the agent in ``users``, a list of objects with the ``username``
+    of a user, whether it's a member of the sudo group in ``sudo`` and its
+    public keys in ``keys``. The agent applies only the changes needed to get
+    to that state, including removing the users it manages that are not in
+    the list, see :class:`bastio.ssh.api.Reconciler`. It describes the state
+    after every action sent before it, so it must never be reordered with
+    any other action.
+    """
+    MessageType = "sync-state"
+
+    def __init__(self, users, **kwargs):
+        self.users = users
+        super(SyncStateMessage, self).__init__(**kwargs)
+        self.parse(self, False)
+
+    def priority(self):
+        """A sync-state may revoke access, so nothing sent after it may run
+        before it, see :class:`bastio.concurrency.LaneQueue` for how it keeps
+        its place behind the actions sent before it.
+        """
+        return self.PRIORITY_HIGH
+
+    @classmethod
+    def parse(cls, obj, traverse=True):
+        """Check sync-state message fields and validate them.
+
+        Return a new object of type ``cls`` containing the validated
+        sync-state object.
+
+        :param obj:
+            A JSON object containing the relevant fields for this sync-state
+            message.
+        :type obj:
+            :class:`bastio.mixin.Json`
+        :param traverse:
+            Whether to traverse ``parse`` on all the classes in the hierarchy.
+        :type traverse:
+            bool
+        :returns:
+            A new object of type ``cls`` containing the validated sync-state
+            object.
+        """
+        if 'users' not in obj:
+            raise BastioMessageError("users field is missing")
+        if not isinstance(obj.users, list):
+            raise BastioMessageError("users field must be a list")
+        usernames = set()
+        for user in obj.users:
+            if not isinstance(user, dict):
+                raise BastioMessageError("users field must be a list of objects")
+            username = user.get('username')
+            if not isinstance(username, basestring) or \
+                    not re.match("^([a-z_][a-z0-9_]{0,30})$", username):
+                raise BastioMessageError("username field is invalid")
+            if username in usernames:
+                raise BastioMessageError("user `{}` is listed more than once".format(
+                    username))
+            usernames.add(username)
+            if not isinstance(user.get('sudo'), bool):
+                raise BastioMessageError("sudo field of `{}` is missing".format(
+                    username))
+            keys = user.get('keys', [])
+            if not isinstance(keys, list) or not all(isinstance(key, basestring)
+                    and RSAKey.validate_public_key(key) for key in keys):
+                raise BastioMessageError("keys field of `{}` is invalid".format(
+                    username))
+        if traverse:
+            return super(SyncStateMessage, cls).parse(obj)
+
+@public
+class StateDigestMessage(ProtocolMessage):
+    """A protocol message that queries a node of the hash tree over the state
+    of the managed users by its hex ``prefix``, which is the empty string for
+    the root. The feedback carries the node in its ``digest`` field, see
+    :func:`bastio.ssh.digest.StateDigest.node`.
+    """
+    MessageType = "state-digest"
+
+    def __init__(self, prefix='', **kwargs):
+        self.prefix = prefix
+        super(StateDigestMessage, self).__init__(**kwargs)
+        self.parse(self, False)
+
+    @classmethod
+    def parse(cls, obj, traverse=True):
+        """Check state-digest message fields and validate them.
+
+        Return a new object of type ``cls`` containing the validated
+        state-digest object.
+
+        :param obj:
+            A JSON object containing the relevant fields for this state-digest
+            message.
+        :type obj:
+            :class:`bastio.mixin.Json`
+        :param traverse:
+            Whether to traverse ``parse`` on all the classes in the hierarchy.
+        :type traverse:
+            bool
+        :returns:
+            A new object of type ``cls`` containing the validated state-digest
+            object.
+        """
+        if 'prefix' in obj and (not isinstance(obj.prefix, basestring) or
+                not re.match("^[0-9a-f]{0,64}$", obj.prefix)):
+            raise BastioMessageError("prefix field is invalid")
+        if traverse:
+            return super(StateDigestMessage, cls).parse(obj)
+
 @public
 class ActionMessage(ProtocolMessage):
     """A protocol action message base class. Use this class as a base for all
     other action messages.
     """
     MessageType = 'action'
+    Revocation = False
 
     def __init__(self, username, **kwargs):
         self.action = self.ActionType
@@ -275,6 +628,28 @@ class ActionMessage(ProtocolMessage):
         super(ActionMessage, self).__init__(**kwargs)
         self.parse(self, False)
 
+    def priority(self):
+        """Return the priority of this action, actions that revoke access
+        take precedence over every other action.
+        """
+        if self.revokes():
+            return self.PRIORITY_HIGH
+        return self.PRIORITY_NORMAL
+
+    def ordering_key(self):
+        """Actions of the same user must keep their relative order."""
+        return self.username
+
+    def revokes(self):
+        """Check whether this action revokes access."""
+        return self.Revocation
+
+    def expires(self):
+        """Return the UNIX time the access granted by this action expires at,
+        or None if it never does.
+        """
+        return getattr(self, 'expires_at', None)
+
     @classmethod
     def parse(cls, obj, traverse=True):
         """Check action message fields and validate them.
@@ -303,11 +678,16 @@ class ActionMessage(ProtocolMessage):
 
 @public
 class AddUserMessage(ActionMessage):
-    """An add-user action message."""
+    """An add-user action message. The user is removed once the UNIX time in
+    the optional ``expires_at`` field passes, see
+    :class:`bastio.ssh.expiry.ExpiryScheduler`.
+    """
     ActionType = 'add-user'
 
-    def __init__(self, sudo, **kwargs):
+    def __init__(self, sudo, expires_at=None, **kwargs):
         self.sudo = sudo
+        if expires_at is not None:
+            self.expires_at = expires_at
         super(AddUserMessage, self).__init__(**kwargs)
         self.parse(self, False)
 
@@ -332,6 +712,10 @@ class AddUserMessage(ActionMessage):
         """
         if 'sudo' not in obj:
             raise BastioMessageError("sudo field is missing")
+        if 'expires_at' in obj and (isinstance(obj.expires_at, bool) or
+                not isinstance(obj.expires_at, (int, long, float)) or
+                obj.expires_at <= 0):
+            raise BastioMessageError("expires_at field must be a positive UNIX time")
         if traverse:
             return super(AddUserMessage, cls).parse(obj)
 
@@ -339,6 +723,7 @@ class AddUserMessage(ActionMessage):
 class RemoveUserMessage(ActionMessage):
     """A remove-user action message."""
     ActionType = 'remove-user'
+    Revocation = True
 
     def __init__(self, **kwargs):
         super(RemoveUserMessage, self).__init__(**kwargs)
@@ -376,6 +761,10 @@ class UpdateUserMessage(ActionMessage):
         super(UpdateUserMessage, self).__init__(**kwargs)
         self.parse(self, False)
 
+    def revokes(self):
+        """Demoting a user from the sudo group revokes access."""
+        return not self.sudo
+
     @classmethod
     def parse(cls, obj, traverse=True):
         """Check update-user message fields and validate them.
@@ -402,11 +791,16 @@ class UpdateUserMessage(ActionMessage):
 
 @public
 class AddKeyMessage(ActionMessage):
-    """A add-key action message."""
+    """A add-key action message. The key is removed once the UNIX time in the
+    optional ``expires_at`` field passes, see
+    :class:`bastio.ssh.expiry.ExpiryScheduler`.
+    """
     ActionType = 'add-key'
 
-    def __init__(self, public_key, **kwargs):
+    def __init__(self, public_key, expires_at=None, **kwargs):
         self.public_key = public_key
+        if expires_at is not None:
+            self.expires_at = expires_at
         super(AddKeyMessage, self).__init__(**kwargs)
         self.parse(self, False)
 
@@ -433,6 +827,10 @@ class AddKeyMessage(ActionMessage):
             raise BastioMessageError("public_key field is missing")
         if not RSAKey.validate_public_key(obj.public_key):
             raise BastioMessageError("public_key field is invalid")
+        if 'expires_at' in obj and (isinstance(obj.expires_at, bool) or
+                not isinstance(obj.expires_at, (int, long, float)) or
+                obj.expires_at <= 0):
+            raise BastioMessageError("expires_at field must be a positive UNIX time")
         if traverse:
             return super(AddKeyMessage, cls).parse(obj)
 
@@ -440,6 +838,7 @@ class AddKeyMessage(ActionMessage):
 class RemoveKeyMessage(ActionMessage):
     """A remove-key action message."""
     ActionType = 'remove-key'
+    Revocation = True
 
     def __init__(self, public_key, **kwargs):
         self.public_key = public_key
@@ -521,6 +920,12 @@ class MessageParser(object):
 
     SupportedMessages = {
             FeedbackMessage.MessageType: FeedbackMessage,
+            HeartbeatMessage.MessageType: HeartbeatMessage,
+            FlowControlMessage.MessageType: FlowControlMessage,
+            AckMessage.MessageType: AckMessage,
+            ResumeMessage.MessageType: ResumeMessage,
+            SyncStateMessage.MessageType: SyncStateMessage,
+            StateDigestMessage.MessageType: StateDigestMessage,
             ActionParser.MessageType: ActionParser,
             }
 
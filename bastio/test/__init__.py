@@ -2,8 +2,19 @@ import unittest
 import test_concurrency
 import test_mixin
 import test_configs
+import test_metrics
+import test_journal
+import test_fsutil
+import test_userdb
+import test_provision
+import test_command
 import test_ssh_crypto
 import test_ssh_protocol
+import test_ssh_authkeys
+import test_ssh_keystore
+import test_ssh_digest
+import test_ssh_expiry
+import test_ssh_dialer
 import test_ssh_api
 import test_ssh_client
 
@@ -17,8 +28,19 @@ suite = unittest.TestSuite()
 suite.addTests(__make_suite(test_concurrency.tests))
 suite.addTests(__make_suite(test_mixin.tests))
 suite.addTests(__make_suite(test_configs.tests))
+suite.addTests(__make_suite(test_metrics.tests))
+suite.addTests(__make_suite(test_journal.tests))
+suite.addTests(__make_suite(test_fsutil.tests))
+suite.addTests(__make_suite(test_userdb.tests))
+suite.addTests(__make_suite(test_provision.tests))
+suite.addTests(__make_suite(test_command.tests))
 suite.addTests(__make_suite(test_ssh_crypto.tests))
 suite.addTests(__make_suite(test_ssh_protocol.tests))
+suite.addTests(__make_suite(test_ssh_authkeys.tests))
+suite.addTests(__make_suite(test_ssh_keystore.tests))
+suite.addTests(__make_suite(test_ssh_digest.tests))
+suite.addTests(__make_suite(test_ssh_expiry.tests))
+suite.addTests(__make_suite(test_ssh_dialer.tests))
 suite.addTests(__make_suite(test_ssh_api.tests))
 suite.addTests(__make_suite(test_ssh_client.tests))
 
@@ -0,0 +1,96 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.test.test_command
+:synopsis: Unit tests for the command module.
+:author: Amr Ali <amr@databracket.com>
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import time
+import signal
+import unittest
+import threading
+
+from bastio.command import CommandHelper
+from bastio.excepts import BastioCommandError
+
+class TestCommandHelper(unittest.TestCase):
+    def setUp(self):
+        self.helper = CommandHelper()
+        self.addCleanup(self.helper.stop)
+
+    def test_run(self):
+        result = self.helper.run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        self.assertEqual(result.code, 3)
+        self.assertEqual(result.stdout, "out\n")
+        self.assertEqual(result.stderr, "err\n")
+        # Arguments are never interpreted by a shell
+        result = self.helper.run(['echo', '$HOME;', '`id`'])
+        self.assertEqual(result.stdout, "$HOME; `id`\n")
+        data = ''.join(chr(x) for x in range(256)) * 64
+        self.assertEqual(self.helper.run(['cat'], data).stdout, data)
+        with self.assertRaises(BastioCommandError):
+            self.helper.run(['/nonexistent/command'])
+
+    def test_timeout(self):
+        self.helper._grace = 0.2
+        started = time.time()
+        # The shell's child is killed along with it
+        result = self.helper.run(['sh', '-c', 'trap "" TERM; sleep 30; echo done'],
+                timeout=0.3)
+        self.assertLess(time.time() - started, 5)
+        self.assertTrue(result.timed_out)
+        self.assertFalse(result.success)
+        self.assertEqual(result.stdout, "")
+        self.assertTrue(self.helper.run(['true']).success)
+        self.assertFalse(self.helper.run(['false']).success)
+
+    def test_output_limit(self):
+        self.helper._limit = 1024
+        result = self.helper.run(['head', '-c', '1048576', '/dev/zero'])
+        self.assertTrue(result.success)
+        self.assertTrue(result.truncated)
+        self.assertEqual(result.stdout, '\0' * 1024)
+
+    def test_cancel(self):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.helper.run(['sleep', '30'])))
+        thread.start()
+        while not self.helper._pending:
+            time.sleep(0.01)
+        self.helper.cancel_all()
+        thread.join(5)
+        self.assertTrue(results[0].cancelled)
+        self.assertFalse(results[0].success)
+
+    def test_concurrency(self):
+        started = time.time()
+        threads = [threading.Thread(target=self.helper.run, args=(['sleep', '0.5'],))
+                for x in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLess(time.time() - started, 1.5)
+
+    def test_restart(self):
+        self.helper.start()
+        os.kill(self.helper._proc.pid, signal.SIGKILL)
+        for x in range(100):
+            if not self.helper.running:
+                break
+            time.sleep(0.05)
+        self.assertFalse(self.helper.running)
+        self.assertEqual(self.helper.run(['true']).code, 0)
+
+tests = [
+        TestCommandHelper,
+        ]
+
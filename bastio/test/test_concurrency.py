@@ -13,6 +13,9 @@ __license__ = "GPLv3+"
 
 import time
 import unittest
+import tempfile
+import threading
+import collections
 
 try:
     import queue
@@ -20,8 +23,11 @@ except ImportError:
     # Python 2.x
     import Queue as queue
 
-from bastio.concurrency import ThreadPool, Task, Failure
+from bastio.concurrency import (ThreadPool, Task, Failure, LaneQueue,
+        KeyedExecutor, GroupCommit)
 from bastio.configs import GlobalConfigStore
+from bastio.metrics import GlobalMetrics
+from bastio.journal import Journal
 
 class TestTask(unittest.TestCase):
     def test_task(self):
@@ -90,8 +96,218 @@ class TestThreadPool(unittest.TestCase):
     def __test_counter(kill_event, arg):
         arg['counter'] += 1
 
+class TestLaneQueue(unittest.TestCase):
+    def test_lane_order(self):
+        q = LaneQueue(lanes=2, lane_of=lambda x: x[0], name='test_order')
+        for item in [(1, 'a'), (1, 'b'), (0, 'c'), (1, 'd'), (0, 'e')]:
+            q.put(item)
+        self.assertEqual(q.qsize(), 5)
+        self.assertEqual(q.lane_size(0), 2)
+        res = [q.get_nowait()[1] for x in range(5)]
+        self.assertEqual(res, ['c', 'e', 'a', 'b', 'd'])
+        with self.assertRaises(queue.Empty):
+            q.get_nowait()
+
+    def test_key_promotion(self):
+        q = LaneQueue(lanes=2, lane_of=lambda x: x[0], key_of=lambda x: x[1],
+                name='test_promotion')
+        for item in [(1, 'u1', 1), (1, 'u2', 2), (1, 'u1', 3), (0, 'u1', 4),
+                (0, 'u3', 5)]:
+            q.put(item)
+        res = [q.get_nowait()[2] for x in range(5)]
+        self.assertEqual(res, [1, 3, 4, 5, 2])
+
+    def test_supersede(self):
+        superseded = []
+        q = LaneQueue(lanes=2, lane_of=lambda x: x[0], key_of=lambda x: x[1],
+                name='test_supersede',
+                supersedes=lambda item, pending: pending[2] == -item[2],
+                superseded=lambda pending, item: superseded.append((pending, item)))
+        for item in [(1, 'u1', 1), (1, 'u2', 2), (1, 'u1', 3), (0, 'u1', -1),
+                (1, 'u2', -3)]:
+            q.put(item)
+        self.assertEqual(superseded, [((1, 'u1', 1), (0, 'u1', -1))])
+        self.assertEqual(q.qsize(), 4)
+        res = [q.get_nowait()[2] for x in range(4)]
+        self.assertEqual(res, [3, -1, 2, -3])
+
+    def test_barrier(self):
+        superseded = []
+        q = LaneQueue(lanes=2, lane_of=lambda x: x[0], key_of=lambda x: x[1],
+                name='test_barrier',
+                supersedes=lambda item, pending: pending[2] == -item[2],
+                superseded=lambda pending, item: superseded.append(pending),
+                barrier_of=lambda x: x[1] is None)
+        for item in [(1, 'u1', 1), (1, 'u1', 2), (0, 'u2', 3), (0, None, 4),
+                (1, 'u1', 5), (0, 'u1', -2), (0, 'u3', 6), (0, 'u1', -5)]:
+            q.put(item)
+        # Nothing jumps over the barrier in either direction
+        self.assertEqual(superseded, [(1, 'u1', 5)])
+        self.assertEqual(q.lane_size(1), 0)
+        res = [q.get_nowait()[2] for x in range(7)]
+        self.assertEqual(res, [3, 1, 2, 4, -2, 6, -5])
+
+    def test_interrupt(self):
+        q = LaneQueue(name='test_interrupt')
+        threading.Timer(0.1, q.interrupt).start()
+        started = time.time()
+        with self.assertRaises(queue.Empty):
+            q.get(timeout=5)
+        self.assertLess(time.time() - started, 1)
+        q.put(1)
+        self.assertEqual(q.get(timeout=5), 1)
+
+    def test_journal(self):
+        journal = tempfile.NamedTemporaryFile()
+        q = LaneQueue(name='test_journal', journal=Journal(journal.name, 4),
+                record_of=lambda x: (str(x), str(x * 2)))
+        q.put(1)
+        q.put(2)
+        self.assertEqual(Journal(journal.name, 4).replay(),
+                [('1', '2'), ('2', '4')])
+
+    def test_duplicate(self):
+        journal = tempfile.NamedTemporaryFile()
+        wal = Journal(journal.name, 4)
+        duplicates = []
+        q = LaneQueue(name='test_duplicate', journal=wal,
+                record_of=lambda x: (str(x), str(x)), duplicate=duplicates.append)
+        q.put(1)
+        q.put(1)
+        self.assertEqual((q.qsize(), duplicates), (1, [1]))
+        # The consumer is woken up to attend to the duplicate
+        self.assertEqual(q.get(timeout=5), 1)
+        with self.assertRaises(queue.Empty):
+            q.get(timeout=0)
+        q.put(1)
+        self.assertEqual(duplicates, [1, 1])
+        wal.ack('1')
+        q.put(1)
+        self.assertEqual(q.get(timeout=5), 1)
+
+    def test_lane_metrics(self):
+        q = LaneQueue(lanes=2, lane_of=lambda x: x, name='test_metrics')
+        q.put(0)
+        q.put(1)
+        q.put(1)
+        metrics = GlobalMetrics()
+        self.assertEqual(metrics.counter('test_metrics.lane0.depth').value, 1)
+        self.assertEqual(metrics.counter('test_metrics.lane1.depth').value, 2)
+        q.get_nowait()
+        self.assertEqual(metrics.counter('test_metrics.lane0.depth').value, 0)
+        self.assertEqual(metrics.stats('test_metrics.lane0.wait').count, 1)
+
+    def test_watermarks(self):
+        q = LaneQueue(maxsize=4, high_watermark=3, low_watermark=1,
+                name='test_watermarks')
+        q.put(1)
+        q.put(2)
+        self.assertFalse(q.throttled())
+        q.put(3)
+        self.assertTrue(q.throttled())
+        q.get_nowait()
+        self.assertTrue(q.throttled())
+        q.get_nowait()
+        self.assertFalse(q.throttled())
+        q.put(4)
+        q.put(5)
+        q.put(6)
+        with self.assertRaises(queue.Full):
+            q.put_nowait(7)
+
+    def test_watermarks_supersede(self):
+        q = LaneQueue(high_watermark=3, low_watermark=1, key_of=lambda x: x[0],
+                name='test_watermarks_supersede',
+                supersedes=lambda item, pending: item[1] == 'remove',
+                superseded=lambda pending, item: None)
+        for x in range(3):
+            q.put(('u1', x))
+        self.assertTrue(q.throttled())
+        # Putting an item that supersedes the pending ones drops below the
+        # low watermark
+        q.put(('u1', 'remove'))
+        self.assertEqual(q.qsize(), 1)
+        self.assertFalse(q.throttled())
+
+class TestKeyedExecutor(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = collections.defaultdict(int)
+        self.peak = collections.defaultdict(int)
+        self.order = []
+
+    def _job(self, key, seq, exclusive=False):
+        with self.lock:
+            for name in (key, 'exclusive' if exclusive else None, 'all'):
+                self.running[name] += 1
+                self.peak[name] = max(self.peak[name], self.running[name])
+        time.sleep(0.05)
+        with self.lock:
+            for name in (key, 'exclusive' if exclusive else None, 'all'):
+                self.running[name] -= 1
+            self.order.append((key, seq))
+
+    def test_keyed_executor(self):
+        pool = ThreadPool(8)
+        self.addCleanup(pool.remove_all_workers, 1)
+        executor = KeyedExecutor(pool, name='test_executor')
+        for seq in range(4):
+            for key in ('a', 'b', 'c'):
+                exclusive = seq % 2 == 0
+                executor.submit(key, self._job, key, seq, exclusive,
+                        exclusive=exclusive)
+        for x in range(100):
+            if len(self.order) == 12:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(self.order), 12)
+        for key in ('a', 'b', 'c'):
+            self.assertEqual(self.peak[key], 1)
+            self.assertEqual([s for k, s in self.order if k == key], range(4))
+            self.assertEqual(executor.pending(key), 0)
+        self.assertEqual(self.peak['exclusive'], 1)
+        self.assertGreater(self.peak['all'], 1)
+
+class TestGroupCommit(unittest.TestCase):
+    def test_group_commit(self):
+        batches = []
+        def apply(items):
+            batches.append(items)
+            time.sleep(0.05)
+            return [ValueError(x) if x % 3 == 0 else x * 2 for x in items]
+        batcher = GroupCommit(apply, max_batch=4, delay=0.1, name='test_batch')
+        results = {}
+        def submit(x):
+            try:
+                results[x] = batcher.submit(x)
+            except ValueError as ex:
+                results[x] = ex
+        threads = [threading.Thread(target=submit, args=(x,)) for x in range(1, 11)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(sum(batches, [])), range(1, 11))
+        self.assertLess(len(batches), 10)
+        self.assertTrue(all(len(batch) <= 4 for batch in batches))
+        for x in range(1, 11):
+            if x % 3 == 0:
+                self.assertIsInstance(results[x], ValueError)
+            else:
+                self.assertEqual(results[x], x * 2)
+
+    def test_apply_error(self):
+        def apply(items):
+            raise RuntimeError("failed")
+        batcher = GroupCommit(apply, delay=0, name='test_batch')
+        with self.assertRaises(RuntimeError):
+            batcher.submit(1)
+
 tests = [
         TestTask,
         TestThreadPool,
+        TestLaneQueue,
+        TestKeyedExecutor,
+        TestGroupCommit,
         ]
 
@@ -45,6 +45,15 @@ test1_float = 44.3
         self.assertEqual(cfg.get_test_test1_value, 'hello')
         self.assertEqual(cfg.getfloat_test_test1_float, 44.3)
 
+        # Test option look ups with defaults
+        self.assertEqual(cfg.lookup('test_int', 0, int), 434)
+        self.assertEqual(cfg.lookup('test_missing', 4.5, float), 4.5)
+        cfg.test_bool = 'yes'
+        self.assertTrue(cfg.lookup('test_bool', False, bool))
+        cfg.test_invalid = 'invalid'
+        with self.assertRaises(BastioConfigError):
+            cfg.lookup('test_invalid', 0, int)
+
     def tearDown(self):
         os.unlink(self._conffile)
 
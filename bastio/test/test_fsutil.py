@@ -0,0 +1,157 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.test.test_fsutil
+:synopsis: Unit tests for the fsutil module.
+:author: Amr Ali <amr@databracket.com>
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import stat
+import shutil
+import unittest
+import time
+import tempfile
+
+from bastio.fsutil import atomic_write, FileLock, LinkLock, DirectoryLock, Trash
+from bastio.concurrency import GlobalThreadPool
+from bastio.metrics import GlobalMetrics
+from bastio.excepts import BastioLockError
+
+class TestAtomicWrite(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'file')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_atomic_write(self):
+        atomic_write(self.path, 'hello', 0640)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0640)
+        os.chmod(self.path, 0600)
+        atomic_write(self.path, 'world')
+        with open(self.path, 'rb') as fd:
+            self.assertEqual(fd.read(), 'world')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+        self.assertEqual(os.listdir(self.tmpdir), ['file'])
+
+class TestLocks(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'file')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_file_lock(self):
+        with FileLock(self.path, 0.1):
+            # Record locks are per process, so check it from a child
+            pid = os.fork()
+            if not pid:
+                try:
+                    FileLock(self.path, 0.1).acquire()
+                except BastioLockError:
+                    os._exit(0)
+                os._exit(1)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(os.WEXITSTATUS(status), 0)
+        with FileLock(self.path, 0.1):
+            pass
+
+    def test_link_lock(self):
+        with LinkLock(self.path, 0.1):
+            self.assertTrue(os.path.exists(self.path + '.lock'))
+            with self.assertRaises(BastioLockError):
+                LinkLock(self.path, 0.1).acquire()
+        self.assertFalse(os.path.exists(self.path + '.lock'))
+
+    def test_directory_lock(self):
+        with DirectoryLock(self.tmpdir, 0.1):
+            # flock locks are per open file description
+            with self.assertRaises(BastioLockError):
+                DirectoryLock(self.tmpdir, 0.1).acquire()
+        with DirectoryLock(self.tmpdir, 0.1):
+            pass
+        os.symlink(self.tmpdir, self.path)
+        with self.assertRaises(BastioLockError):
+            DirectoryLock(self.path, 0.1).acquire()
+
+    def test_directory_lock_entry(self):
+        lockdir = os.path.join(self.tmpdir, 'dir')
+        os.mkdir(lockdir)
+        with DirectoryLock(lockdir, 0.1) as lock:
+            # Entries are reached through the locked directory even if its
+            # path is made to point elsewhere
+            os.rename(lockdir, lockdir + '.old')
+            os.symlink(self.tmpdir, lockdir)
+            atomic_write(lock.entry('file'), 'data')
+        self.assertEqual(os.listdir(lockdir + '.old'), ['file'])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_stale_link_lock(self):
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        with open(self.path + '.lock', 'wb') as fd:
+            fd.write(str(pid))
+        with LinkLock(self.path, 0.1):
+            pass
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+class TestTrash(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.home = os.path.join(self.tmpdir, 'bob')
+        os.makedirs(os.path.join(self.home, 'a', 'b'))
+        for name in ('x', 'a/y', 'a/b/z'):
+            with open(os.path.join(self.home, name), 'wb') as fd:
+                fd.write('data')
+        os.symlink('/etc', os.path.join(self.home, 'a', 'link'))
+        self.trash_dir = os.path.join(self.tmpdir, Trash.DirName)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_empty(self):
+        metrics = GlobalMetrics()
+        files, size = metrics.counter('trash.files').value, \
+                metrics.counter('trash.bytes').value
+        trash = Trash(batch=2, pause=0.01)
+        self.assertTrue(trash.put(self.home))
+        self.assertFalse(trash.put(self.home))
+        self.assertFalse(os.path.exists(self.home))
+        self.assertEqual(len(os.listdir(self.trash_dir)), 1)
+        trash.empty()
+        self.assertEqual(os.listdir(self.trash_dir), [])
+        self.assertTrue(os.path.isdir('/etc'))
+        self.assertEqual(metrics.counter('trash.files').value - files, 6)
+        self.assertEqual(metrics.counter('trash.bytes').value - size, 16)
+
+    def test_background(self):
+        GlobalThreadPool()
+        # Trash left behind by an earlier run
+        os.mkdir(self.trash_dir)
+        os.rename(self.home, os.path.join(self.trash_dir, 'bob.0'))
+        trash = Trash()
+        trash.start()
+        try:
+            trash.watch(self.tmpdir)
+            deadline = time.time() + 10
+            while os.listdir(self.trash_dir) and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(os.listdir(self.trash_dir), [])
+        finally:
+            trash.stop()
+
+tests = [
+        TestAtomicWrite,
+        TestLocks,
+        TestTrash,
+        ]
@@ -0,0 +1,171 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.test.test_journal
+:synopsis: Unit tests for the journal module.
+:author: Amr Ali <amr@databracket.com>
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import mmap
+import errno
+import subprocess
+import shutil
+import unittest
+import tempfile
+
+from bastio.journal import Journal
+from bastio.configs import GlobalConfigStore
+from bastio.excepts import BastioJournalError
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_replay(self):
+        journal = Journal(self.path, 4)
+        journal.append('a', 'data a')
+        journal.append('b', 'data b')
+        journal.append('a', 'data a again')
+        journal.append('c', 'data c')
+        journal.ack('b')
+        journal.ack('x')
+        self.assertEqual(len(journal), 2)
+        self.assertIn('a', journal)
+        self.assertNotIn('b', journal)
+        journal.close()
+
+        journal = Journal(self.path, 4)
+        self.assertEqual(journal.replay(), [('a', 'data a'), ('c', 'data c')])
+        journal.close()
+
+    def test_torn_record(self):
+        journal = Journal(self.path, 4)
+        journal.append('a', 'data a')
+        journal.close()
+        with open(self.path, 'r+b') as fd:
+            data = fd.read()
+            end = data.index('\0')
+            fd.seek(end)
+            fd.write('27:["+","b","da')
+        journal = Journal(self.path, 4)
+        self.assertEqual(journal.replay(), [('a', 'data a')])
+        journal.append('c', 'data c')
+        journal.close()
+        journal = Journal(self.path, 4)
+        self.assertEqual(journal.replay(), [('a', 'data a'), ('c', 'data c')])
+        journal.close()
+
+    def test_compaction(self):
+        journal = Journal(self.path, 4)
+        for x in range(1000):
+            journal.append(str(x), 'x' * 64)
+            if x % 10:
+                journal.ack(str(x))
+        journal.sync()
+        self.assertEqual(len(journal), 100)
+        self.assertLess(os.path.getsize(self.path), 64 * 1024)
+        self.assertFalse(os.path.exists(self.path + '.compact'))
+        journal.close()
+        journal = Journal(self.path, 4)
+        self.assertEqual([key for key, _ in journal.replay()],
+                [str(x) for x in range(0, 1000, 10)])
+        journal.close()
+
+    def test_growth(self):
+        journal = Journal(self.path, 4)
+        for x in range(100):
+            journal.append(str(x), 'x' * 1024)
+        self.assertGreaterEqual(os.path.getsize(self.path), 100 * 1024)
+        journal.close()
+        self.assertEqual(len(Journal(self.path, 4).replay()), 100)
+
+    def test_failed_compaction(self):
+        def fail(*args, **kwargs):
+            raise mmap.error(errno.ENOMEM, os.strerror(errno.ENOMEM))
+        journal = Journal(self.path, 4)
+        remap, mmap.mmap = mmap.mmap, fail
+        try:
+            for x in range(100):
+                journal.append(str(x), 'x' * 64)
+            for x in range(0, 100, 2):
+                journal.ack(str(x))
+            journal.sync()
+        finally:
+            mmap.mmap = remap
+        self.assertFalse(os.path.exists(self.path + '.compact'))
+        keys = [str(x) for x in range(1, 100, 2)]
+        self.assertEqual([key for key, _ in journal.replay()], keys)
+        # Records that did not fit are written by the next compaction
+        journal.close()
+        journal = Journal(self.path, 4)
+        self.assertEqual(journal.replay(), [(key, 'x' * 64) for key in keys])
+        journal.close()
+
+    def test_preallocation(self):
+        journal = Journal(self.path, 4)
+        for x in range(100):
+            journal.append(str(x), 'x' * 1024)
+        # Mapped pages are backed by allocated blocks, not by holes
+        st = os.stat(self.path)
+        self.assertGreaterEqual(st.st_size, 100 * 1024)
+        self.assertGreaterEqual(st.st_blocks * 512, st.st_size)
+        journal.close()
+
+    def test_open(self):
+        cfg = GlobalConfigStore()
+        state_dir = cfg.state_dir
+        try:
+            cfg.state_dir = os.path.join(self.tmpdir, 'state')
+            journal = Journal.open('test.journal')
+            self.assertTrue(os.path.exists(os.path.join(cfg.state_dir,
+                'test.journal')))
+            journal.close()
+            cfg.state_dir = os.path.join(self.path, 'state')
+            with open(self.path, 'w') as fd:
+                fd.write('not a directory')
+            with self.assertRaises(BastioJournalError):
+                Journal.open('test.journal')
+        finally:
+            cfg.state_dir = state_dir
+
+@unittest.skipIf(os.getuid() != 0, "this test case requires root access")
+class TestJournalDiskFull(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.journal')
+        with open(os.devnull, 'wb') as null:
+            if subprocess.call(['mount', '-t', 'tmpfs', '-o', 'size=64k',
+                'tmpfs', self.tmpdir], stdout=null, stderr=null):
+                shutil.rmtree(self.tmpdir)
+                self.skipTest("unable to mount a tmpfs")
+
+    def tearDown(self):
+        subprocess.call(['umount', self.tmpdir])
+        shutil.rmtree(self.tmpdir)
+
+    def test_disk_full(self):
+        journal = Journal(self.path, 4)
+        # Records keep being appended once the disk is full
+        for x in range(100):
+            journal.append(str(x), 'x' * 1024)
+        journal.sync()
+        self.assertEqual(len(journal), 100)
+        self.assertEqual(len(journal.replay()), 100)
+        self.assertFalse(os.path.exists(self.path + '.compact'))
+        journal.close()
+        self.assertGreater(len(Journal(self.path, 4)), 0)
+
+tests = [
+        TestJournal,
+        TestJournalDiskFull,
+        ]
@@ -0,0 +1,60 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.test.test_metrics
+:synopsis: Unit tests for the metrics module.
+:author: Amr Ali <amr@databracket.com>
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import unittest
+
+from bastio.metrics import Counter, RollingStats, Metrics, GlobalMetrics
+
+class TestCounter(unittest.TestCase):
+    def test_counter(self):
+        counter = Counter()
+        counter.inc()
+        counter.inc(5)
+        counter.dec(2)
+        self.assertEqual(counter.value, 4)
+        counter.set(10)
+        self.assertEqual(counter.value, 10)
+
+class TestRollingStats(unittest.TestCase):
+    def test_rolling_stats(self):
+        stats = RollingStats(window=10)
+        self.assertIsNone(stats.average)
+        self.assertIsNone(stats.percentile(50))
+        for x in range(1, 101):
+            stats.add(x)
+        self.assertEqual(stats.count, 100)
+        self.assertEqual(stats.last, 100)
+        # Only the last 10 samples are in the window
+        self.assertEqual(stats.percentile(0), 91)
+        self.assertEqual(stats.percentile(100), 100)
+        self.assertGreater(stats.average, 50)
+        self.assertLess(stats.average, 100)
+        self.assertIn('p99', stats.snapshot())
+
+class TestMetrics(unittest.TestCase):
+    def test_metrics(self):
+        metrics = Metrics()
+        metrics.counter('test.counter').inc(3)
+        metrics.stats('test.stats').add(0.5)
+        self.assertIs(metrics.counter('test.counter'),
+                metrics.counter('test.counter'))
+        snap = metrics.snapshot()
+        self.assertEqual(snap['test.counter'], 3)
+        self.assertEqual(snap['test.stats']['last'], 0.5)
+        self.assertIs(GlobalMetrics(), GlobalMetrics())
+
+tests = [
+        TestCounter,
+        TestRollingStats,
+        TestMetrics,
+        ]
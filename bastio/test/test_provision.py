@@ -0,0 +1,208 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.test.test_provision
+:synopsis: Unit tests for the provision module.
+:author: Amr Ali <amr@databracket.com>
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import shutil
+import socket
+import unittest
+import threading
+
+from bastio.provision import (Provisioner, NativeProvisioner, CommandProvisioner,
+        NssCacheProvisioner)
+from bastio.concurrency import GroupCommit
+from bastio.userdb import AccountIndex
+from bastio.journal import Journal
+from bastio.fsutil import Trash
+from bastio.excepts import BastioProvisionError, BastioConfigError
+from bastio.test.test_userdb import make_root
+
+class TestProvisioner(unittest.TestCase):
+    def test_create(self):
+        self.assertIsInstance(Provisioner.create('native'), NativeProvisioner)
+        self.assertIsInstance(Provisioner.create('command'), CommandProvisioner)
+        with self.assertRaises(BastioConfigError):
+            Provisioner.create('unknown')
+
+@unittest.skipIf(os.getuid() != 0, "this test case requires root access")
+class TestNativeProvisioner(unittest.TestCase):
+    def setUp(self):
+        self.root = make_root()
+        self.prov = NativeProvisioner(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _read(self, name):
+        with open(os.path.join(self.root, 'etc', name), 'rb') as fd:
+            return fd.read()
+
+    def test_add_remove_user(self):
+        self.prov.add_user('bob', True)
+        self.assertIn("bob:x:1001:1001::/home/bob:/bin/bash\n", self._read('passwd'))
+        self.assertIn("sudo:x:27:alice,bob\n", self._read('group'))
+        home = os.path.join(self.root, 'home', 'bob')
+        self.assertEqual(os.stat(home).st_mode & 0777, 0755)
+        self.assertEqual(os.stat(os.path.join(home, '.config', 'app')).st_uid, 1001)
+        with self.assertRaises(BastioProvisionError):
+            self.prov.add_user('bob', False)
+
+        self.prov.remove_user('bob')
+        self.assertFalse(os.path.exists(home))
+        # The home directory is deleted in the background
+        trash = os.path.join(self.root, 'home', Trash.DirName)
+        self.assertEqual(len(os.listdir(trash)), 1)
+        self.prov._trash.empty()
+        self.assertEqual(os.listdir(trash), [])
+        for name in ('passwd', 'shadow', 'group', 'gshadow'):
+            self.assertNotIn('bob', self._read(name))
+        with self.assertRaises(BastioProvisionError):
+            self.prov.remove_user('bob')
+
+    def test_add_users(self):
+        batches = []
+        def add_users(requests):
+            batches.append(requests)
+            return self.prov.add_users(requests)
+        self.prov._adds = GroupCommit(add_users, delay=0.2)
+        errors = {}
+        def add(username):
+            try:
+                self.prov.add_user(username, False)
+            except BastioProvisionError as ex:
+                errors[username] = ex
+        threads = [threading.Thread(target=add, args=(name,))
+                for name in ('bob', 'carol', 'dave')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(batches), 1)
+        # Only two UIDs are left in the range
+        self.assertEqual(len(errors), 1)
+        passwd = self._read('passwd')
+        for name in ('bob', 'carol', 'dave'):
+            self.assertEqual(name in passwd, name not in errors)
+            self.assertEqual(os.path.isdir(os.path.join(self.root, 'home', name)),
+                    name not in errors)
+
+    def test_existing_home(self):
+        # Like useradd, a home directory that already exists is kept as it is
+        home = os.path.join(self.root, 'home', 'bob')
+        os.makedirs(home, 0700)
+        self.prov.add_user('bob', False)
+        self.assertIn("bob:x:1001:1001::/home/bob:/bin/bash\n", self._read('passwd'))
+        st = os.stat(home)
+        self.assertEqual((st.st_uid, st.st_mode & 0777), (0, 0700))
+        self.assertEqual(os.listdir(home), [])
+
+    def test_home_failure(self):
+        # A skeleton that can't be copied fails the user and removes it again
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.bind(os.path.join(self.root, 'etc', 'skel', 'socket'))
+            with self.assertRaises(BastioProvisionError):
+                self.prov.add_user('bob', True)
+        finally:
+            sock.close()
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'home', 'bob')))
+        for name in ('passwd', 'shadow', 'group', 'gshadow'):
+            self.assertNotIn('bob', self._read(name))
+        os.unlink(os.path.join(self.root, 'etc', 'skel', 'socket'))
+        self.prov.add_user('bob', False)
+
+    def test_set_sudo(self):
+        self.prov.set_sudo('alice', True)
+        self.prov.set_sudo('alice', False)
+        self.assertIn("sudo:x:27:\n", self._read('group'))
+        with self.assertRaises(BastioProvisionError):
+            self.prov.set_sudo('alice', False)
+        with self.assertRaises(BastioProvisionError):
+            self.prov.set_sudo('nobody', True)
+
+@unittest.skipIf(os.getuid() != 0, "this test case requires root access")
+class TestNssCacheProvisioner(unittest.TestCase):
+    def setUp(self):
+        self.root = make_root()
+        self.journal = os.path.join(self.root, 'accounts.journal')
+        self.prov = NssCacheProvisioner(self.root, journal=Journal(self.journal))
+
+    def tearDown(self):
+        self.prov.stop()
+        shutil.rmtree(self.root)
+
+    def _read(self, name):
+        with open(os.path.join(self.root, 'etc', name), 'rb') as fd:
+            return fd.read()
+
+    def test_add_remove_user(self):
+        passwd = self._read('passwd')
+        self.prov.add_user('bob', True)
+        self.prov.add_user('carol', False)
+        self.assertEqual(self._read('passwd'), passwd)
+        self.assertEqual(self._read('passwd.cache'),
+                "bob:x:1001:1001::/home/bob:/bin/bash\n"
+                "carol:x:1002:1002::/home/carol:/bin/bash\n")
+        self.assertEqual(self._read('passwd.cache.ixname'),
+                "bob" + "\0" * 3 + "00\n" "carol\0" "37\n")
+        self.assertEqual(self._read('passwd.cache.ixuid'),
+                "1001\0" "00\n" "1002\0" "37\n")
+        self.assertIn("sudo:x:27:bob\n", self._read('group.cache'))
+        home = os.path.join(self.root, 'home', 'bob')
+        self.assertEqual(os.stat(home).st_uid, 1001)
+        index = AccountIndex(self.root)
+        self.assertEqual(index.user('carol')[2], '1002')
+        self.assertTrue(index.is_member('sudo', 'bob'))
+        with self.assertRaises(BastioProvisionError):
+            self.prov.add_user('bob', False)
+        with self.assertRaises(BastioProvisionError):
+            self.prov.add_user('alice', False)
+        # Only two UIDs are left in the range
+        with self.assertRaises(BastioProvisionError):
+            self.prov.add_user('dave', False)
+
+        self.prov.remove_user('bob')
+        self.assertFalse(os.path.exists(home))
+        self.assertNotIn('bob', self._read('passwd.cache'))
+        self.assertNotIn('bob', self._read('group.cache'))
+        self.assertFalse(index.has_user('bob'))
+        with self.assertRaises(BastioProvisionError):
+            self.prov.remove_user('bob')
+
+        # Users are kept across restarts
+        self.prov.stop()
+        self.prov = NssCacheProvisioner(self.root, journal=Journal(self.journal))
+        os.unlink(os.path.join(self.root, 'etc', 'passwd.cache'))
+        self.prov.add_user('dave', False)
+        self.assertEqual(self._read('passwd.cache'),
+                "dave:x:1001:1001::/home/dave:/bin/bash\n"
+                "carol:x:1002:1002::/home/carol:/bin/bash\n")
+
+    def test_set_sudo(self):
+        self.prov.add_user('bob', False)
+        self.prov.set_sudo('bob', True)
+        self.assertIn("sudo:x:27:bob\n", self._read('group.cache'))
+        self.prov.set_sudo('bob', False)
+        self.assertNotIn("sudo", self._read('group.cache'))
+        with self.assertRaises(BastioProvisionError):
+            self.prov.set_sudo('bob', False)
+        # Local users are left to the native provisioner
+        self.prov.set_sudo('alice', False)
+        self.assertIn("sudo:x:27:\n", self._read('group'))
+        with self.assertRaises(BastioProvisionError):
+            self.prov.set_sudo('nobody', True)
+
+tests = [
+        TestProvisioner,
+        TestNativeProvisioner,
+        TestNssCacheProvisioner,
+        ]
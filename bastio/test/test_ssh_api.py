@@ -12,31 +12,64 @@ __copyright__ = "Copyright 2013 Databracket LLC"
 __license__ = "GPLv3+"
 
 import os
+import time
+import shutil
 import unittest
+import tempfile
+import threading
 
-from bastio.ssh.api import Processor
+from bastio.ssh.api import Processor, ReplayCache
 from bastio.ssh.crypto import RSAKey
 from bastio.ssh.protocol import (FeedbackMessage, AddUserMessage,
-        RemoveUserMessage, UpdateUserMessage, AddKeyMessage, RemoveKeyMessage)
+        RemoveUserMessage, UpdateUserMessage, AddKeyMessage, RemoveKeyMessage,
+        SyncStateMessage, StateDigestMessage)
+from bastio.ssh.digest import StateDigest
+from bastio.ssh.authkeys import AuthorizedKey
 from bastio.concurrency import GlobalThreadPool
+from bastio.configs import GlobalConfigStore
+from bastio.journal import Journal
+from bastio.metrics import GlobalMetrics
+from bastio.excepts import BastioProvisionError
 
 @unittest.skipIf(os.getuid() != 0, "this test case requires root access")
 class TestProcessor(unittest.TestCase):
+    # Tests that run without the user every other test starts with
+    Unprovisioned = ('test_replay',)
 
     @classmethod
     def setUpClass(cls):
         cls._public_key = RSAKey.generate(1024).get_public_key()
+        cls._state_dir = tempfile.mkdtemp()
+        GlobalConfigStore().state_dir = cls._state_dir
+        # Leave an incomplete action behind as if the agent crashed
+        cls._incomplete = RemoveUserMessage(username="test_replay_user")
+        wal = Journal.open(Processor.JournalName)
+        wal.append(cls._incomplete.mid, cls._incomplete.to_json())
+        wal.close()
         cls._proc = Processor()
 
     @classmethod
     def tearDownClass(cls):
         cls._proc.stop()
+        shutil.rmtree(cls._state_dir)
 
     def setUp(self):
-        self._add_user(FeedbackMessage.SUCCESS, sudo=False)
+        # Replaying must not depend on provisioning working
+        self._provisioned = self._testMethodName not in self.Unprovisioned
+        if self._provisioned:
+            self._add_user(FeedbackMessage.SUCCESS, sudo=False)
 
     def tearDown(self):
-        self._remove_user(FeedbackMessage.SUCCESS)
+        if self._provisioned:
+            self._remove_user(FeedbackMessage.SUCCESS)
+
+    def test_replay(self):
+        fb = self._proc.endpoint().egress.get(timeout=10)
+        self.assertEqual(fb.mid, self._incomplete.mid)
+        self._assert_feedback(fb, FeedbackMessage.INFO)
+        wal = Journal.open(Processor.JournalName)
+        self.assertNotIn(self._incomplete.mid, wal)
+        wal.close()
 
     def test_add_remove_user(self):
         self._add_user(FeedbackMessage.INFO, sudo=False)
@@ -53,6 +86,51 @@ class TestProcessor(unittest.TestCase):
         self._remove_key(FeedbackMessage.SUCCESS)
         self._remove_key(FeedbackMessage.INFO)
 
+    def test_expiry(self):
+        path = '/home/test_user/.ssh/authorized_keys'
+        fingerprint = AuthorizedKey.parse(self._public_key).fingerprint
+        try:
+            self._add_key(FeedbackMessage.SUCCESS, expires_at=time.time() + 3600)
+            self.assertIsNotNone(self._proc._expiry.get('test_user', fingerprint))
+            # Adding the key again without a deadline makes it permanent
+            self._add_key(FeedbackMessage.INFO)
+            self.assertIsNone(self._proc._expiry.get('test_user', fingerprint))
+            expires_at = time.time() + 0.5
+            self._add_key(FeedbackMessage.INFO, expires_at=expires_at)
+            self._proc_message(AddUserMessage(username="test_expire_user",
+                sudo=False, expires_at=expires_at), FeedbackMessage.SUCCESS)
+            deadline = time.time() + 10
+            while time.time() < deadline and len(self._proc._expiry):
+                time.sleep(0.05)
+            self.assertEqual(len(self._proc._expiry), 0)
+            # Access is revoked right at the deadline
+            self.assertLess(time.time() - expires_at, 1.5)
+            self.assertFalse(os.path.exists('/home/test_expire_user'))
+            with open(path, 'rb') as fd:
+                self.assertEqual(fd.read(), '')
+        finally:
+            self._proc.process(RemoveUserMessage(username="test_expire_user"))
+
+    def test_key_batch(self):
+        keys = [RSAKey.generate(1024).get_public_key() for x in range(3)]
+        writes = GlobalMetrics().counter('authkeys.writes')
+        count = writes.value
+        messages = [AddKeyMessage(username="test_user", public_key=keys[0]),
+                AddKeyMessage(username="test_user", public_key=keys[1]),
+                AddKeyMessage(username="test_user", public_key=keys[0]),
+                RemoveKeyMessage(username="test_user", public_key=keys[1]),
+                RemoveKeyMessage(username="test_user", public_key=keys[2])]
+        statuses = [fb.status for fb in self._proc.process_keys(messages)]
+        self.assertEqual(statuses, [FeedbackMessage.SUCCESS, FeedbackMessage.SUCCESS,
+            FeedbackMessage.INFO, FeedbackMessage.SUCCESS, FeedbackMessage.INFO])
+        self.assertEqual(writes.value, count + 1)
+        path = '/home/test_user/.ssh/authorized_keys'
+        with open(path, 'rb') as fd:
+            self.assertEqual(fd.read(), keys[0] + '\n')
+        st = os.stat(path)
+        self.assertEqual(st.st_mode & 0777, 0600)
+        self.assertNotEqual(st.st_uid, 0)
+
     def test_update_user(self):
         self._remove_user(FeedbackMessage.SUCCESS)
         self._update_user(FeedbackMessage.ERROR, sudo=False)
@@ -61,6 +139,80 @@ class TestProcessor(unittest.TestCase):
         self._update_user(FeedbackMessage.SUCCESS, sudo=False)
         self._update_user(FeedbackMessage.ERROR, sudo=False)
 
+    def test_sync_state(self):
+        key = self._public_key
+        path = '/home/{}/.ssh/authorized_keys'
+        users = [{'username': 'test_user', 'sudo': True, 'keys': [key]},
+                {'username': 'test_sync_user', 'sudo': False, 'keys': [key]}]
+        try:
+            self._proc_message(SyncStateMessage(users=users), FeedbackMessage.SUCCESS)
+            self._update_user(FeedbackMessage.SUCCESS, sudo=False)
+            self._update_user(FeedbackMessage.SUCCESS, sudo=True)
+            for username in ('test_user', 'test_sync_user'):
+                with open(path.format(username), 'rb') as fd:
+                    self.assertEqual(fd.read(), key + '\n')
+            self._proc_message(SyncStateMessage(users=users), FeedbackMessage.INFO)
+            users = [{'username': 'test_user', 'sudo': False, 'keys': []}]
+            self._proc_message(SyncStateMessage(users=users), FeedbackMessage.SUCCESS)
+            self.assertFalse(os.path.exists('/home/test_sync_user'))
+            self._update_user(FeedbackMessage.ERROR, sudo=False)
+            with open(path.format('test_user'), 'rb') as fd:
+                self.assertEqual(fd.read(), '')
+        finally:
+            self._proc.process(RemoveUserMessage(username="test_sync_user"))
+
+    def test_sync_local_user(self):
+        # A user the agent did not create is never removed by a sync-state
+        self._proc._provisioner.add_user('test_local_user', False)
+        try:
+            os.mkdir('/home/test_local_user/.ssh', 0700)
+            users = [{'username': 'test_user', 'sudo': False, 'keys': []},
+                    {'username': 'test_local_user', 'sudo': False,
+                        'keys': [self._public_key]}]
+            self._proc_message(SyncStateMessage(users=users), FeedbackMessage.SUCCESS)
+            self.assertNotIn('test_local_user', self._proc.managed)
+            with open('/home/test_local_user/.ssh/authorized_keys', 'rb') as fd:
+                self.assertEqual(fd.read(), self._public_key + '\n')
+            users = [{'username': 'test_user', 'sudo': False, 'keys': []}]
+            self._proc_message(SyncStateMessage(users=users), FeedbackMessage.INFO)
+            self.assertTrue(self._proc.has_user('test_local_user'))
+        finally:
+            self._proc.remove_user('test_local_user')
+
+    def test_state_digest(self):
+        self._add_key(FeedbackMessage.SUCCESS)
+        fb = self._proc.process(StateDigestMessage())
+        self._assert_feedback(fb, FeedbackMessage.SUCCESS)
+        self.assertIsNotNone(fb.digest['hash'])
+        expected = StateDigest()
+        expected.set_user('test_user', False,
+                [AuthorizedKey.parse(self._public_key).fingerprint])
+        self.assertEqual(fb.digest['hash'], expected.root())
+        self._update_user(FeedbackMessage.SUCCESS, sudo=True)
+        fb = self._proc.process(StateDigestMessage())
+        self.assertNotEqual(fb.digest['hash'], expected.root())
+
+    def test_unreadable_accounts(self):
+        def user(name):
+            raise BastioProvisionError("unable to read `/etc/passwd`")
+        self._proc._accounts.user = user
+        try:
+            self._add_user(FeedbackMessage.ERROR, sudo=False)
+            self._update_user(FeedbackMessage.ERROR, sudo=True)
+            self._add_key(FeedbackMessage.ERROR)
+            self._remove_key(FeedbackMessage.ERROR)
+            self._remove_user(FeedbackMessage.ERROR)
+            self._proc_message(SyncStateMessage(users=[{'username': 'test_user',
+                'sudo': False, 'keys': []}]), FeedbackMessage.ERROR)
+        finally:
+            del self._proc._accounts.user
+        # A key that can't be parsed fails alone
+        messages = [AddKeyMessage(username="test_user", public_key=self._public_key)
+                for x in range(2)]
+        messages[0].public_key = ""
+        statuses = [fb.status for fb in self._proc.process_keys(messages)]
+        self.assertEqual(statuses, [FeedbackMessage.ERROR, FeedbackMessage.SUCCESS])
+
     def _add_user(self, expect_status, **kwargs):
         msg = AddUserMessage(username="test_user", **kwargs)
         self._proc_message(msg, expect_status)
@@ -92,7 +244,201 @@ class TestProcessor(unittest.TestCase):
         msg = "{0} != {1}: {2}".format(fb.status, expect_status, fb.feedback)
         self.assertEqual(fb.status, expect_status, msg=msg)
 
+class PipelinedProcessor(Processor):
+    running = set()
+    concurrency = 0
+    accounts = 0
+    account_concurrency = 0
+    order = []
+    batches = []
+    lock = threading.Lock()
+
+    def process(self, message):
+        cls = PipelinedProcessor
+        if isinstance(message, SyncStateMessage):
+            with cls.lock:
+                if cls.running:
+                    raise AssertionError("a sync-state ran with other actions")
+                cls.running.add(None)
+            time.sleep(0.2)
+            with cls.lock:
+                cls.running.remove(None)
+                cls.order.append(message.mid)
+            return message.reply("done", FeedbackMessage.SUCCESS)
+        with cls.lock:
+            if None in cls.running:
+                raise AssertionError("an action ran with a sync-state")
+            if message.username in cls.running:
+                raise AssertionError("actions of the same user ran concurrently")
+            cls.running.add(message.username)
+            cls.concurrency = max(cls.concurrency, len(cls.running))
+            if isinstance(message, self.ExclusiveActions):
+                cls.accounts += 1
+                cls.account_concurrency = max(cls.account_concurrency, cls.accounts)
+        time.sleep(0.2)
+        with cls.lock:
+            cls.running.remove(message.username)
+            if isinstance(message, self.ExclusiveActions):
+                cls.accounts -= 1
+            cls.order.append(message.mid)
+        return message.reply("done", FeedbackMessage.SUCCESS)
+
+    def process_keys(self, messages):
+        PipelinedProcessor.batches.append([message.mid for message in messages])
+        return [self.process(message) for message in messages]
+
+class TestPipeline(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cfg = GlobalConfigStore()
+        cls._old_state_dir = cfg.state_dir
+        cls._state_dir = tempfile.mkdtemp()
+        cfg.state_dir = cls._state_dir
+        cls._proc = PipelinedProcessor()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._proc.stop()
+        GlobalConfigStore().state_dir = cls._old_state_dir
+        shutil.rmtree(cls._state_dir)
+
+    def test_pipeline(self):
+        endpoint = self._proc.endpoint()
+        key = RSAKey.generate(1024).get_public_key()
+        messages = [AddUserMessage(username="alice", sudo=False),
+                AddKeyMessage(username="alice", public_key=key),
+                AddKeyMessage(username="bob", public_key=key),
+                AddKeyMessage(username="carol", public_key=key),
+                AddUserMessage(username="dave", sudo=False),
+                RemoveUserMessage(username="erin")]
+        for msg in messages:
+            endpoint.ingress.put(msg)
+        mids = [endpoint.egress.get(timeout=10).mid for msg in messages]
+        self.assertItemsEqual(mids, [msg.mid for msg in messages])
+        self.assertGreater(PipelinedProcessor.concurrency, 1)
+        self.assertEqual(PipelinedProcessor.account_concurrency, 1)
+        # Actions of the same user complete in the order they were received
+        order = PipelinedProcessor.order
+        self.assertLess(order.index(messages[0].mid), order.index(messages[1].mid))
+
+    def test_key_batches(self):
+        endpoint = self._proc.endpoint()
+        key = RSAKey.generate(1024).get_public_key()
+        messages = [AddUserMessage(username="frank", sudo=False)]
+        messages += [AddKeyMessage(username="frank", public_key=key)
+                for x in range(4)]
+        messages += [UpdateUserMessage(username="frank", sudo=True),
+                RemoveKeyMessage(username="frank",
+                    public_key=RSAKey.generate(1024).get_public_key())]
+        for msg in messages:
+            endpoint.ingress.put(msg)
+        mids = [endpoint.egress.get(timeout=10).mid for msg in messages]
+        self.assertItemsEqual(mids, [msg.mid for msg in messages])
+        # Key actions waiting behind the user's action are applied together,
+        # but never across an action of another kind
+        self.assertIn([msg.mid for msg in messages[1:5]], PipelinedProcessor.batches)
+        self.assertIn([messages[6].mid], PipelinedProcessor.batches)
+        order = PipelinedProcessor.order
+        self.assertEqual([mid for mid in order if mid in mids],
+                [msg.mid for msg in messages])
+
+    def test_sync_barrier(self):
+        endpoint = self._proc.endpoint()
+        messages = [AddUserMessage(username="grace", sudo=False),
+                AddUserMessage(username="heidi", sudo=False),
+                SyncStateMessage(users=[]),
+                AddUserMessage(username="ivan", sudo=False),
+                AddUserMessage(username="judy", sudo=False)]
+        for msg in messages:
+            endpoint.ingress.put(msg)
+        feedbacks = [endpoint.egress.get(timeout=10) for msg in messages]
+        self.assertItemsEqual([fb.mid for fb in feedbacks],
+                [msg.mid for msg in messages])
+        # Actions that ran with a sync-state would have failed
+        self.assertEqual([fb.status for fb in feedbacks],
+                [FeedbackMessage.SUCCESS] * len(messages))
+
+    def test_replay_cache(self):
+        endpoint = self._proc.endpoint()
+        msg = AddUserMessage(username="kate", sudo=False)
+        endpoint.ingress.put(msg)
+        first = endpoint.egress.get(timeout=10)
+        # The backend sends the action again after a reconnect
+        endpoint.ingress.put(AddUserMessage(username="kate", sudo=False, mid=msg.mid))
+        second = endpoint.egress.get(timeout=10)
+        self.assertEqual(second.mid, msg.mid)
+        self.assertEqual((second.feedback, second.status),
+                (first.feedback, first.status))
+        self.assertEqual(PipelinedProcessor.order.count(msg.mid), 1)
+
+    def test_pending_duplicate(self):
+        endpoint = self._proc.endpoint()
+        msg = AddUserMessage(username="liam", sudo=False)
+        endpoint.ingress.put(msg)
+        # The backend sends the action again while it's being processed
+        time.sleep(0.05)
+        endpoint.ingress.put(AddUserMessage(username="liam", sudo=False, mid=msg.mid))
+        first = endpoint.egress.get(timeout=10)
+        second = endpoint.egress.get(timeout=10)
+        self.assertEqual((first.mid, second.mid), (msg.mid, msg.mid))
+        self.assertEqual((second.feedback, second.status),
+                (first.feedback, first.status))
+        self.assertEqual(PipelinedProcessor.order.count(msg.mid), 1)
+
+    def test_supersede(self):
+        endpoint = self._proc.endpoint()
+        key = RSAKey.generate(1024).get_public_key()
+        # Hold the handler back so that the actions are pending together, it
+        # may only take the first one
+        with self._proc._slots:
+            self._proc._barrier = True
+        messages = [AddUserMessage(username="nina", sudo=False),
+                AddKeyMessage(username="leo", public_key=key),
+                AddKeyMessage(username="mia", public_key=key),
+                UpdateUserMessage(username="leo", sudo=True),
+                RemoveKeyMessage(username="leo", public_key=key),
+                RemoveUserMessage(username="leo")]
+        for msg in messages:
+            endpoint.ingress.put(msg)
+        with self._proc._slots:
+            self._proc._barrier = False
+            self._proc._slots.notify_all()
+        feedbacks = dict((fb.mid, fb) for fb in
+                [endpoint.egress.get(timeout=10) for msg in messages])
+        self.assertItemsEqual(feedbacks, [msg.mid for msg in messages])
+        superseded = [msg.mid for msg in messages if msg.username == 'leo'][:-1]
+        for mid in superseded:
+            self.assertEqual(feedbacks[mid].status, FeedbackMessage.INFO)
+            self.assertNotIn(mid, PipelinedProcessor.order)
+        self.assertIn(messages[2].mid, PipelinedProcessor.order)
+        self.assertIn(messages[5].mid, PipelinedProcessor.order)
+
+class TestReplayCache(unittest.TestCase):
+    def test_lru(self):
+        evictions = GlobalMetrics().counter('replay_cache.evictions')
+        count = evictions.value
+        cache = ReplayCache(capacity=2)
+        cache.put('1', 'a')
+        cache.put('2', 'b')
+        self.assertEqual(cache.get('1'), 'a')
+        cache.put('3', 'c')
+        self.assertIsNone(cache.get('2'))
+        self.assertEqual(cache.get('1'), 'a')
+        self.assertEqual(cache.get('3'), 'c')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(evictions.value, count + 1)
+
+    def test_ttl(self):
+        cache = ReplayCache(ttl=0.1)
+        cache.put('1', 'a')
+        self.assertEqual(cache.get('1'), 'a')
+        time.sleep(0.15)
+        self.assertIsNone(cache.get('1'))
+        self.assertEqual(len(cache), 0)
+
 tests = [
         TestProcessor,
+        TestPipeline,
+        TestReplayCache,
         ]
 
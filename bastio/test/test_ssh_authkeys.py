@@ -0,0 +1,152 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.test.test_ssh_authkeys
+:synopsis: Unit tests for the ssh.authkeys module.
+:author: Amr Ali <amr@databracket.com>
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import shutil
+import unittest
+import tempfile
+
+from bastio.ssh.crypto import RSAKey
+from bastio.ssh.authkeys import (AuthorizedKey, AuthorizedKeys, AuthorizedKeysCache,
+        AuthorizedKeysWriter)
+from bastio.metrics import GlobalMetrics
+from bastio.excepts import BastioAuthKeysError
+
+class TestAuthorizedKey(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pubkey = RSAKey.generate(1024).get_public_key()
+
+    def test_parse(self):
+        key = AuthorizedKey.parse(self.pubkey + ' alice@host')
+        self.assertEqual(key.keytype, 'ssh-rsa')
+        self.assertIsNone(key.options)
+        self.assertEqual(key.comment, 'alice@host')
+        self.assertTrue(key.fingerprint.startswith('SHA256:'))
+        self.assertEqual(str(key), self.pubkey + ' alice@host')
+
+        options = 'from="10.0.0.1",command="echo \\"a b\\"",no-pty'
+        key = AuthorizedKey.parse('{} {}'.format(options, self.pubkey))
+        self.assertEqual(key.options, options)
+        self.assertIsNone(key.comment)
+        self.assertEqual(key.fingerprint,
+                AuthorizedKey.parse(self.pubkey).fingerprint)
+
+        self.assertIsNone(AuthorizedKey.parse('  # a comment'))
+        self.assertIsNone(AuthorizedKey.parse(''))
+        for line in ('no-pty', 'command="x ssh-rsa AAAA', 'ssh-rsa'):
+            with self.assertRaises(BastioAuthKeysError):
+                AuthorizedKey.parse(line)
+
+class TestAuthorizedKeys(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'authorized_keys')
+        self.keys = [RSAKey.generate(1024).get_public_key() for x in range(2)]
+        # The second key appears in the comment of the first entry
+        self.data = '# keys\n{} {}\ngarbage\n{}\n'.format(self.keys[0],
+                self.keys[1].split()[1], self.keys[1])
+        with open(self.path, 'wb') as fd:
+            fd.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_model(self):
+        keys = AuthorizedKeys(self.path)
+        keys.load()
+        self.assertEqual(len(keys), 2)
+        self.assertEqual(keys.render(), self.data)
+        fingerprint = AuthorizedKey.parse(self.keys[1]).fingerprint
+        self.assertIn(fingerprint, keys)
+        self.assertTrue(keys.remove(fingerprint))
+        self.assertFalse(keys.remove(fingerprint))
+        self.assertNotIn(fingerprint, keys)
+        # Only the entry of the key is removed
+        self.assertEqual(keys.render(), '\n'.join(self.data.splitlines()[:3]) + '\n')
+        self.assertTrue(keys.add(AuthorizedKey.parse(self.keys[1])))
+        self.assertFalse(keys.add(AuthorizedKey.parse(self.keys[1])))
+
+        missing = AuthorizedKeys(os.path.join(self.dir, 'missing'))
+        missing.load()
+        self.assertEqual(len(missing), 0)
+
+    def test_cache(self):
+        cache = AuthorizedKeysCache()
+        reloads = GlobalMetrics().counter('authkeys.reloads')
+        keys = cache.get(self.path)
+        count = reloads.value
+        self.assertIs(cache.get(self.path), keys)
+        self.assertEqual(reloads.value, count)
+        with open(self.path, 'ab') as fd:
+            fd.write(RSAKey.generate(1024).get_public_key() + '\n')
+        self.assertEqual(len(cache.get(self.path)), 3)
+        self.assertEqual(reloads.value, count + 1)
+
+    def test_writer(self):
+        writer = AuthorizedKeysWriter()
+        writes = GlobalMetrics().counter('authkeys.writes')
+        count = writes.value
+        new_key = AuthorizedKey.parse(RSAKey.generate(1024).get_public_key())
+        old = AuthorizedKey.parse(self.keys[0]).fingerprint
+        results = writer.apply(self.path, [(writer.ADD, new_key),
+            (writer.ADD, new_key), (writer.REMOVE, old), (writer.REMOVE, old)])
+        self.assertEqual(results, [True, False, True, False])
+        self.assertEqual(writes.value, count + 1)
+        with open(self.path, 'rb') as fd:
+            data = fd.read()
+        self.assertNotIn(self.keys[0], data)
+        self.assertTrue(data.endswith(str(new_key) + '\n'))
+        # Nothing is written if nothing changes
+        self.assertEqual(writer.apply(self.path, [(writer.REMOVE, old)]), [False])
+        self.assertEqual(writes.value, count + 1)
+
+        path = os.path.join(self.dir, 'new_keys')
+        writer.apply(path, [(writer.ADD, new_key)], (os.getuid(), os.getgid()))
+        self.assertEqual(os.stat(path).st_mode & 0777, 0600)
+        with self.assertRaises(BastioAuthKeysError):
+            writer.apply(os.path.join(self.dir, 'missing', 'keys'),
+                    [(writer.ADD, new_key)])
+        # Nothing is removed from a directory that does not exist
+        self.assertEqual(writer.apply(os.path.join(self.dir, 'missing', 'keys'),
+            [(writer.REMOVE, old)]), [False])
+
+    def test_writer_links(self):
+        writer = AuthorizedKeysWriter()
+        new_key = AuthorizedKey.parse(RSAKey.generate(1024).get_public_key())
+        outside = os.path.join(self.dir, 'outside')
+        with open(outside, 'wb') as fd:
+            fd.write('secret\n')
+        ssh_dir = os.path.join(self.dir, 'ssh')
+        os.mkdir(ssh_dir)
+        path = os.path.join(ssh_dir, 'authorized_keys')
+        os.symlink(outside, path)
+        # A linked file is neither read nor written through
+        with self.assertRaises(BastioAuthKeysError):
+            writer.apply(path, [(writer.ADD, new_key)])
+        self.assertTrue(os.path.islink(path))
+        with open(outside, 'rb') as fd:
+            self.assertEqual(fd.read(), 'secret\n')
+        os.unlink(path)
+        self.assertEqual(writer.apply(path, [(writer.ADD, new_key)]), [True])
+        # A linked directory is never locked
+        os.rename(ssh_dir, ssh_dir + '.real')
+        os.symlink(self.dir, ssh_dir)
+        with self.assertRaises(BastioAuthKeysError):
+            writer.apply(path, [(writer.ADD, new_key)])
+
+tests = [
+        TestAuthorizedKey,
+        TestAuthorizedKeys,
+        ]
+
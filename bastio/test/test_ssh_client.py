@@ -11,6 +11,10 @@ __author__ = "Amr Ali"
 __copyright__ = "Copyright 2013 Databracket LLC"
 __license__ = "GPLv3+"
 
+import time
+import random
+import shutil
+import tempfile
 import unittest
 import threading
 import paramiko
@@ -21,25 +25,58 @@ import Queue as queue
 from bastio.configs import GlobalConfigStore
 from bastio.ssh.client import BackendConnector
 from bastio.ssh.crypto import RSAKey
+from bastio.concurrency import LaneQueue
+from bastio.metrics import GlobalMetrics
 from bastio.ssh.protocol import (Netstring, MessageParser, AddUserMessage,
-        FeedbackMessage)
+        FeedbackMessage, HeartbeatMessage, FlowControlMessage, AckMessage,
+        ResumeMessage)
 from bastio.excepts import (BastioNetstringError, BastioMessageError,
-        BastioEOFError)
+        BastioEOFError, BastioBackendError)
 
 # Disable paramiko logging
 __plog = logging.getLogger('paramiko')
 __plog.addHandler(logging.NullHandler())
 
 class SSHSubsystem(paramiko.SubsystemHandler):
+    flow_control = queue.Queue()
+    session = None
+    recv_seq = 0
+    send_seq = 0
+
     def start_subsystem(self, name, transport, chan):
+        cls = SSHSubsystem
         while True:
             try:
                 json_string = self._read_message(chan)
                 msg = MessageParser.parse(json_string)
-                reply = msg.reply("message received successfully",
-                        FeedbackMessage.SUCCESS)
-                self._write_message(chan, reply.to_json())
-                return
+                if isinstance(msg, HeartbeatMessage):
+                    self._write_message(chan, msg.make_echo().to_json())
+                    continue
+                if isinstance(msg, FlowControlMessage):
+                    self.flow_control.put(msg.pause)
+                    # Pause the agent for as long as it pauses us
+                    self._write_message(chan, FlowControlMessage(
+                        pause=msg.pause).to_json())
+                    continue
+                if isinstance(msg, AckMessage):
+                    continue
+                if isinstance(msg, ResumeMessage):
+                    if msg.session is None or msg.session != cls.session:
+                        cls.session = str(random.getrandbits(64))
+                        cls.recv_seq = cls.send_seq = 0
+                    self._write_message(chan, ResumeMessage(session=cls.session,
+                        ack=cls.recv_seq).to_json())
+                    continue
+                if msg.seq > cls.recv_seq:
+                    cls.recv_seq = msg.seq
+                    reply = msg.reply("message received successfully",
+                            FeedbackMessage.SUCCESS)
+                    cls.send_seq += 1
+                    reply.seq = cls.send_seq
+                    self._write_message(chan, reply.to_json())
+                    if msg.username == "test_duplicate":
+                        self._write_message(chan, reply.to_json())
+                self._write_message(chan, AckMessage(ack=cls.recv_seq).to_json())
             except BastioNetstringError as ex:
                 msg = FeedbackMessage(ex.message, FeedbackMessage.ERROR)
                 self._write_message(chan, msg.to_json())
@@ -104,9 +141,12 @@ class TestBackendConnector(unittest.TestCase):
         cfg.backend_hostkey = RSAKey.generate(1024)
         cfg.host = "127.0.0.1"
         cfg.port = 12345
+        cfg.heartbeat_interval = 0.05
+        cls.state_dir = tempfile.mkdtemp()
+        cfg.state_dir = cls.state_dir
         cls.ingress = queue.Queue()
-        cls.egress = queue.Queue()
         cls.connector = BackendConnector()
+        cls.egress = cls.connector.egress
         endpoint = BackendConnector.EndPoint(ingress=cls.ingress,
                 egress=cls.egress)
         cls.connector.register(endpoint)
@@ -118,6 +158,7 @@ class TestBackendConnector(unittest.TestCase):
         cls.server_end.set()
         cls.server_thread.join()
         cls.server_sock.close()
+        shutil.rmtree(cls.state_dir)
 
     def test_backend_connector(self):
         self.server_ready.wait()
@@ -133,6 +174,96 @@ class TestBackendConnector(unittest.TestCase):
                 reply.feedback)
         self.assertEqual(reply.status, FeedbackMessage.SUCCESS, msg=errmsg)
 
+        # The backend acknowledges the message so it's dropped from the journal
+        for x in range(100):
+            if msg.mid not in self.connector.journal:
+                break
+            time.sleep(0.05)
+        self.assertNotIn(msg.mid, self.connector.journal)
+
+    def test_duplicate(self):
+        self.server_ready.wait()
+        self.assertIsNotNone(self.connector.session)
+        duplicates = GlobalMetrics().counter('backend.duplicates')
+        msg = AddUserMessage(username="test_duplicate", sudo=False)
+        self.egress.put(msg)
+        reply = self.ingress.get(timeout=10)
+        self.assertEqual(msg.mid, reply.mid)
+        self.assertEqual(reply.seq, SSHSubsystem.send_seq)
+        with self.assertRaises(queue.Empty):
+            self.ingress.get(timeout=0.5)
+        self.assertGreater(duplicates.value, 0)
+
+    def test_flow_control(self):
+        self.server_ready.wait()
+        ingress = LaneQueue(high_watermark=2, low_watermark=0)
+        self.connector.register(BackendConnector.EndPoint(ingress=ingress,
+            egress=self.egress))
+        ingress.put(1)
+        ingress.put(2)
+        self.assertTrue(ingress.throttled())
+        self.assertTrue(SSHSubsystem.flow_control.get(timeout=10))
+        # Control messages are still read and answered while both sides
+        # are paused
+        self._wait_for(lambda: self.connector._peer_paused)
+        count = self.connector.rtt.count
+        self._wait_for(lambda: self.connector.rtt.count > count)
+        self.assertTrue(self.connector.is_active())
+        ingress.get_nowait()
+        ingress.get_nowait()
+        self.assertFalse(ingress.throttled())
+        self.assertFalse(SSHSubsystem.flow_control.get(timeout=10))
+        self._wait_for(lambda: not self.connector._peer_paused)
+
+    def test_hold_back(self):
+        self.server_ready.wait()
+        ingress = LaneQueue(maxsize=1)
+        ingress.put(None)
+        self.connector.register(BackendConnector.EndPoint(ingress=ingress,
+            egress=self.egress))
+        try:
+            msg = AddUserMessage(username="test_hold_back", sudo=False)
+            self.egress.put(msg)
+            reply = self.ingress.get(timeout=10)
+            self.assertEqual(reply.mid, msg.mid)
+            # The reply is held back and not acknowledged while heartbeats
+            # are still handled
+            self._wait_for(lambda: self.connector._held)
+            self.assertEqual(self.connector._ack_seq(), reply.seq - 1)
+            self.assertTrue(SSHSubsystem.flow_control.get(timeout=10))
+            count = self.connector.rtt.count
+            self._wait_for(lambda: self.connector.rtt.count > count)
+            self.assertIsNone(ingress.get_nowait())
+            self.assertEqual(ingress.get(timeout=10).mid, msg.mid)
+            self._wait_for(lambda: not self.connector._held)
+            self.assertEqual(self.connector._ack_seq(), reply.seq)
+            self.assertFalse(SSHSubsystem.flow_control.get(timeout=10))
+        finally:
+            self.connector._endpoints.remove(self.connector._endpoints[-1])
+
+    def _wait_for(self, predicate):
+        for x in range(200):
+            if predicate():
+                break
+            time.sleep(0.05)
+        self.assertTrue(predicate())
+
+    def test_register(self):
+        endpoint = BackendConnector.EndPoint(ingress=queue.Queue(),
+                egress=queue.Queue())
+        with self.assertRaises(BastioBackendError):
+            self.connector.register(endpoint)
+
+    def test_heartbeat(self):
+        self.server_ready.wait()
+        for x in range(100):
+            if self.connector.rtt.count:
+                break
+            time.sleep(0.05)
+        self.assertGreater(self.connector.rtt.count, 0)
+        self.assertGreaterEqual(self.connector.rtt.average, 0)
+        self.assertTrue(self.connector.is_active())
+
     @classmethod
     def __server(cls):
         cfg = GlobalConfigStore()
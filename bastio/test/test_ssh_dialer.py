@@ -0,0 +1,84 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.test.test_ssh_dialer
+:synopsis: Unit tests for the ssh.dialer module.
+:author: Amr Ali <amr@databracket.com>
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import socket
+import unittest
+
+from bastio.ssh.dialer import Dialer
+from bastio.excepts import BastioBackendError
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class TestDialer(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_parse_endpoints(self):
+        endpoints = Dialer.parse_endpoints(
+                'a.example.com, b.example.com:22,[::1]:23,[::1]', 2357)
+        self.assertEqual(endpoints, [('a.example.com', 2357),
+            ('b.example.com', 22), ('::1', 23), ('::1', 2357)])
+        with self.assertRaises(BastioBackendError):
+            Dialer.parse_endpoints('a.example.com:port', 2357)
+        with self.assertRaises(BastioBackendError):
+            Dialer([])
+
+    def test_dial_failover(self):
+        dialer = Dialer([('127.0.0.1', _free_port()), ('127.0.0.1', self.port)],
+                stagger=0.05, timeout=5)
+        addr, sock = dialer.dial()
+        sock.close()
+        self.assertEqual(addr.port, self.port)
+
+        # The dead endpoint is attempted last from now on
+        candidates = dialer.candidates()
+        self.assertEqual(candidates[0].port, self.port)
+
+    def test_dial_failure(self):
+        dialer = Dialer([('127.0.0.1', _free_port())], timeout=5)
+        with self.assertRaises(BastioBackendError):
+            dialer.dial()
+
+    def test_rtt_preference(self):
+        other = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        other.bind(('127.0.0.1', 0))
+        other.listen(5)
+        try:
+            dialer = Dialer([('127.0.0.1', self.port),
+                ('127.0.0.1', other.getsockname()[1])], stagger=1)
+            first, second = dialer.candidates()
+            dialer.record_rtt(first, 0.5)
+            dialer.record_rtt(second, 0.01)
+            addr, sock = dialer.dial()
+            sock.close()
+            self.assertEqual(addr, second)
+            self.assertTrue(dialer.has_alternatives(second))
+            dialer.mark_failed(first)
+            self.assertFalse(dialer.has_alternatives(second))
+        finally:
+            other.close()
+
+tests = [
+        TestDialer,
+        ]
@@ -0,0 +1,87 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.test.test_ssh_digest
+:synopsis: Unit tests for the ssh.digest module.
+:author: Amr Ali <amr@databracket.com>
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import unittest
+
+from bastio.ssh.digest import StateDigest
+from bastio.metrics import GlobalMetrics
+
+class TestStateDigest(unittest.TestCase):
+    def setUp(self):
+        self.users = [('user{}'.format(x), x % 3 == 0, ['SHA256:k{}'.format(x),
+            'SHA256:j{}'.format(x)]) for x in range(200)]
+
+    def _make(self, users):
+        digest = StateDigest()
+        for user in users:
+            digest.set_user(*user)
+        return digest
+
+    def test_root(self):
+        self.assertIsNone(StateDigest().root())
+        digest = self._make(self.users)
+        root = digest.root()
+        self.assertEqual(len(digest), 200)
+        # The root only depends on the state
+        self.assertEqual(self._make(reversed(self.users)).root(), root)
+        digest.set_user('user7', False, ['SHA256:j7', 'SHA256:k7'])
+        self.assertEqual(digest.root(), root)
+        digest.set_user('user7', True, ['SHA256:j7', 'SHA256:k7'])
+        self.assertNotEqual(digest.root(), root)
+        digest.set_user('user7', False, ['SHA256:j7'])
+        self.assertNotEqual(digest.root(), root)
+        digest.set_user('extra', False, [])
+        digest.remove_user('extra')
+        digest.set_user('user7', False, ['SHA256:k7', 'SHA256:j7'])
+        self.assertEqual(digest.root(), root)
+        self.assertNotIn('extra', digest)
+
+    def test_incremental(self):
+        hashes = GlobalMetrics().counter('digest.hashes')
+        digest = self._make(self.users)
+        digest.root()
+        count = hashes.value
+        digest.root()
+        self.assertEqual(hashes.value, count)
+        digest.set_user('user7', True, [])
+        digest.root()
+        # Only the nodes on the path of the user are hashed again
+        self.assertLess(hashes.value - count, 5)
+
+    def test_find_drift(self):
+        local = self._make(self.users)
+        users = list(self.users)
+        users[42] = ('user42', True, [])
+        del users[99]
+        remote = self._make(users)
+        differ = set()
+        exchanges = 0
+        pending = ['']
+        while pending:
+            prefix = pending.pop()
+            mine, theirs = local.node(prefix), remote.node(prefix)
+            exchanges += 1
+            if mine['hash'] == theirs['hash']:
+                continue
+            if 'children' in mine:
+                pending.extend(prefix + digit for digit in mine['children'])
+            else:
+                for name, bucket in mine['users'].iteritems():
+                    if theirs.get('users', {}).get(name) != bucket:
+                        differ.add(name)
+        self.assertEqual(differ, set(['user42', 'user99']))
+        self.assertLess(exchanges, 60)
+
+tests = [
+        TestStateDigest,
+        ]
@@ -0,0 +1,101 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.test.test_ssh_expiry
+:synopsis: Unit tests for the ssh.expiry module.
+:author: Amr Ali <amr@databracket.com>
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import shutil
+import unittest
+import tempfile
+
+from bastio.ssh.expiry import ExpiryScheduler
+from bastio.ssh.crypto import RSAKey
+from bastio.ssh.authkeys import AuthorizedKey
+from bastio.journal import Journal
+
+class TestExpiryScheduler(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pubkey = RSAKey.generate(1024).get_public_key()
+        cls.fingerprint = AuthorizedKey.parse(cls.pubkey).fingerprint
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, ExpiryScheduler.JournalName)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _open(self, wake=None):
+        return ExpiryScheduler(Journal(self._path), wake)
+
+    def test_due(self):
+        sched = self._open()
+        for x in range(1000):
+            sched.add('user{}'.format(x), 1000 - x)
+        sched.add('user0', 2000)
+        sched.add('user1', 5000, self.pubkey)
+        for x in range(2, 500):
+            sched.discard('user{}'.format(x))
+        self.assertEqual(len(sched), 503)
+        self.assertEqual(sched.get('user1', self.fingerprint).public_key,
+                self.pubkey)
+        due = sched.due(now=510)
+        self.assertEqual([grant.username for grant in due],
+                ['user{}'.format(x) for x in range(999, 499, -1)])
+        self.assertIsNone(due[0].public_key)
+        # Grants are handed out again until they are discarded
+        self.assertEqual(sched.due(now=510), [])
+        retry = 510 + ExpiryScheduler.RetryInterval
+        self.assertEqual(len(sched.due(now=retry)), 500)
+        sched.discard('user1')
+        for x in range(500, 1000):
+            sched.discard('user{}'.format(x))
+        self.assertEqual([grant.username for grant in sched.due(now=10000)],
+                ['user0', 'user1'])
+        sched.stop()
+
+    def test_persistence(self):
+        sched = self._open()
+        sched.add('alice', 100, self.pubkey)
+        sched.add('alice', 50)
+        sched.add('bob', 200)
+        sched.add('bob', 300)
+        sched.add('carol', 400)
+        sched.discard_user('carol')
+        sched.stop()
+        sched = self._open()
+        self.assertEqual(len(sched), 3)
+        self.assertEqual(sched.get('bob').deadline, 300)
+        self.assertEqual([(grant.username, grant.fingerprint, grant.deadline)
+            for grant in sched.due(now=1000)], [('alice', None, 50),
+                ('alice', self.fingerprint, 100), ('bob', None, 300)])
+        sched.stop()
+
+    def test_wake(self):
+        wakes = []
+        sched = self._open(lambda: wakes.append(sched.next_deadline()))
+        self.assertIsNone(sched.next_deadline())
+        sched.add('alice', 300)
+        sched.add('bob', 400)
+        sched.add('carol', 200)
+        # Only grants that become the earliest wake the consumer up
+        self.assertEqual(wakes, [300, 200])
+        sched.discard('carol')
+        self.assertEqual(sched.next_deadline(), 300)
+        self.assertEqual(sched.due(now=350), [sched.get('alice')])
+        self.assertEqual(sched.next_deadline(),
+                min(400, 350 + ExpiryScheduler.RetryInterval))
+        sched.stop()
+
+tests = [
+        TestExpiryScheduler,
+        ]
@@ -0,0 +1,92 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.test.test_ssh_keystore
+:synopsis: Unit tests for the ssh.keystore module.
+:author: Amr Ali <amr@databracket.com>
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import pwd
+import time
+import shutil
+import socket
+import unittest
+import tempfile
+
+from bastio.ssh.crypto import RSAKey
+from bastio.ssh.authkeys import AuthorizedKey, AuthorizedKeysWriter
+from bastio.ssh.keystore import KeyStore, KeyServer, query_keys
+from bastio.concurrency import GlobalThreadPool
+from bastio.journal import Journal
+from bastio.excepts import BastioAuthKeysError
+
+ADD = AuthorizedKeysWriter.ADD
+REMOVE = AuthorizedKeysWriter.REMOVE
+
+class TestKeyStore(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = [AuthorizedKey.parse(RSAKey.generate(1024).get_public_key())
+                for x in range(2)]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'keys.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_store(self):
+        store = KeyStore(Journal(self.path))
+        self.assertEqual(store.apply('alice', [(ADD, self.keys[0]),
+            (ADD, self.keys[1]), (ADD, self.keys[0]),
+            (REMOVE, self.keys[1].fingerprint)]), [True, True, False, True])
+        store.apply('bob', [(ADD, self.keys[1])])
+        store.stop()
+        # Keys are kept across restarts
+        store = KeyStore(Journal(self.path))
+        self.assertEqual(store.render('alice'), str(self.keys[0]) + '\n')
+        self.assertEqual(store.render('bob'), str(self.keys[1]) + '\n')
+        store.remove_user('bob')
+        self.assertEqual(store.render('bob'), '')
+        self.assertEqual(store.render('nobody'), '')
+        store.stop()
+
+    def test_server(self):
+        GlobalThreadPool()
+        store = KeyStore(Journal(self.path))
+        store.apply('alice', [(ADD, self.keys[0])])
+        socket_path = os.path.join(self.tmpdir, 'run', 'keys.sock')
+        server = KeyServer(store, socket_path)
+        server.start()
+        slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            st = os.stat(socket_path)
+            self.assertEqual(st.st_mode & 0777, 0600)
+            self.assertEqual(st.st_uid, pwd.getpwnam(KeyServer.SocketUser).pw_uid)
+            # A client that never completes its query holds up no one
+            slow.connect(socket_path)
+            slow.sendall('ali')
+            started = time.time()
+            self.assertEqual(query_keys('alice', socket_path), str(self.keys[0]) + '\n')
+            self.assertEqual(query_keys('bob', socket_path), '')
+            self.assertLess(time.time() - started, KeyServer.ClientTimeout)
+            slow.settimeout(5)
+            self.assertEqual(slow.recv(1), '')
+        finally:
+            slow.close()
+            server.stop()
+            store.stop()
+        with self.assertRaises(BastioAuthKeysError):
+            query_keys('alice', socket_path)
+
+tests = [
+        TestKeyStore,
+        ]
+
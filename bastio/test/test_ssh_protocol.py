@@ -18,7 +18,8 @@ from bastio.mixin import Json
 from bastio.excepts import BastioMessageError
 from bastio.ssh.crypto import RSAKey
 from bastio.ssh.protocol import (Netstring, MessageParser, ProtocolMessage,
-        FeedbackMessage, ActionMessage, AddUserMessage, RemoveUserMessage,
+        FeedbackMessage, HeartbeatMessage, FlowControlMessage, AckMessage,
+        ResumeMessage, SyncStateMessage, StateDigestMessage, ActionMessage, AddUserMessage, RemoveUserMessage,
         UpdateUserMessage, AddKeyMessage, RemoveKeyMessage, ActionParser)
 
 class TestNetstring(unittest.TestCase):
@@ -45,6 +46,14 @@ class TestProtocolMessages(unittest.TestCase):
         obj.sudo = False
         msg = MessageParser.parse(obj.to_json())
         self.assertIsInstance(msg, AddUserMessage)
+        self.assertIsNone(msg.expires())
+        self.assertNotIn('expires_at', msg)
+        for expires_at in (True, '1700000000', 0, -1):
+            obj.expires_at = expires_at
+            self._msg_parser_raises(obj)
+        obj.expires_at = 1700000000.5
+        msg = MessageParser.parse(obj.to_json())
+        self.assertEqual(msg.expires(), 1700000000.5)
 
     def test_message_remove_user(self):
         obj = self._construct_action_msg(RemoveUserMessage)
@@ -64,6 +73,11 @@ class TestProtocolMessages(unittest.TestCase):
         obj.public_key = self.pubkey
         msg = MessageParser.parse(obj.to_json())
         self.assertIsInstance(msg, AddKeyMessage)
+        obj.expires_at = None
+        self._msg_parser_raises(obj)
+        obj.expires_at = 1700000000
+        msg = MessageParser.parse(obj.to_json())
+        self.assertEqual(msg.expires(), 1700000000)
 
     def test_message_remove_key(self):
         obj = self._construct_action_msg(RemoveKeyMessage)
@@ -84,6 +98,106 @@ class TestProtocolMessages(unittest.TestCase):
         msg = MessageParser.parse(obj.to_json())
         self.assertIsInstance(msg, FeedbackMessage)
 
+    def test_message_heartbeat(self):
+        obj = self._construct_protocol_msg()
+        obj.type = HeartbeatMessage.MessageType
+        self._msg_parser_raises(obj)
+        obj.echo = False
+        msg = MessageParser.parse(obj.to_json())
+        self.assertIsInstance(msg, HeartbeatMessage)
+        echo = msg.make_echo()
+        self.assertTrue(echo.echo)
+        self.assertEqual(echo.mid, msg.mid)
+        msg = MessageParser.parse(echo.to_json())
+        self.assertTrue(msg.echo)
+
+    def test_message_flow_control(self):
+        obj = self._construct_protocol_msg()
+        obj.type = FlowControlMessage.MessageType
+        self._msg_parser_raises(obj)
+        obj.pause = True
+        msg = MessageParser.parse(obj.to_json())
+        self.assertIsInstance(msg, FlowControlMessage)
+        self.assertTrue(msg.pause)
+
+    def test_message_ack(self):
+        obj = self._construct_protocol_msg()
+        obj.type = AckMessage.MessageType
+        self._msg_parser_raises(obj)
+        obj.ack = -1
+        self._msg_parser_raises(obj)
+        obj.ack = 42
+        msg = MessageParser.parse(obj.to_json())
+        self.assertIsInstance(msg, AckMessage)
+        self.assertEqual(msg.ack, 42)
+
+    def test_message_resume(self):
+        obj = self._construct_protocol_msg()
+        obj.type = ResumeMessage.MessageType
+        obj.ack = 0
+        self._msg_parser_raises(obj)
+        obj.session = None
+        msg = MessageParser.parse(obj.to_json())
+        self.assertIsInstance(msg, ResumeMessage)
+        self.assertIsNone(msg.session)
+        self.assertTrue(msg.Control)
+
+    def test_message_sync_state(self):
+        obj = self._construct_protocol_msg()
+        obj.type = SyncStateMessage.MessageType
+        self._msg_parser_raises(obj)
+        obj.users = [{'username': 'd4de', 'sudo': True, 'keys': [self.pubkey]}]
+        msg = MessageParser.parse(obj.to_json())
+        self.assertIsInstance(msg, SyncStateMessage)
+        self.assertEqual(msg.users[0]['keys'], [self.pubkey])
+        self.assertEqual(msg.priority(), ProtocolMessage.PRIORITY_HIGH)
+        self.assertIsNone(msg.ordering_key())
+        for users in ({}, [{'username': 'd4de'}],
+                [{'username': '@@@', 'sudo': False}],
+                [{'username': 'd4de', 'sudo': False, 'keys': ['invalid']}],
+                [{'username': 'd4de', 'sudo': False}] * 2):
+            obj.users = users
+            self._msg_parser_raises(obj)
+
+    def test_message_state_digest(self):
+        obj = self._construct_protocol_msg()
+        obj.type = StateDigestMessage.MessageType
+        msg = MessageParser.parse(obj.to_json())
+        self.assertIsInstance(msg, StateDigestMessage)
+        self.assertEqual(msg.prefix, '')
+        obj.prefix = '0af'
+        self.assertEqual(MessageParser.parse(obj.to_json()).prefix, '0af')
+        obj.prefix = 'xyz'
+        self._msg_parser_raises(obj)
+
+    def test_message_seq(self):
+        msg = AddUserMessage(username='d4de', sudo=True)
+        self.assertNotIn('seq', msg)
+        msg.seq = 7
+        parsed = MessageParser.parse(msg.to_json())
+        self.assertEqual(parsed.seq, 7)
+        self.assertNotIn('seq', parsed.reply('done', FeedbackMessage.SUCCESS))
+        msg.seq = 0
+        with self.assertRaises(BastioMessageError):
+            MessageParser.parse(msg.to_json())
+
+    def test_message_priority(self):
+        high, normal = ProtocolMessage.PRIORITY_HIGH, ProtocolMessage.PRIORITY_NORMAL
+        messages = [
+                (AddUserMessage(username='d4de', sudo=True), normal),
+                (RemoveUserMessage(username='d4de'), high),
+                (UpdateUserMessage(username='d4de', sudo=True), normal),
+                (UpdateUserMessage(username='d4de', sudo=False), high),
+                (AddKeyMessage(username='d4de', public_key=self.pubkey), normal),
+                (RemoveKeyMessage(username='d4de', public_key=self.pubkey), high),
+                ]
+        for msg, priority in messages:
+            self.assertEqual(msg.priority(), priority)
+            fb = msg.reply("test", FeedbackMessage.SUCCESS)
+            self.assertEqual(fb.priority(), priority)
+            self.assertEqual(fb.ordering_key(), 'd4de')
+        self.assertEqual(HeartbeatMessage().priority(), normal)
+
     def test_message_reply(self):
         obj = self._construct_action_msg(RemoveUserMessage)
         msg = MessageParser.parse(obj.to_json())
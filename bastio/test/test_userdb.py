@@ -0,0 +1,185 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.test.test_userdb
+:synopsis: Unit tests for the userdb module.
+:author: Amr Ali <amr@databracket.com>
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import shutil
+import unittest
+import tempfile
+
+from bastio.userdb import UserDatabase, AccountIndex, read_login_defs, allocate_id
+from bastio.fsutil import atomic_write
+from bastio.metrics import GlobalMetrics
+from bastio.excepts import BastioProvisionError
+
+PASSWD = """root:x:0:0:root:/root:/bin/bash
+# a comment
+alice:x:1000:1000::/home/alice:/bin/sh
++@netgroup
+"""
+SHADOW = """root:*:15000:0:99999:7:::
+alice:!:15000:0:99999:7:::
+"""
+GROUP = """root:x:0:
+sudo:x:27:alice
+alice:x:1000:
+"""
+GSHADOW = """root:*::
+sudo:*::alice
+alice:!::
+"""
+LOGIN_DEFS = """# login.defs
+UID_MIN 1000
+UID_MAX 1002
+GID_MIN 1000
+GID_MAX 60000
+UMASK 022
+"""
+
+def make_root():
+    """Create a root directory with account databases for tests."""
+    root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(root, 'etc', 'default'))
+    os.makedirs(os.path.join(root, 'etc', 'skel', '.config'))
+    for name, data in [('passwd', PASSWD), ('shadow', SHADOW), ('group', GROUP),
+            ('gshadow', GSHADOW), ('login.defs', LOGIN_DEFS),
+            ('default/useradd', 'SHELL=/bin/bash\nHOME=/home\n'),
+            ('skel/.profile', 'umask 022\n'), ('skel/.config/app', 'x\n')]:
+        with open(os.path.join(root, 'etc', name), 'wb') as fd:
+            fd.write(data)
+    return root
+
+class TestUserDatabase(unittest.TestCase):
+    def setUp(self):
+        self.root = make_root()
+        self.db = UserDatabase(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _read(self, name):
+        with open(os.path.join(self.root, 'etc', name), 'rb') as fd:
+            return fd.read()
+
+    def test_read_login_defs(self):
+        defs = read_login_defs(os.path.join(self.root, 'etc', 'login.defs'))
+        self.assertEqual(defs['UID_MAX'], '1002')
+        self.assertEqual(read_login_defs('/nonexistent'), {})
+
+    def test_add_user(self):
+        with self.db.transaction() as db:
+            uid = db.allocate_uid()
+            gid = db.allocate_gid(uid)
+            self.assertEqual((uid, gid), (1001, 1001))
+            db.add_group('bob', gid)
+            db.add_user('bob', uid, gid, '/home/bob', '/bin/sh', password='')
+            self.assertTrue(db.add_member('sudo', 'bob'))
+            self.assertFalse(db.add_member('sudo', 'bob'))
+        self.assertIn("bob:x:1001:1001::/home/bob:/bin/sh\n", self._read('passwd'))
+        self.assertIn("# a comment\n", self._read('passwd'))
+        self.assertIn("+@netgroup\n", self._read('passwd'))
+        self.assertTrue(self._read('shadow').splitlines()[-1].startswith('bob::'))
+        self.assertIn("sudo:x:27:alice,bob\n", self._read('group'))
+        self.assertIn("sudo:*::alice,bob\n", self._read('gshadow'))
+        self.assertIn("bob:!::\n", self._read('gshadow'))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'etc', 'passwd.lock')))
+
+    def test_allocation(self):
+        with self.db.transaction() as db:
+            db.add_user('bob', 1002, 1002, '/home/bob', '/bin/sh')
+            # Gaps are used once the range is exhausted
+            self.assertEqual(db.allocate_uid(), 1001)
+            db.add_user('carol', 1001, 1001, '/home/carol', '/bin/sh')
+            with self.assertRaises(BastioProvisionError):
+                db.allocate_uid()
+            # The preferred GID is taken
+            self.assertEqual(db.allocate_gid(1000), 1001)
+
+    def test_remove_user(self):
+        with self.db.transaction() as db:
+            db.remove_user('alice')
+            db.remove_group('alice')
+            with self.assertRaises(BastioProvisionError):
+                db.remove_member('nogroup', 'alice')
+        self.assertNotIn('alice', self._read('passwd'))
+        self.assertNotIn('alice', self._read('shadow'))
+        self.assertNotIn('alice', self._read('group'))
+        self.assertNotIn('alice', self._read('gshadow'))
+
+    def test_rollback(self):
+        with self.assertRaises(BastioProvisionError):
+            with self.db.transaction() as db:
+                db.remove_user('alice')
+                db.add_group('root', 1)
+        self.assertEqual(self._read('passwd'), PASSWD)
+
+class TestAccountIndex(unittest.TestCase):
+    def setUp(self):
+        self.root = make_root()
+        self.index = AccountIndex(self.root)
+        self.reloads = GlobalMetrics().counter('accounts.reloads')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.user('alice')[5], '/home/alice')
+        self.assertIsNone(self.index.user('bob'))
+        self.assertTrue(self.index.is_member('sudo', 'alice'))
+        self.assertFalse(self.index.is_member('alice', 'alice'))
+        reloads = self.reloads.value
+        self.assertTrue(self.index.has_user('root'))
+        self.assertEqual(self.reloads.value, reloads)
+
+    def test_invalidation(self):
+        self.assertFalse(self.index.has_user('bob'))
+        # A change made by some other tool
+        atomic_write(os.path.join(self.root, 'etc', 'passwd'),
+                PASSWD + "bob:x:1001:1001::/home/bob:/bin/sh\n")
+        self.assertTrue(self.index.has_user('bob'))
+
+    def test_absorb(self):
+        self.index.user('alice')
+        self.index.group('sudo')
+        reloads = self.reloads.value
+        with UserDatabase(self.root, self.index).transaction() as db:
+            db.add_group('bob', 1001)
+            db.add_user('bob', 1001, 1001, '/home/bob', '/bin/sh')
+            db.add_member('sudo', 'bob')
+        self.assertTrue(self.index.has_user('bob'))
+        self.assertTrue(self.index.is_member('sudo', 'bob'))
+        self.assertEqual(self.reloads.value, reloads)
+
+    def test_cache_files(self):
+        self.assertFalse(self.index.has_user('bob'))
+        atomic_write(os.path.join(self.root, 'etc', 'passwd.cache'),
+                "bob:x:1001:1001::/home/bob:/bin/sh\n")
+        atomic_write(os.path.join(self.root, 'etc', 'group.cache'),
+                "sudo:x:27:bob\n")
+        self.assertEqual(self.index.user('bob')[2], '1001')
+        self.assertTrue(self.index.is_member('sudo', 'alice'))
+        self.assertTrue(self.index.is_member('sudo', 'bob'))
+        os.unlink(os.path.join(self.root, 'etc', 'passwd.cache'))
+        self.assertFalse(self.index.has_user('bob'))
+
+    def test_allocate_id(self):
+        defs = {'UID_MIN': '1000', 'UID_MAX': '1002'}
+        self.assertEqual(allocate_id(defs, 'UID', set()), 1000)
+        self.assertEqual(allocate_id(defs, 'UID', set([1000]), 1001), 1001)
+        self.assertEqual(allocate_id(defs, 'UID', set([1001, 1002])), 1000)
+        with self.assertRaises(BastioProvisionError):
+            allocate_id(defs, 'UID', set([1000, 1001, 1002]))
+
+tests = [
+        TestUserDatabase,
+        TestAccountIndex,
+        ]
@@ -0,0 +1,515 @@
+# Copyright 2013 Databracket LLC
+# See LICENSE file for details.
+
+"""
+:module: bastio.userdb
+:synopsis: Direct access to the system's account databases.
+:author: Amr Ali <amr@databracket.com>
+
+.. autofunction:: read_login_defs
+
+.. autofunction:: allocate_id
+
+.. autoclass:: AccountDatabase
+    :members:
+
+.. autoclass:: UserDatabase
+    :members:
+
+.. autoclass:: AccountIndex
+    :members:
+"""
+
+__author__ = "Amr Ali"
+__copyright__ = "Copyright 2013 Databracket LLC"
+__license__ = "GPLv3+"
+
+import os
+import re
+import errno
+import time
+import threading
+import contextlib
+
+from bastio.mixin import public
+from bastio.metrics import GlobalMetrics
+from bastio.fsutil import atomic_write, FileLock, LinkLock
+from bastio.excepts import BastioProvisionError
+
+@public
+def read_login_defs(path):
+    """Read a ``login.defs(5)`` file, or a file of ``KEY=VALUE`` lines like
+    ``/etc/default/useradd``, into a dictionary of strings. A missing file is
+    read as an empty one.
+
+    :param path:
+        The path of the file.
+    :type path:
+        str
+    :returns:
+        dict
+    """
+    defs = {}
+    try:
+        with open(path, 'rb') as fd:
+            for line in fd:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                match = re.match(r'^(\w+)(?:\s+|\s*=\s*)(.*)$', line)
+                if match:
+                    defs[match.group(1)] = match.group(2).strip('"')
+    except IOError:
+        pass
+    return defs
+
+@public
+def allocate_id(defs, kind, used, preferred=None):
+    """Return ``preferred`` if it's free, otherwise a free ID in the
+    ``<kind>_MIN`` to ``<kind>_MAX`` range of ``login.defs(5)``. Like
+    ``useradd``, the one after the highest ID in use is taken and gaps are only
+    looked for once the range is exhausted.
+
+    :param defs:
+        The definitions read by :func:`read_login_defs`.
+    :type defs:
+        dict
+    :param kind:
+        Either ``UID`` or ``GID``.
+    :type kind:
+        str
+    :param used:
+        The IDs in use.
+    :type used:
+        set
+    :returns:
+        int
+    :raises:
+        :class:`bastio.excepts.BastioProvisionError`
+    """
+    low = int(defs.get(kind + '_MIN', 1000))
+    high = int(defs.get(kind + '_MAX', 60000))
+    if preferred is not None and low <= preferred <= high and \
+            preferred not in used:
+        return preferred
+    in_range = [x for x in used if low <= x <= high]
+    candidate = max(in_range) + 1 if in_range else low
+    if candidate <= high:
+        return candidate
+    for candidate in xrange(low, high + 1):
+        if candidate not in used:
+            return candidate
+    raise BastioProvisionError("no free {} is left between {} and {}".format(
+        kind, low, high))
+
+@public
+class AccountDatabase(object):
+    """A colon separated account database file such as ``/etc/passwd``, where
+    the first field of every entry is its name. Lines that are not entries
+    (e.g., comments or NIS compat lines) are kept untouched.
+
+    :param path:
+        The path of the database file.
+    :type path:
+        str
+    :param fields:
+        The number of fields of every entry.
+    :type fields:
+        int
+    :param optional:
+        Whether the file may not exist, in which case it's never written.
+    :type optional:
+        bool
+    """
+
+    def __init__(self, path, fields, optional=False):
+        self._path = path
+        self._fields = fields
+        self._optional = optional
+        self._lines = []
+        self._index = {}
+        self._exists = False
+        self._dirty = False
+        self._stat = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def stat(self):
+        """The :func:`os.stat` result of the file as it was last written by
+        :func:`AccountDatabase.save`, or None.
+        """
+        return self._stat
+
+    @property
+    def exists(self):
+        return self._exists
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def load(self):
+        """Read the database file.
+
+        :raises:
+            :class:`bastio.excepts.BastioProvisionError`
+        """
+        self._lines = []
+        self._index = {}
+        self._dirty = False
+        try:
+            with open(self._path, 'rb') as fd:
+                data = fd.read()
+        except IOError as ex:
+            if self._optional and not os.path.exists(self._path):
+                self._exists = False
+                return
+            raise BastioProvisionError("unable to read `{}`: {}".format(
+                self._path, ex.strerror))
+        self._exists = True
+        for line in data.splitlines():
+            fields = line.split(':')
+            if len(fields) != self._fields or not fields[0] or line[0] in '#+-':
+                self._lines.append(line)
+                continue
+            self._index.setdefault(fields[0], len(self._lines))
+            self._lines.append(fields)
+
+    def save(self):
+        """Write the database file atomically if it was changed."""
+        if not (self._exists and self._dirty):
+            return
+        data = ''.join('{}\n'.format(line if isinstance(line, basestring) else
+            ':'.join(line)) for line in self._lines if line is not None)
+        self._stat = atomic_write(self._path, data, 0600)
+        self._dirty = False
+
+    def copy(self):
+        """Return a copy of the database as it is in memory."""
+        db = AccountDatabase(self._path, self._fields, self._optional)
+        db._lines = list(self._lines)
+        db._index = dict(self._index)
+        db._exists = self._exists
+        return db
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        """Iterate over copies of all entries."""
+        for line in self._lines:
+            if line is not None and not isinstance(line, basestring):
+                yield list(line)
+
+    def get(self, name):
+        """Return a copy of the fields of entry ``name`` or None."""
+        if name not in self._index:
+            return None
+        return list(self._lines[self._index[name]])
+
+    def add(self, fields):
+        """Append a new entry.
+
+        :raises:
+            :class:`bastio.excepts.BastioProvisionError`
+        """
+        if not self._exists:
+            return
+        if fields[0] in self._index:
+            raise BastioProvisionError("`{}` already exists in `{}`".format(
+                fields[0], self._path))
+        self._index[fields[0]] = len(self._lines)
+        self._lines.append(list(fields))
+        self._dirty = True
+
+    def update(self, fields):
+        """Replace the entry named after the first field."""
+        if fields[0] in self._index:
+            self._lines[self._index[fields[0]]] = list(fields)
+            self._dirty = True
+
+    def remove(self, name):
+        """Remove entry ``name`` and return whether it existed."""
+        if name not in self._index:
+            return False
+        self._lines[self._index.pop(name)] = None
+        self._dirty = True
+        return True
+
+@public
+class UserDatabase(object):
+    """The ``passwd``, ``shadow``, ``group`` and ``gshadow`` databases of a
+    system. Changes must be made within a :func:`UserDatabase.transaction`,
+    which takes the same locks the shadow utilities take so that concurrent
+    changes by the agent and by tools such as ``useradd`` never clobber each
+    other.
+
+    :param root:
+        The root directory of the system, which is only useful for tests.
+    :type root:
+        str
+    :param index:
+        An index to update with the changes of every transaction.
+    :type index:
+        :class:`AccountIndex`
+    """
+    LockTimeout = 15.0
+
+    def __init__(self, root='/', index=None):
+        self._root = root
+        self._index = index
+        self.passwd = AccountDatabase(self.path('etc/passwd'), 7)
+        self.shadow = AccountDatabase(self.path('etc/shadow'), 9, optional=True)
+        self.group = AccountDatabase(self.path('etc/group'), 4)
+        self.gshadow = AccountDatabase(self.path('etc/gshadow'), 4, optional=True)
+        # The order in which databases are written, groups come first so that
+        # a user never refers to a group that does not exist yet
+        self._databases = (self.group, self.gshadow, self.passwd, self.shadow)
+
+    def path(self, *parts):
+        """Return the path of ``parts`` under the root directory."""
+        return os.path.join(self._root, *parts)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """A context manager that locks and loads all the databases, and writes
+        back the changed ones if no error is raised within the context.
+
+        :raises:
+            :class:`bastio.excepts.BastioProvisionError`
+        """
+        locks = [FileLock(self.path('etc/.pwd.lock'), self.LockTimeout)]
+        locks.extend(LinkLock(db.path, self.LockTimeout) for db in self._databases
+                if os.path.exists(db.path))
+        acquired = []
+        try:
+            for lock in locks:
+                lock.acquire()
+                acquired.append(lock)
+            self.defs = read_login_defs(self.path('etc/login.defs'))
+            for db in self._databases:
+                db.load()
+            yield self
+            for db in self._databases:
+                db.save()
+            if self._index is not None:
+                self._index.absorb(self.passwd, self.group)
+        except (OSError, IOError) as ex:
+            raise BastioProvisionError("unable to update account databases: {}".format(
+                ex.strerror))
+        except BastioProvisionError:
+            raise
+        except Exception as ex:
+            # Lock errors and the like
+            raise BastioProvisionError(str(ex))
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    def allocate_uid(self):
+        """Return a free UID in the ``UID_MIN`` to ``UID_MAX`` range."""
+        return self._allocate(self.passwd, 'UID')
+
+    def allocate_gid(self, preferred=None):
+        """Return ``preferred`` if it's a free GID, otherwise a free GID in the
+        ``GID_MIN`` to ``GID_MAX`` range.
+        """
+        return self._allocate(self.group, 'GID', preferred)
+
+    def add_user(self, name, uid, gid, home, shell, gecos='', password='!'):
+        """Add a user to the ``passwd`` and ``shadow`` databases."""
+        self.passwd.add([name, 'x', str(uid), str(gid), gecos, home, shell])
+        self.shadow.add([name, password, str(int(time.time() // 86400)),
+            self.defs.get('PASS_MIN_DAYS', '0'),
+            self.defs.get('PASS_MAX_DAYS', '99999'),
+            self.defs.get('PASS_WARN_AGE', '7'), '', '', ''])
+
+    def remove_user(self, name):
+        """Remove a user from the ``passwd`` and ``shadow`` databases and from
+        the members of every group.
+        """
+        self.passwd.remove(name)
+        self.shadow.remove(name)
+        for db in (self.group, self.gshadow):
+            for fields in db:
+                members = self._members(fields)
+                if name in members:
+                    members.remove(name)
+                    fields[3] = ','.join(members)
+                    db.update(fields)
+
+    def add_group(self, name, gid, members=()):
+        """Add a group to the ``group`` and ``gshadow`` databases."""
+        self.group.add([name, 'x', str(gid), ','.join(members)])
+        self.gshadow.add([name, '!', '', ','.join(members)])
+
+    def remove_group(self, name):
+        """Remove a group from the ``group`` and ``gshadow`` databases."""
+        self.group.remove(name)
+        self.gshadow.remove(name)
+
+    def members(self, group):
+        """Return the members of a group."""
+        return self._members(self.group.get(group))
+
+    def add_member(self, group, user):
+        """Add a user to the members of a group and return False if it was
+        already a member.
+
+        :raises:
+            :class:`bastio.excepts.BastioProvisionError`
+        """
+        if group not in self.group:
+            raise BastioProvisionError("group `{}` does not exist".format(group))
+        return self._set_member(group, user, True)
+
+    def remove_member(self, group, user):
+        """Remove a user from the members of a group and return False if it
+        was not a member.
+
+        :raises:
+            :class:`bastio.excepts.BastioProvisionError`
+        """
+        if group not in self.group:
+            raise BastioProvisionError("group `{}` does not exist".format(group))
+        return self._set_member(group, user, False)
+
+    def _set_member(self, group, user, member):
+        changed = False
+        for db in (self.group, self.gshadow):
+            fields = db.get(group)
+            if fields is None:
+                continue
+            members = self._members(fields)
+            if (user in members) == member:
+                continue
+            if member:
+                members.append(user)
+            else:
+                members.remove(user)
+            fields[3] = ','.join(members)
+            db.update(fields)
+            changed = True
+        return changed
+
+    def _allocate(self, db, kind, preferred=None):
+        used = set()
+        for fields in db:
+            try:
+                used.add(int(fields[2]))
+            except ValueError:
+                pass
+        return allocate_id(self.defs, kind, used, preferred)
+
+    @staticmethod
+    def _members(fields):
+        if not fields or not fields[3]:
+            return []
+        return fields[3].split(',')
+
+@public
+class AccountIndex(object):
+    """An in-memory index of the users and groups of the local ``passwd`` and
+    ``group`` databases, which answers lookups without going through NSS (and
+    possibly over the network to LDAP and the like). The ``passwd.cache`` and
+    ``group.cache`` files of ``libnss-cache`` are looked up as well if they
+    exist, after the databases themselves, see
+    :class:`bastio.provision.NssCacheProvisioner`.
+
+    Every lookup checks the inode, modification time and size of the files it
+    needs, and a file is read again only if any of them changed. Changes the
+    agent makes through a :class:`UserDatabase` that was given the index are
+    taken as they are without reading the files again. The number of times
+    the files are read is tracked by the ``accounts.reloads`` metric.
+
+    :param root:
+        The root directory of the system, which is only useful for tests.
+    :type root:
+        str
+    """
+    Fields = {'passwd': 7, 'group': 4}
+    CacheSuffix = '.cache'
+
+    def __init__(self, root='/'):
+        self._lock = threading.Lock()
+        self._databases = {}
+        for name, fields in self.Fields.iteritems():
+            path = os.path.join(root, 'etc', name)
+            self._databases[name] = [
+                    [AccountDatabase(path, fields), None],
+                    [AccountDatabase(path + self.CacheSuffix, fields, optional=True),
+                        None]]
+        self._reloads = GlobalMetrics().counter('accounts.reloads')
+
+    def user(self, name):
+        """Return the ``passwd`` fields of a user or None."""
+        return self._lookup('passwd', name)
+
+    def group(self, name):
+        """Return the ``group`` fields of a group or None."""
+        return self._lookup('group', name)
+
+    def has_user(self, name):
+        """Return whether a user exists."""
+        return self.user(name) is not None
+
+    def is_member(self, group, user):
+        """Return whether a user is listed as a member of a group in any of
+        the files.
+        """
+        for db in self._get('group'):
+            fields = db.get(group)
+            if fields and fields[3] and user in fields[3].split(','):
+                return True
+        return False
+
+    def absorb(self, passwd, group):
+        """Take the databases as written by the agent.
+
+        :param passwd:
+            The ``passwd`` database.
+        :type passwd:
+            :class:`AccountDatabase`
+        :param group:
+            The ``group`` database.
+        :type group:
+            :class:`AccountDatabase`
+        """
+        with self._lock:
+            for name, db in (('passwd', passwd), ('group', group)):
+                if db.stat is not None:
+                    self._databases[name][0] = [db.copy(), self._signature(db.stat)]
+
+    def _lookup(self, name, key):
+        for db in self._get(name):
+            fields = db.get(key)
+            if fields is not None:
+                return fields
+        return None
+
+    def _get(self, name):
+        with self._lock:
+            entries = self._databases[name]
+            for idx, entry in enumerate(entries):
+                try:
+                    signature = self._signature(os.stat(entry[0].path))
+                except OSError as ex:
+                    if idx == 0 or ex.errno != errno.ENOENT:
+                        raise BastioProvisionError("unable to stat `{}`: {}".format(
+                            entry[0].path, ex.strerror))
+                    signature = None
+                if signature != entry[1]:
+                    # Loading after the stat may only cause an extra reload
+                    db = AccountDatabase(entry[0].path, self.Fields[name],
+                            optional=idx > 0)
+                    db.load()
+                    entries[idx] = [db, signature]
+                    self._reloads.inc()
+            return [entry[0] for entry in entries]
+
+    @staticmethod
+    def _signature(st):
+        return (st.st_dev, st.st_ino, st.st_mtime, st.st_size)